@@ -1,15 +1,12 @@
 #!/usr/bin/python
 #
 import os
-import errno
 import logging
-import time
 import RPi.GPIO as GPIO
 import threading
 import smbus
-from datetime import datetime
-import requests
-import math
+from array import array
+from monitorLib import apa102, led_anim, sens_shm, uploader, sched, clock, trace, so1602, i2c_bus, ipc_server, sample_ring, sht31, history, metrics
 
 __i2c = None
 
@@ -27,11 +24,9 @@ __i2c = None
 class c3_m:
 
     _i2c = None
-    _t1  = 0
-    _t2r = 0
-    _t2g = 0
-    _t2b = 0
     _dt  = 1/4.0
+    _pattern = 'breath'		# initial animation pattern (changed by UI module)
+    _timer = None		# animation frame timer
 
     #- - - - - - - - - - - - - - - - - -
     # LED controller constant
@@ -43,28 +38,8 @@ class c3_m:
     REG_POLARITY = 0x02
     REG_CONFIG   = 0x03
 
-    LED_DATA = 7
-    LED_CLOCK = 6
-
-    LED_GAMMA = [
-	  0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,
-	  0,   0,   0,   0,   0,   0,   1,   1,   1,   1,   1,   1,   1,   2,   2,   2,
-	  2,   2,   2,   3,   3,   3,   3,   3,   4,   4,   4,   4,   5,   5,   5,   5,
-	  6,   6,   6,   7,   7,   7,   8,   8,   8,   9,   9,   9,  10,  10,  11,  11,
-	 11,  12,  12,  13,  13,  13,  14,  14,  15,  15,  16,  16,  17,  17,  18,  18,
-	 19,  19,  20,  21,  21,  22,  22 , 23,  23,  24,  25,  25,  26,  27,  27,  28,
-	 29,  29,  30,  31,  31,  32,  33,  34,  34,  35,  36,  37,  37,  38,  39,  40,
-	 40,  41,  42,  43,  44,  45,  46,  46,  47,  48,  49,  50,  51,  52,  53,  54,
-	 55,  56,  57,  58,  59,  60,  61,  62,  63,  64,  65,  66,  67,  68,  69,  70,
-	 71,  72,  73,  74,  76,  77,  78,  79,  80,  81,  83,  84,  85,  86,  88,  89,
-	 90,  91,  93,  94,  95,  96,  98,  99, 100, 102, 103, 104, 106, 107, 109, 110,
-	111, 113, 114, 116, 117, 119, 120, 121, 123, 124, 126, 128, 129, 131, 132, 134,
-	135, 137, 138, 140, 142, 143, 145, 146, 148, 150, 151, 153, 155, 157, 158, 160,
-	162, 163, 165, 167, 169, 170, 172, 174, 176, 178, 179, 181, 183, 185, 187, 189,
-	191, 193, 194, 196, 198, 200, 202, 204, 206, 208, 210, 212, 214, 216, 218, 220,
-	222, 224, 227, 229, 231, 233, 235, 237, 239, 241, 244, 246, 248, 250, 252, 255]
-
     _brightness = 0.8
+    _last_rgb = None		# gamma corrected color of the last frame
 
     @staticmethod
     def init(__i2c):
@@ -76,51 +51,54 @@ class c3_m:
 
 	c3_m.set_pixel(0, 100, 200)
 
+	led_anim.init(apa102.GAMMA, c3_m._brightness, c3_m._dt)
+	led_anim.load(c3_m._pattern)
+	c3_m._start()
+
     @staticmethod
-    def _write_byte(byte):
-	cmd = []
-	for x in range(8):
-	    if (byte & 0b10000000) : _cmd = (1 << c3_m.LED_DATA)
-	    else:			 _cmd = 0
-	    cmd.append(_cmd)
-	    _cmd |= (1 << c3_m.LED_CLOCK)
-	    cmd.append(_cmd)
-	    byte <<= 1
-
-	c3_m._i2c.write_i2c_block_data(c3_m.i2cAddr_BTN, c3_m.REG_OUTPUT, cmd)
+    def _start():
+	# a static pattern needs only one frame: no frame timer
+	sched.cancel(c3_m._timer)
+	c3_m._timer = None
+	if led_anim.is_static():
+	    sched.call_soon(c3_m.polling)
+	else:
+	    c3_m._timer = sched.every(c3_m._dt, c3_m.polling)
 
     @staticmethod
+    def set_pattern(name):
+	logger = logging.getLogger(__name__)
+	try:
+	    led_anim.load(name)
+	    c3_m._pattern = name
+	    c3_m._start()
+	    logger.debug("led pattern:" + name)
+	except ValueError as e:
+	    logger.warning(str(e))
+
+    @staticmethod
+    @metrics.timed('c3_m.set_pixel')
     def set_pixel(r, g, b):
-	r, g, b = [int(x * c3_m._brightness) for x in (r, g, b)]
+	r, g, b = [apa102.GAMMA[int(x * c3_m._brightness) & 0xff] for x in (r, g, b)]
+	c3_m.write_frame(r, g, b)
 
-	c3_m._write_byte(0)
-	c3_m._write_byte(0)
-	c3_m._write_byte(0b11101111)
-	c3_m._write_byte(c3_m.LED_GAMMA[b & 0xff])
-	c3_m._write_byte(c3_m.LED_GAMMA[g & 0xff])
-	c3_m._write_byte(c3_m.LED_GAMMA[r & 0xff])
-	c3_m._write_byte(0)
-	c3_m._write_byte(0)
+    @staticmethod
+    @metrics.timed('c3_m.write_frame')
+    def write_frame(r, g, b):
+	# nothing to do if the corrected color is the same as the last frame
+	if c3_m._last_rgb == (r, g, b): return
+	c3_m._last_rgb = (r, g, b)
+
+	# the whole frame under the bus lock, but buttons / sensors may cut in between the blocks
+	with c3_m._i2c:
+	    for block in apa102.encode(r, g, b):
+		c3_m._i2c.yield_bus()
+		c3_m._i2c.write_i2c_block_data(c3_m.i2cAddr_BTN, c3_m.REG_OUTPUT, block)
 
     @staticmethod
     def polling():
-
-	c3_m._t1 += c3_m._dt
-	mtr = abs((c3_m._t1 % 80) - 40) + 10.0
-	mtg = abs((c3_m._t1 % 82) - 41) + 10.1
-	mtb = abs((c3_m._t1 % 84) - 42) + 9.9
-	
-	c3_m._t2r += c3_m._dt / mtr
-	c3_m._t2g += c3_m._dt / mtg
-	c3_m._t2b += c3_m._dt / mtb
-
-	Lr = math.sin(c3_m._t2r * math.pi) * 180 + 60
-	if Lr < 0 : Lr = 0
-	Lg = math.sin(c3_m._t2g * math.pi) * 180 + 60
-	if Lg < 0 : Lg = 0
-	Lb = math.sin(c3_m._t2b * math.pi) * 180 + 60
-	if Lb < 0 : Lb = 0
-	c3_m.set_pixel(Lr, Lg, Lb)
+	r, g, b = led_anim.next_frame()
+	c3_m.write_frame(r, g, b)
 
 #====================================================================#
 #  LED display ON / OFF  controller class
@@ -153,16 +131,37 @@ class ld():
     RL  = 4		# Scroll(shift) direction 1: right  0: left
     #---------------------------------------------------------------------------------
 
+    _batch = None	# commands queued between batch_begin() and batch_end()
+    _batch_depth = 0
+
     # # INTERNAL methods # #
 
     @staticmethod
     def ms_delay(n):
-	time.sleep(n / 1000000.0)
+	clock.sleep(n / 1000000.0)
 
     @staticmethod
-    def so_cmd(c) :
-	ld._i2c.write_byte_data(ld.i2cAddr_LD, 0, c)
-	ld.ms_delay(5)
+    def so_cmd(c, delay = None) :
+	if delay is None: delay = so1602.delay(c)
+	if ld._batch is not None:
+	    ld._batch.append((c, delay))
+	else:
+	    so1602.send(ld._i2c, ld.i2cAddr_LD, [(c, delay)])
+
+    #
+    #  command batch: so_cmd() between begin and end goes in one transfer
+    #
+    @staticmethod
+    def batch_begin():
+	if ld._batch_depth == 0: ld._batch = []
+	ld._batch_depth += 1
+
+    @staticmethod
+    def batch_end():
+	ld._batch_depth -= 1
+	if ld._batch_depth == 0:
+	    cmds, ld._batch = ld._batch, None
+	    so1602.send(ld._i2c, ld.i2cAddr_LD, cmds)
 
     @staticmethod
     def init_1602() :
@@ -196,23 +195,29 @@ class ld():
 
 class hsd:
 
+    CONFIRM = 3.0		# 2 edges within CONFIRM sec : somebody is there
+    LEAVE   = 10.0		# no edge for LEAVE sec : left
+    RING    = 16		# edges kept in the ring buffer
+
     _mode = 0			# 0:mode off , 1: hsd mode
     _is_someone = 0
-    _dtect_count = 0		# detection signal count in a minute
-    _t_detect = None		# the time of sensor detect heat source(=null when _is_someone == false)
-    _t_confirming = None	# when the sensor detect twice within 3.0 second, it's regard as "detection". 
-				#  This store the first detection time.
-    _detect_count = 0
+    _edges = None		# ring buffer of edge times (clock.time())
+    _head = 0			# next slot of _edges
+    _detect_count = 0		# detection signal count in a minute
+    _timer = None		# leave timer
+    _lock = threading.Lock()	# edges come on the GPIO thread
+    _subscribers = []		# func(is_someone) called on the sched thread at a state change
 
     @staticmethod
     def init():
 
+	hsd._edges = array('d', [0.0] * hsd.RING)
+	hsd._head = 0
+
 	GPIO.setmode( GPIO.BCM )
 	GPIO.setup( 10, GPIO.IN )
 	GPIO.add_event_detect( 10, GPIO.RISING, callback = hsd.hsd_callback )
 
-	hsd._t_confirming = time.time()
-
 	if hsd._mode == 0 :
 	    hsd._is_someone= 1
 	else :
@@ -220,6 +225,27 @@ class hsd:
 
 	return
 
+    @staticmethod
+    def subscribe(func):
+	hsd._subscribers.append(func)
+
+    @staticmethod
+    def _publish(is_someone):
+	for func in hsd._subscribers:
+	    func(is_someone)
+
+    @staticmethod
+    def _set(is_someone):
+	# (under _lock)
+	if hsd._is_someone == is_someone: return
+	hsd._is_someone = is_someone
+	sched.call_soon(hsd._publish, is_someone)
+
+    @staticmethod
+    def _last_edge(n = 1):
+	# the time of the n-th last edge (0.0: none)
+	return hsd._edges[(hsd._head - n) % hsd.RING]
+
     #
     #  set configuration
     #
@@ -228,72 +254,73 @@ class hsd:
 	logger = logging.getLogger(__name__)
 	logger.debug("set_mode:" + str(new_mode))
 
-	if hsd._mode == new_mode:
-	    return
+	with hsd._lock:
+	    if hsd._mode == new_mode:
+		return
 
-	hsd._mode = new_mode
-	if hsd._mode== 0 :
-	    logger.debug("set_mode:_is_someone = 1")
-	    hsd._is_someone = 1
-#	else :
-#	    logger.debug("set_mode:_is_someone = 0")
-#	    hsd._is_someone = 0
+	    hsd._mode = new_mode
+	    if hsd._mode== 0 :
+		logger.debug("set_mode:_is_someone = 1")
+		sched.cancel(hsd._timer)
+		hsd._set(1)
 
     #
-    # hsd callback
+    # hsd callback (GPIO thread)
     #
-    #   update _t_detect by current time
+    #   the edge goes to the ring buffer, the state is decided here at once
     #
     @staticmethod
     def hsd_callback(portNo):
 
 	logger = logging.getLogger(__name__)
-	hsd._t_detect = time.time()
-	logger.debug("hsd triggered")
-	hsd._detect_count += 1
+	t = clock.time()
+	trace.record('pir')
+
+	with hsd._lock:
+	    prev = hsd._last_edge()
+	    hsd._edges[hsd._head] = t
+	    hsd._head = (hsd._head + 1) % hsd.RING
+	    hsd._detect_count += 1
+
+	    if hsd._mode == 0:
+		return
+
+	    if hsd._is_someone:
+		hsd._arm_leave(t)
+	    elif t - prev <= hsd.CONFIRM:
+		logger.debug("hsd: detect")
+		hsd._set(1)
+		hsd._arm_leave(t)
+	    else:
+		logger.debug("hsd: confirming...")
 
 	return
 
     @staticmethod
-    def get_detect_count():
+    def _arm_leave(t):
+	# (under _lock) leave timer at the last edge + LEAVE
+	sched.cancel(hsd._timer)
+	hsd._timer = sched.call_later(t + hsd.LEAVE - clock.time(), hsd._leave)
 
-	return_val = hsd._detect_count
-	hsd._detect_count = 0
-	return return_val
-        
-    #
-    #   expected to be called periodically
-    #
-    #    decide _is_someone or not
-    #
     @staticmethod
-    def polling():
-
+    def _leave():
 	logger = logging.getLogger(__name__)
-	if hsd._mode == 0 or hsd._t_detect == None :
-	    # there is nothing to do in this condition
-	    return
-
-	if hsd._is_someone :
-	    # aleady acquired
-	    if time.time() - hsd._t_detect > 10 :
-		hsd._is_someone = 0
-		hsd._t_detect = None
-		logger.debug("hsd: leaved")
-
-	elif (hsd._t_confirming == None) or (hsd._t_detect - hsd._t_confirming > 3.0) :
-	    # first event
-	    hsd._t_confirming = hsd._t_detect
-	    hsd._t_detect = None
-	    logger.debug("hsd: confirming...")
+	with hsd._lock:
+	    if hsd._mode == 0 or not hsd._is_someone: return
+	    t = hsd._last_edge()
+	    if clock.time() - t < hsd.LEAVE:
+		hsd._arm_leave(t)		# an edge came just now
+		return
+	    logger.debug("hsd: leaved")
+	    hsd._set(0)
 
-	else :
-	    # subsequent event(now acquireing)
-	    hsd._t_confirming = None
-	    hsd._is_someone = 1
-	    logger.debug("hsd: detect")
+    @staticmethod
+    def get_detect_count():
 
-	return
+	with hsd._lock:
+	    return_val = hsd._detect_count
+	    hsd._detect_count = 0
+	return return_val
 
 #====================================================================#
 #  message acceptor (from child process)
@@ -304,39 +331,44 @@ class m_a:
     _hsd_mode = 2	# 0/1 : the same as hsd._mode, 
 			# 2   : hsd mechanism is closed because of stagnation of a message from UI module
     _t_received = 0
-    _fifo = '/tmp/pipe'
     _led_current = 0
+    _timer = None		# UI module timeout timer
 
     @staticmethod
     def init():
+	m_a._t_received = clock.time()
+	ipc_server.listen(m_a.on_message)
+
+    #
+    #  a message from UI module
+    #
+    @staticmethod
+    def on_message(data):
 	logger = logging.getLogger(__name__)
 
-	m_a._t_received = time.time()
-	try:
-	    os.mkfifo(m_a._fifo)
-	except EnvironmentError as ee:
-	    logger.info("fifo cannot create:" + str(ee.errno))
-	    if ee.errno != errno.EEXIST:
-		logger.error("fifo cannot create" + ee.args)
-		raise
+	if data.startswith('led:'):
+	    # animation pattern of the 3 color led
+	    c3_m.set_pattern(data[4:])
+	    return
+	if not data.startswith('hsd:'):
+	    logger.warning("unknown message: " + repr(data))
+	    return
 
-	th = threading.Thread(target = m_a.fifo_listner)
-	th.setDaemon(True)
-	th.start()
+	m_a._hsd_mode = int(data[4:])
+	m_a._t_received = clock.time()
+	logger.debug("data received from UI " + str(m_a._hsd_mode))
+	hsd.set_mode(m_a._hsd_mode)
 
-    @staticmethod
-    def fifo_listner():
-	logger = logging.getLogger(__name__)
+	sched.cancel(m_a._timer)
+	m_a._timer = sched.call_later(125.05, presence_check)
+	sched.call_soon(presence_check)
 
-	while True:
-	    logger.debug("waiting fifo...")
-	    with open (m_a._fifo) as f:
-		data = f.read()
-		if len(data) == 0 : break
-		m_a._hsd_mode = int(data)
-		m_a._t_received = time.time()
-		logger.debug("data received from fifo " + str(m_a._hsd_mode))
-		hsd.set_mode(m_a._hsd_mode)
+    #
+    #  hsd state change (subscriber of hsd)
+    #
+    @staticmethod
+    def on_presence(is_someone):
+	m_a.polling()
 
     @staticmethod
     def polling():
@@ -347,9 +379,9 @@ class m_a:
             # This could be changed by a reconnected UI module.
 	    return
 
-	if time.time() - m_a._t_received > 125:
+	if clock.time() - m_a._t_received > 125:
             # UI module is not active
-	    logger.warning("fifo timeout... hsd is closed")
+	    logger.warning("UI timeout... hsd is closed")
 	    m_a._hsd_mode = 2
 	    m_a._led_current = 0
 	    logger.debug("led OFF");
@@ -358,6 +390,7 @@ class m_a:
 	    if m_a._led_current != hsd._is_someone :
 		# hsd status is changed or UI module change the hsd_mode
 		m_a._led_current = hsd._is_someone
+		ipc_server.broadcast('pir:%d' % m_a._led_current)
 		if m_a._led_current == 1 :
 		    logger.debug("led ON");
 		    ld.display_sw(1)
@@ -376,71 +409,101 @@ def get_cpu_thermal():
     f = open('/sys/class/thermal/thermal_zone0/temp','r')
     temp_c = long(f.read()) / 1000.0
     f.close()
+    trace.record('cpu', temp_c)
 
     return temp_c
 
 #
-#   SHT-31 sensor read
+#   SHT-31 sensor read (sht31 driver of monitorLib)
 #
-i2cAddr_SHT31 = 0x45
+sensor = None
+sht_rep = sht31.HIGH			# repeatability (HIGH / MEDIUM / LOW)
 
-def measure_T_H():
+def measure_T_H(callback = None):
+    # returns at once, sens_and_record() (or callback) gets the result
+    # (cost of a measurement: sensor.latency, monitor_sht31_measure_seconds)
+    logger.debug("read from sensor device...")
+    sensor.measure(callback or sens_and_record, sht_rep)
 
-    global __i2c
+#
+#   SHT-31 periodic acquisition (high rate sampling)
+#
+sht_rate = 0				# 0: one shot per minute,  0.5/1/2/4/10: periodic acquisition (Hz)
+
+sens_ring = None			# samples of the current minute
+aggregate = None			# per minute aggregates of sens_ring (window())
+
+def start_periodic(rate):
+    global sens_ring
+    sensor.start_periodic(rate, sht_rep)
+    sens_ring = sample_ring(('T-SHT-31', 'H-SHT-31', 'T-cpu_emily'), int(rate * 60 * 2))
+    sched.every(1.0 / rate, sample_job)
+
+def first_sample(th):
+    # the sensor NACKs commands while converting: periodic mode starts
+    # only after the single shot has been read (or given up)
+    sens_and_record(th)
+    if sht_rate: start_periodic(sht_rate)
+
+def sample_job():
+    th = sensor.fetch()
+    if th is None: return
+    (temp_s, humidity) = th
+    trace.record('sht', temp_s, humidity)
+    sens_ring.add(temp_s, humidity, get_cpu_thermal())
 
-    logger = logging.getLogger(__name__)
-    logger.debug("read from sensor device...")
-    __i2c.write_i2c_block_data(i2cAddr_SHT31, 0x2c, [0x06])
-    time.sleep(0.02)
-    data = __i2c.read_i2c_block_data(i2cAddr_SHT31, 0, 6)
+#
+#   write sensed data to the shared memory, the history (and the data file)
+#
+sens_file = '/tmp/sens_data.txt'	# text file for an old UI module (None: not written)
 
-    temp_s   = ( 175 * (data[0] * 256 + data[1]) / 65535.0) - 45
-    humidity =   100 * (data[3] * 256 + data[4]) / 65535.0
+def sens_and_record(th):
+    global sample
 
+    if th is None:
+	logger.warning("SHT-31: no valid result (crc errors {}, timeouts {})".format(
+	    sensor.crc_errors, sensor.timeouts))
+	return
+    (temp_s, humidity) = th
     logger.debug("{:05.2f}C {:04.1f}%".format(temp_s, humidity))
+    trace.record('sht', temp_s, humidity)
 
-    return temp_s, humidity
+    temp_c = get_cpu_thermal()
+    sample = record(temp_s, temp_c, humidity)
 
-#
-#   write sensed data to the data file and the server
-#
-def sens_and_record():
+def record(temp_s, temp_c, humidity):
 
-    (temp_s, humidity) = measure_T_H()
-    temp_c = get_cpu_thermal()
+    ts = clock.time()
+    sens_shm.write(ts, temp_s, temp_c, humidity)
+    history.add(ts, temp_s, temp_c, humidity)
+    ipc_server.broadcast('sens:' + ','.join([repr(x) for x in (ts, temp_s, temp_c, humidity)]))
 
-    with open('/tmp/sens_data.txt', 'w') as f:
-	f.write(str(temp_s)+','+ str(temp_c) + ',' + str(humidity))
+    if sens_file is not None:
+	with open(sens_file + '.tmp', 'w') as f:
+	    f.write(str(temp_s)+','+ str(temp_c) + ',' + str(humidity))
+	os.rename(sens_file + '.tmp', sens_file)
 
     return temp_s, temp_c, humidity
 
 #
-#   POST to GAE
+#   POST to GAE (through the spool of the uploader thread)
 #
-def postToGAE(temp_s, temp_c, humidity, sensCount):
+@metrics.timed('postToGAE')
+def postToGAE(temp_s, temp_c, humidity, sensCount, agg = None):
 
-    logger = logging.getLogger(__name__)
+    data = {
+	"timestamp"   : clock.now().isoformat(),
+	"T-SHT-31"    : temp_s ,
+	"H-SHT-31"    : humidity ,
+	"C-HC501"     : sensCount ,
+	"T-cpu_emily" : temp_c }
 
-    postUrl = "https://jebaxxmonitor.appspot.com/postData"
-    params = { 
-	"sensData[%s]" % "timestamp" : datetime.now().isoformat(),
-	"sensData[%s]" % "T-SHT-31"  : temp_s ,
-	"sensData[%s]" % "H-SHT-31"  : humidity ,
-	"sensData[%s]" % "C-HC501"   : sensCount ,
-	"sensData[%s]" % "T-cpu_emily" : temp_c }
+    # high rate sampling: <key>-min, -max, -sd, -n of the minute (the mean is <key>)
+    for key, a in (agg or {}).items():
+	if a is None: continue
+	data[key + '-min'], data[key + '-max'], mean, data[key + '-sd'], data[key + '-n'] = a
 
-    try:
-	response = requests.post(postUrl, data = params)
-    except EnvironmentError:
-	logger.warning("connection error 1")
-	time.sleep(5)
-	try:
-	    response = requests.post(postUrl, data = params)
-	except EnvironmentError:
-	    logger.warning("connection error 2")
-	    pass
-
-    logger.debug("response.code = %d" % response.status_code)
+    uploader.put(data)
 
 ######===============================================================#
 #
@@ -448,45 +511,87 @@ def postToGAE(temp_s, temp_c, humidity, sensCount):
 #
 ######===============================================================#
 
-logging.basicConfig(format='%(asctime)s %(funcName)s %(message)s', filename='/tmp/p2.log',level=logging.INFO)
-logger = logging.getLogger(__name__)
-logger.addHandler(logging.StreamHandler())
-
 #
-__i2c = smbus.SMBus(1)
-ld.init(__i2c)
-
-hsd.init()
-m_a.init()
-c3_m.init(__i2c)
+#   scheduled jobs
 #
-sens_and_record()
-logger.info("*** monitorBase_service *** has started")
+def presence_check():
+    # hsd state change, UI module message or its timeout
+    m_a.polling()
 
-m_time = time.time() // 60
-s_time = m_time
+sample = None
 
-try:
-    while 1:
-	time.sleep(0.25)
-	hsd.polling()
-	m_a.polling()
-	c3_m.polling()
+def measure_job():
+    global sample, aggregate
+    logger.debug("main: start measuring [{}]".format(clock.time()))
+    if sens_ring is None:
+	measure_T_H()
+	return
+
+    aggregate = sens_ring.window()
+    if aggregate['T-SHT-31'] is not None:
+	sample = record(aggregate['T-SHT-31'][2], aggregate['T-cpu_emily'][2], aggregate['H-SHT-31'][2])
+    else:
+	logger.warning("no sample in the last minute")
 
-	# start Mesurement before 2 seconds of every minut
-	if (m_time != (time.time() + 2) // 60):
-	    m_time = (time.time() + 2) // 60
-            logger.debug("main: start measuring [{}]".format(time.time()))
-	    (temp_s, temp_c, humidity) = sens_and_record()
+def post_job():
+    logger.debug("main: start posting [{}]".format(clock.time()))
+    if sample is None: return
+    (temp_s, temp_c, humidity) = sample
+    postToGAE(temp_s, temp_c, humidity, hsd.get_detect_count(), aggregate)
 
-	# Send mesured data to the server every minut
-	if s_time != (time.time() // 60):
-	    s_time = m_time
-            logger.debug("main: start posting [{}]".format(time.time()))
-	    postToGAE(temp_s, temp_c, humidity, hsd.get_detect_count())
+logger = logging.getLogger(__name__)
+
+def init():
+    global __i2c, sensor
+
+    sched.init()
+    metrics.start('base')				# /tmp/monitor_base.prom
+    bus = smbus.SMBus(1)				# shared with monitorUI through i2c_bus
+    __i2c = i2c_bus(bus, 'sht')
+    sensor = sht31(__i2c)
+    ld.init(i2c_bus(bus, 'ld'))
+
+    hsd.init()
+    hsd.subscribe(m_a.on_presence)
+    m_a.init()
+    c3_m.init(i2c_bus(bus, 'led', i2c_bus.LOW))
+    sens_shm.open_writer()
+    history.open()
+    uploader.init()
+    #
+    measure_T_H(first_sample)				# first sample (in sched.run), then periodic mode
+    logger.info("*** monitorBase_service *** has started")
+
+    sched.every_minute(-2, measure_job)	# start Mesurement before 2 seconds of every minut
+    sched.every_minute(0, post_job)		# Send mesured data to the server every minut
+    sched.every(3600, i2c_bus.log_stats)	# I2C bus wait time histograms
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(funcName)s %(message)s', filename='/tmp/p2.log',level=logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    trace.open(os.environ.get('MONITOR_TRACE'))		# record events for monitorSim
+    global sht_rate
+    rate = os.environ.get('MONITOR_SHT_RATE')		# high rate sampling (Hz)
+    if rate is not None:
+	try:
+	    sht_rate = float(rate)
+	except ValueError:
+	    sht_rate = None
+	if sht_rate != 0 and sht_rate not in sht31.PERIODIC:
+	    logger.error("MONITOR_SHT_RATE {}: not one of {}, one shot per minute".format(
+		rate, sorted(sht31.PERIODIC.keys())))
+	    sht_rate = 0
+
+    init()
+    try:
+	sched.run()
 
-except KeyboardInterrupt:
+    except KeyboardInterrupt:
 
-    ld.display_sw(0)
-    GPIO.cleanup()
+	ld.display_sw(0)
+	history.flush()
+	metrics.export()
+	GPIO.cleanup()
 
+if __name__ == '__main__':
+    main()
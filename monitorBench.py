@@ -0,0 +1,942 @@
+#!/usr/bin/python
+#
+#  micro benchmarks for monitorBase / monitorUI
+#
+#	runs on any linux box: the I2C bus is replaced by fake_bus
+#	which only counts transactions and bytes.
+#
+#	usage:  python monitorBench.py [name ...]
+#
+import os
+import sys
+import time
+import math
+import shutil
+import tempfile
+import threading
+import logging
+import SocketServer
+import BaseHTTPServer
+import urlparse
+from collections import OrderedDict
+from monitorLib import apa102, led_anim, uploader, sens_batch
+
+######################################################################
+#  fake SMBus (counts transactions and bytes)
+#====================================================================#
+
+class fake_bus:
+
+    def __init__(self):
+	self.reset()
+
+    def reset(self):
+	self.transactions = 0
+	self.bytes = 0
+
+    def _count(self, n):
+	self.transactions += 1
+	self.bytes += n + 1		# + address byte
+
+    def write_byte_data(self, addr, cmd, val):
+	self._count(2)
+
+    def read_byte_data(self, addr, cmd):
+	self._count(2)
+	return 0xff
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+	self._count(1 + len(vals))
+
+    def read_i2c_block_data(self, addr, cmd, n):
+	self._count(1 + n)
+	return [0] * n
+
+def report(name, bus, frames, elapsed, fps):
+    print "%-28s %6.2f trans/frame %7.1f bytes/frame  | @%gfps: %6.1f trans/s %8.1f bytes/s | %7.1f us/frame" % (
+	name, bus.transactions / float(frames), bus.bytes / float(frames),
+	fps, bus.transactions * fps / float(frames), bus.bytes * fps / float(frames),
+	elapsed * 1000000.0 / frames)
+
+######################################################################
+#  [led] APA102 frame writer of c3_m
+#====================================================================#
+
+def _legacy_set_pixel(bus, r, g, b):
+    # the former implementation: one block write per byte, per-bit loop
+    def write_byte(byte):
+	cmd = []
+	for x in range(8):
+	    if (byte & 0b10000000) : _cmd = (1 << 7)
+	    else:			 _cmd = 0
+	    cmd.append(_cmd)
+	    _cmd |= (1 << 6)
+	    cmd.append(_cmd)
+	    byte <<= 1
+	bus.write_i2c_block_data(0x3f, 0x01, cmd)
+
+    for byte in (0, 0, 0b11101111, b, g, r, 0, 0):
+	write_byte(byte)
+
+def bench_led(frames = 2000):
+    # slowly changing color like the breathing animation (some frames repeat)
+    colors = [(i // 3 & 0xff, i // 5 & 0xff, i // 7 & 0xff) for i in range(frames)]
+
+    bus = fake_bus()
+    t = time.time()
+    for r, g, b in colors:
+	_legacy_set_pixel(bus, r, g, b)
+    report("led: per byte (before)", bus, frames, time.time() - t, 4)
+
+    bus = fake_bus()
+    last = None
+    t = time.time()
+    for rgb in colors:
+	if rgb == last: continue
+	last = rgb
+	for block in apa102.encode(*rgb):
+	    bus.write_i2c_block_data(0x3f, 0x01, block)
+    report("led: frame encoder (after)", bus, frames, time.time() - t, 4)
+
+######################################################################
+#  [anim] per tick cost of the c3_m animation
+#====================================================================#
+
+class _legacy_anim:
+    # the former c3_m.polling: math.sin per tick + brightness + gamma
+    t1 = 0
+    t2r = 0
+    t2g = 0
+    t2b = 0
+    dt = 1/4.0
+
+    @staticmethod
+    def polling():
+	a = _legacy_anim
+	a.t1 += a.dt
+	mtr = abs((a.t1 % 80) - 40) + 10.0
+	mtg = abs((a.t1 % 82) - 41) + 10.1
+	mtb = abs((a.t1 % 84) - 42) + 9.9
+
+	a.t2r += a.dt / mtr
+	a.t2g += a.dt / mtg
+	a.t2b += a.dt / mtb
+
+	Lr = math.sin(a.t2r * math.pi) * 180 + 60
+	if Lr < 0 : Lr = 0
+	Lg = math.sin(a.t2g * math.pi) * 180 + 60
+	if Lg < 0 : Lg = 0
+	Lb = math.sin(a.t2b * math.pi) * 180 + 60
+	if Lb < 0 : Lb = 0
+	return [apa102.GAMMA[int(x * 0.8) & 0xff] for x in (Lr, Lg, Lb)]
+
+def bench_anim(ticks = 100000):
+    t = time.time()
+    for i in xrange(ticks):
+	_legacy_anim.polling()
+    e = time.time() - t
+    print "%-28s %7.2f us/tick" % ("anim: math.sin (before)", e * 1000000.0 / ticks)
+
+    t = time.time()
+    led_anim.init(apa102.GAMMA, 0.8, 1/4.0)
+    for name in led_anim.patterns():
+	led_anim.load(name)
+    e = time.time() - t
+    print "%-28s %7.2f ms (all patterns, %d bytes)" % ("anim: table build", e * 1000.0,
+	sum([len(x) for n in led_anim.patterns() for x in led_anim._cache[n]]))
+
+    led_anim.load('breath')
+    t = time.time()
+    for i in xrange(ticks):
+	led_anim.next_frame()
+    e = time.time() - t
+    print "%-28s %7.2f us/tick" % ("anim: table (after)", e * 1000000.0 / ticks)
+
+######################################################################
+#  fake SO1602 (fake_bus that also keeps the DDRAM and display shift)
+#
+#	decodes the control bytes of every transfer, so a check can
+#	compare what the panel would show with what ld meant to show.
+#====================================================================#
+
+class so1602_bus(fake_bus):
+
+    COLS  = 16
+    DDRAM = 40
+
+    def __init__(self):
+	fake_bus.__init__(self)
+	self.ram = [[' '] * self.DDRAM for l in range(2)]
+	self.addr = (0, 0)
+	self.shift = 0			# columns the display is shifted left
+	self.cgram = False		# data goes to CGRAM
+	self.re = self.sd = False
+	self.value = False		# next command byte is an argument (contrast)
+
+    def visible(self, l):
+	return ''.join([self.ram[l][(c + self.shift) % self.DDRAM] for c in range(self.COLS)])
+
+    def _command(self, c):
+	if self.value:
+	    self.value = False
+	elif self.sd:
+	    if c == 0x78:   self.sd = False
+	    elif c == 0x81: self.value = True
+	elif c & 0xe0 == 0x20:
+	    self.re = bool(c & 0x02)
+	elif self.re:
+	    if c == 0x79: self.sd = True
+	elif c == 0x01:
+	    self.ram = [[' '] * self.DDRAM for l in range(2)]
+	    self.addr, self.shift, self.cgram = (0, 0), 0, False
+	elif c & 0xfe == 0x02:
+	    self.addr, self.shift, self.cgram = (0, 0), 0, False
+	elif c & 0x80:
+	    self.addr, self.cgram = ((c >> 6) & 1, c & 0x3f), False
+	elif c & 0xc0 == 0x40:
+	    self.cgram = True
+	elif c & 0xf8 == 0x18:
+	    self.shift += -1 if c & 0x04 else 1
+
+    def _data(self, d):
+	if self.cgram: return
+	l, c = self.addr
+	self.ram[l][c] = chr(d)
+	self.addr = (l, c + 1) if c + 1 < self.DDRAM else (1 - l, 0)
+
+    def _stream(self, b):
+	# [control, byte, control, byte, ...], Co = 0 in a control: the rest is of its kind
+	i = 0
+	while i < len(b):
+	    ctrl, rest = b[i], b[i + 1:] if not b[i] & 0x80 else b[i + 1:i + 2]
+	    for x in rest:
+		if ctrl & 0x40: self._data(x)
+		else:		self._command(x)
+	    i += 1 + len(rest)
+
+    def write_byte_data(self, addr, cmd, val):
+	fake_bus.write_byte_data(self, addr, cmd, val)
+	self._stream([cmd, val])
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+	fake_bus.write_i2c_block_data(self, addr, cmd, vals)
+	self._stream([cmd] + list(vals))
+
+######################################################################
+#  [display] SO1602 bytes per refresh: direct writes vs framebuffer
+#====================================================================#
+
+class _legacy_ld:
+    # the former ld of monitorUI: every call goes to the panel
+    bus = None
+
+    @staticmethod
+    def so_cmd(c):
+	_legacy_ld.bus.write_byte_data(0x3c, 0, c)
+
+    @staticmethod
+    def clear_display():
+	_legacy_ld.so_cmd(0x01)
+
+    @staticmethod
+    def cursor_sw(sw):
+	_legacy_ld.so_cmd(0x0c | (3 if sw else 0))
+
+    @staticmethod
+    def set_double_height(sw):
+	_legacy_ld.so_cmd(0x28 | (4 if sw else 0))
+
+    @staticmethod
+    def set_location(l, c):
+	_legacy_ld.so_cmd(0x80 + 0x40 * l + c)
+
+    @staticmethod
+    def write_char(str, l = None, c = None):
+	if c is not None: _legacy_ld.set_location(l, c)
+	_legacy_ld.bus.write_i2c_block_data(0x3c, 0x40, map(ord, str))
+
+    @staticmethod
+    def flush():
+	pass
+
+def _screens():
+    # refreshes as the screen modules of monitorUI issue them
+    from datetime import datetime, timedelta
+    t0 = datetime(2026, 1, 1, 6, 0)
+    def clock_minute(ld, i):
+	ld.write_char((t0 + timedelta(minutes = i)).strftime('%m/%d %a %H:%M'), 0, 0)
+    def sensor_minute(ld, i):
+	ld.write_char((t0 + timedelta(minutes = i)).strftime('%m/%d %H:%M'), 0, 0)
+	ld.write_char('{temp:05.2f}C   {hum:04.1f}%'.format(temp = 21.5 + (i % 7) / 100.0, hum = 45.0 + (i % 3) / 10.0), 1, 0)
+    def snooze_second(ld, i):
+	ld.write_char(str(300 - i % 300) + " ", 1, 0)
+    def config_key(ld, i):
+	ld.clear_display()
+	ld.write_char('clock_style', 0, 0)
+	ld.write_char(str(i % 11), 1, 0)
+	ld.set_location(1, 0)
+	ld.cursor_sw(1)
+    def screen_change(ld, i):
+	ld.clear_display()
+	ld.cursor_sw(0)
+	if i % 2:
+	    ld.set_double_height(1)
+	    clock_minute(ld, i)
+	else:
+	    ld.set_double_height(0)
+	    sensor_minute(ld, i)
+    return [('clock / minute', clock_minute), ('sensor / minute', sensor_minute),
+	    ('snooze / second', snooze_second), ('config / key', config_key),
+	    ('screen change', screen_change)]
+
+def bench_display(refreshes = 300):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim'))
+    from monitorUI import ld
+
+    for name, draw in _screens():
+	for label, drv in (('before', _legacy_ld), ('after', ld)):
+	    bus = fake_bus()
+	    if drv is ld: ld.init(bus)
+	    else:	  _legacy_ld.bus = bus
+	    draw(drv, 0)
+	    drv.flush()
+	    bus.reset()
+	    for i in range(1, refreshes + 1):
+		draw(drv, i)
+		drv.flush()
+	    print "%-36s %6.2f trans/refresh %6.1f bytes/refresh" % (
+		"display: %s (%s)" % (name, label), bus.transactions / float(refreshes),
+		bus.bytes / float(refreshes))
+
+######################################################################
+#  [so1602] command batching: one transfer per command vs batches
+#====================================================================#
+
+def bench_so1602(repeat = 100):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim'))
+    from monitorUI import ld
+    from monitorLib import so1602, clock
+
+    def transit(bus):
+	for i in range(8):
+	    ld.batch_begin()
+	    ld.shift_Left()
+	    ld.shift_Left()
+	    ld.batch_end()
+	ld.flush()
+    def config_redraw(bus):
+	ld.clear_display()
+	ld.set_double_height(1 - ld._dh // 4)
+	ld.write_char('clock_style', 0, 0)
+	ld.write_char('3', 1, 0)
+	ld.set_location(1, 0)
+	ld.cursor_sw(1 - ld._cur)
+	ld.flush()
+    seqs = [('init', ld.init), ('set_contrast', lambda bus: ld.set_contrast(0x38)),
+	    ('transit shifts', transit), ('mode change redraw', config_redraw)]
+
+    slept = [0.0]
+    sleep = vars(clock)['sleep']		# the staticmethod itself
+    clock.sleep = staticmethod(lambda sec: slept.__setitem__(0, slept[0] + sec))
+    inline_max = so1602.INLINE_MAX
+    try:
+	for name, seq in seqs:
+	    for label, inline in (('before', -1), ('after', inline_max)):
+		so1602.INLINE_MAX = inline		# -1: every command closes its transfer
+		bus = fake_bus()
+		ld.init(bus)
+		bus.reset()
+		slept[0] = 0.0
+		for i in range(repeat):
+		    seq(bus)
+		print "%-36s %6.2f trans %6.1f bytes %8.1f us delay" % (
+		    "so1602: %s (%s)" % (name, label), bus.transactions / float(repeat),
+		    bus.bytes / float(repeat), slept[0] * 1000000.0 / repeat)
+    finally:
+	so1602.INLINE_MAX = inline_max
+	clock.sleep = sleep
+
+######################################################################
+#  [transit] panel DDRAM through transitions between every two states
+#====================================================================#
+
+def bench_transit():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim'))
+    from monitorUI import ld, tr_m, d_m
+
+    def redraw(state):
+	# the screen drawn by transit_done (visible columns only)
+	ld.clear_display()
+	ld.set_double_height(0)
+	ld.write_char(state.upper() + ' screen', 0, 0)
+	ld.write_char('0123456789abcdef', 1, 0)
+	ld.flush()
+
+    for style in tr_m.STYLES[:-1]:
+	bus = so1602_bus()
+	ld.init(bus)
+	bus.reset()
+	checks = bad = n = 0
+	for prev in d_m._states:
+	    for state in d_m._states:
+		if state == prev: continue
+		redraw(prev)
+		for ops, sec in tr_m._build(style, state):
+		    for func, args in ops: func(*args)
+		checks += 1
+		if bus.visible(0) != state.ljust(ld.COLS):
+		    bad += 1
+		    print "transit: %s %s -> %s shows %r" % (style, prev, state, bus.visible(0))
+		redraw(state)
+		checks += 1
+		if [bus.visible(0), bus.visible(1)] != [str(ld._fb[l][:ld.COLS]) for l in range(2)]:
+		    bad += 1
+		    print "transit: %s %s -> %s screen %r" % (style, prev, state, [bus.visible(0), bus.visible(1)])
+		n += 1
+	print "%-36s %6.2f trans %6.1f bytes  %d checks, %d mismatches" % (
+	    "transit: %s" % style, bus.transactions / float(n), bus.bytes / float(n), checks, bad)
+
+######################################################################
+#  [arbiter] button wait behind LED frames of another process
+#====================================================================#
+
+class slow_bus(fake_bus):
+    # takes the time of the transfer at 100kHz (9 clocks per byte)
+
+    def _count(self, n):
+	fake_bus._count(self, n)
+	time.sleep((n + 1) * 90e-6)
+
+def bench_arbiter(sec = 3.0):
+    from monitorLib import i2c_bus
+    tmp = tempfile.mkdtemp()
+    i2c_bus.LOCK_PATH = os.path.join(tmp, 'i2c.lock')
+    i2c_bus.PRIO_PATH = os.path.join(tmp, 'i2c.prio')
+    blocks = apa102.encode(10, 20, 30)
+    try:
+	for label, prio in (('LED as HIGH', i2c_bus.HIGH), ('LED as LOW', i2c_bus.LOW)):
+	    for fd in (i2c_bus._fd, i2c_bus._pfd):
+		if fd is not None: os.close(fd)
+	    i2c_bus._fd = i2c_bus._pfd = None		# own lock files per process
+	    t_end = time.time() + sec
+
+	    pid = os.fork()
+	    if pid == 0:
+		# monitorBase: LED frames back to back
+		led = i2c_bus(slow_bus(), 'led', prio)
+		while time.time() < t_end:
+		    with led:
+			for block in blocks:
+			    led.yield_bus()
+			    led.write_i2c_block_data(0x3f, 0x01, block)
+		os._exit(0)
+
+	    # monitorUI: button reads
+	    time.sleep(0.1)
+	    btn = i2c_bus(slow_bus(), 'button')
+	    while time.time() < t_end:
+		btn.read_byte_data(0x3f, 0x00)
+		time.sleep(0.005)
+	    os.waitpid(pid, 0)
+	    i2c_bus.clients.remove(btn)
+
+	    labels = ['<%gms' % (b * 1000) for b in i2c_bus.BUCKETS] + ['more']
+	    print "%-28s button wait avg %6.3f ms  max %6.3f ms  %s" % ("arbiter: " + label,
+		btn.wait * 1000 / btn.count, btn.wait_max * 1000,
+		' '.join(['%s:%d' % (l, n) for l, n in zip(labels, btn.hist.counts) if n]))
+    finally:
+	shutil.rmtree(tmp)
+
+######################################################################
+#  [presence] PIR edge -> display on latency of hsd
+#====================================================================#
+
+class _legacy_hsd:
+    # the former hsd: the callback stamps the edge, polling() every 250ms decides
+    _is_someone = 0
+    _t_detect = None
+    _t_confirming = None
+
+    @staticmethod
+    def hsd_callback(portNo):
+	_legacy_hsd._t_detect = time.time()
+
+    @staticmethod
+    def polling():
+	h = _legacy_hsd
+	if h._t_detect == None: return
+	if h._is_someone:
+	    if time.time() - h._t_detect > 10:
+		h._is_someone = 0
+		h._t_detect = None
+	elif (h._t_confirming == None) or (h._t_detect - h._t_confirming > 3.0):
+	    h._t_confirming = h._t_detect
+	    h._t_detect = None
+	else:
+	    h._t_confirming = None
+	    h._is_someone = 1
+
+def bench_presence(trials = 20):
+    import random
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim'))
+    import monitorBase as base
+    from monitorLib import sched, clock
+    rnd = random.Random(1)
+
+    def run(label, reset, fire, on_time, gap):
+	lat = []
+	for i in range(trials):
+	    reset()
+	    time.sleep(rnd.uniform(0, 0.25))
+	    fire()
+	    time.sleep(gap)
+	    t = time.time()
+	    fire()
+	    _wait_for(lambda: on_time[0] is not None, 1.0)
+	    if on_time[0] is not None: lat.append(on_time[0] - t)
+	lat.sort()
+	print "%-40s detected %2d/%d  latency avg %7.2f ms  max %7.2f ms" % ("presence: %s" % label, len(lat), trials,
+	    sum(lat) * 1000 / max(1, len(lat)), (lat[-1] if lat else 0) * 1000)
+
+    # before: 250ms polling thread
+    on_time = [None]
+    def legacy_loop():
+	while True:
+	    _legacy_hsd.polling()
+	    if _legacy_hsd._is_someone and on_time[0] is None: on_time[0] = time.time()
+	    time.sleep(0.25)
+    def legacy_reset():
+	_legacy_hsd._is_someone = 0
+	_legacy_hsd._t_detect = _legacy_hsd._t_confirming = None
+	on_time[0] = None
+    th = threading.Thread(target = legacy_loop)
+    th.setDaemon(True)
+    th.start()
+    for gap in (0.5, 0.05):
+	run("polling (before), gap %gs" % gap, legacy_reset, lambda: _legacy_hsd.hsd_callback(10), on_time, gap)
+
+    # after: edge driven state machine, m_a subscribed, sched in its own thread
+    on_time = [None]
+    base.ld.display_sw = staticmethod(lambda sw: on_time.__setitem__(0, time.time()) if sw else None)
+    sched.init()
+    base.hsd.init()
+    base.hsd.subscribe(base.m_a.on_presence)
+    base.hsd.set_mode(1)
+    base.m_a._hsd_mode = 1
+    def reset():
+	with base.hsd._lock:
+	    base.hsd._is_someone = 0
+	    base.hsd._edges = base.array('d', [0.0] * base.hsd.RING)
+	base.m_a._led_current = 0
+	base.m_a._t_received = clock.time()
+	on_time[0] = None
+    th = threading.Thread(target = sched.run)
+    th.setDaemon(True)
+    th.start()
+    for gap in (0.5, 0.05):
+	run("event driven (after), gap %gs" % gap, reset, lambda: base.hsd.hsd_callback(10), on_time, gap)
+    sched.stop()
+    th.join(1)
+
+######################################################################
+#  [alarm] al_a reschedule latency with many alarms
+#====================================================================#
+
+class _legacy_alarm:
+    # setAlarm() before alarm_queue: dict + OrderedDict sorted on every change
+    _queue = {}
+    _ordered_queue = None
+    _recent_alarm = None
+
+    @staticmethod
+    def setAlarm(alarm_name, alarm_info):
+	from monitorUI import al_a
+	if alarm_info['sw ']['value'] == 'ON':
+	    _legacy_alarm._queue[alarm_name] = al_a.calc_next_alarm(alarm_info)
+	else:
+	    _legacy_alarm._queue.pop(alarm_name, None)
+	_legacy_alarm._ordered_queue = OrderedDict(sorted(_legacy_alarm._queue.items(), key=lambda x:x[1]))
+	_legacy_alarm._recent_alarm = next(iter(_legacy_alarm._ordered_queue), None)
+
+def bench_alarm(changes = 2000):
+    import random
+    import copy
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim'))
+    from monitorUI import al_a, c_m
+    from monitorLib import sched
+    sched.init()
+    rnd = random.Random(1)
+
+    for n in (3, 100, 300, 1000):
+	base = OrderedDict()
+	for i in range(n):
+	    a = copy.deepcopy(c_m._b['alarm']['alarm2'])
+	    a['sw ']['value'] = 'ON'
+	    a['wek']['value'] = rnd.choice(a['wek']['candidate'])
+	    a['h ']['value']  = rnd.randint(0, 23)
+	    a['m ']['value']  = rnd.randint(0, 59)
+	    base['alarm%d' % (i + 1)] = a
+	edits = [('alarm%d' % rnd.randint(1, n), rnd.randint(0, 23), rnd.choice(('ON', 'ON', 'ON', 'OFF')))
+		 for i in range(changes)]
+
+	for label in ('before', 'after'):
+	    alarms = copy.deepcopy(base)
+	    c_m._c = { 'alarm' : alarms }
+	    if label == 'before':
+		_legacy_alarm._queue = {}
+		for name in alarms: _legacy_alarm.setAlarm(name, alarms[name])
+		set_alarm = lambda name: _legacy_alarm.setAlarm(name, alarms[name])
+	    else:
+		al_a.setAlarm(None)
+		set_alarm = al_a.setAlarm
+
+	    lat = []
+	    for name, h, sw in edits:
+		alarms[name]['h ']['value']  = h
+		alarms[name]['sw ']['value'] = sw
+		t = time.time()
+		set_alarm(name)
+		lat.append(time.time() - t)
+	    lat.sort()
+	    print "%-28s %5d alarms  reschedule avg %7.1f us  p99 %7.1f us" % ("alarm: " + label, n,
+		sum(lat) * 1000000 / len(lat), lat[len(lat) * 99 // 100] * 1000000)
+
+    # disarm: the benches after this one run sched
+    c_m._c = { 'alarm' : {} }
+    al_a.setAlarm(None)
+
+######################################################################
+#  [render] clock / sensor text per minute refresh: format vs cache
+#====================================================================#
+
+def bench_render(minutes = 1440):
+    from datetime import datetime
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim'))
+    from monitorUI import ld, d_m, c_m
+    from monitorLib import clock
+    t0 = 1767225600					# 2026-01-01 00:00
+    # a new reading every 10 minutes, as monitorBase measures
+    samples = [(21.5 + (i // 10 % 7) / 100.0, 45.0 + (i // 10 % 3) / 10.0) for i in range(minutes)]
+
+    def before(i, clock_form):
+	ts = t0 + i * 60
+	temp, hum = samples[i]
+	if clock_form != 0:
+	    ld.write_char(datetime.fromtimestamp(ts).strftime(d_m._clock_form[clock_form - 1]), 0, 0)
+	    ld.write_char(d_m._sens_form[0].format(temp = temp, hum = hum), 1, 0)
+	else:
+	    ld.write_char(d_m._sens_form[0].format(temp = temp, hum = hum), 0, 0)
+	ld.flush()
+    def after(i, clock_form):
+	clock.set_virtual(t0 + i * 60)
+	d_m._sample = (t0 + i * 60, samples[i][0], 0.0, samples[i][1])
+	if d_m.refresh_display(): ld.flush()
+
+    c_m._c = c_m._copy(c_m._b)
+    d_m._state = 'sensor'
+    try:
+	for clock_form in (8, 0):
+	    c_m._c['sens_style']['clock']['value'] = clock_form
+	    for label, refresh in (('before', before), ('after', after)):
+		bus = fake_bus()
+		ld.init(bus)
+		ld.clear_display()
+		bus.reset()
+		t = time.time()
+		for i in range(minutes): refresh(i, clock_form)
+		t = time.time() - t
+		print "%-36s %7.1f us/refresh %6.2f trans/refresh" % ("render: %s (%s)" % (
+		    'sensor + clock' if clock_form else 'sensor only', label),
+		    t * 1000000 / minutes, bus.transactions / float(minutes))
+    finally:
+	clock._virtual = None
+	d_m._sample = None
+
+######################################################################
+#  [audio] alarm trigger -> first sample latency
+#====================================================================#
+
+def bench_audio(trials = 30):
+    import subprocess
+    from monitorLib import audio_player, null_sink
+
+    def report(label, lat):
+	lat.sort()
+	print "%-40s avg %7.2f ms  max %7.2f ms" % ("audio: " + label, sum(lat) * 1000 / len(lat), lat[-1] * 1000)
+
+    # before: a player process per alarm (process start only: mpg321 decodes on top of it)
+    lat = []
+    for i in range(trials):
+	t = time.time()
+	proc = subprocess.Popen([sys.executable, '-c', 'import sys; sys.stdout.write("x")'], stdout = subprocess.PIPE)
+	proc.stdout.read(1)
+	lat.append(time.time() - t)
+	proc.wait()
+    report("process per alarm (before)", lat)
+
+    # after: decoded PCM, warm worker thread and sink
+    frame = audio_player.CHANNELS * audio_player.WIDTH
+    sink = null_sink(audio_player.RATE, frame)
+    audio_player.init(sink)
+    audio_player.add('alarm', '\x00\x10' * (audio_player.RATE * audio_player.CHANNELS))
+    lat = []
+    for i in range(trials):
+	sink.reset()
+	t = time.time()
+	audio_player.play('alarm', fade_in = 1.0)
+	_wait_for(lambda: sink.first_write is not None, 1.0)
+	lat.append(sink.first_write - t)
+	time.sleep(0.05)
+	audio_player.stop()
+	time.sleep(0.1)
+    report("warm player, null sink (after)", lat)
+
+    # checks of the player on the sink: fade in, stop, end of a sound
+    import audioop
+    class capture_sink(null_sink):
+	def reset(self):
+	    null_sink.reset(self)
+	    self.chunks = []
+	def write(self, data):
+	    null_sink.write(self, data)
+	    self.chunks.append(data)
+    def check(label, ok, detail):
+	print "%-40s %s (%s)" % ("audio: " + label, "ok" if ok else "NG", detail)
+
+    full = 0x1000
+    audio_player._sink = sink = capture_sink(audio_player.RATE, frame)
+    audio_player.add('beep', '\x00\x10' * (audio_player.RATE // 10 * audio_player.CHANNELS))	# 0.1 sec
+
+    audio_player.play('alarm', fade_in = 0.5)
+    _wait_for(lambda: len(sink.chunks) >= 30, 2.0)
+    peaks = [audioop.max(x, audio_player.WIDTH) for x in sink.chunks[:30]]
+    check("fade in", peaks[0] < full // 10 and peaks == sorted(peaks) and peaks[-1] == full,
+	  "peaks %d .. %d of %d" % (peaks[0], peaks[-1], full))
+
+    audio_player.stop()
+    time.sleep(0.2)
+    n = len(sink.chunks)
+    tail = [audioop.max(x, audio_player.WIDTH) for x in sink.chunks[-4:]]
+    time.sleep(0.2)
+    check("stop", len(sink.chunks) == n and not audio_player.is_playing() and tail == sorted(tail, reverse = True) and tail[-1] < full // 2,
+	  "fade out peaks %s, %d writes after it" % (tail, len(sink.chunks) - n))
+
+    audio_player.play('beep', loop = False)
+    time.sleep(0.02)
+    playing = audio_player.is_playing()
+    time.sleep(0.3)
+    check("end of a sound (loop = False)", playing and not audio_player.is_playing(),
+	  "is_playing %s -> %s" % (playing, audio_player.is_playing()))
+
+######################################################################
+#  local HTTP stand-in for the GAE server
+#
+#	keep-alive capable. While 'down' it answers 503.
+#	/postData takes the legacy form, /postBatch a sens_batch payload
+#	(404 unless 'batch' is set, like the current GAE server).
+#	records the requests, bytes and client connections it has seen.
+#====================================================================#
+
+class stand_in_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def do_POST(self):
+	    srv = self.server
+	    body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+	    with srv.lock:
+		srv.requests += 1
+		srv.bytes += len(self.requestline) + len(str(self.headers)) + len(body)
+		srv.connections.add(self.client_address)
+		if srv.down: code = 503
+		elif self.path == '/postBatch':
+		    samples = srv.batch and sens_batch.decode(body)
+		    if not srv.batch: code = 404
+		    elif len(samples) > srv.batch_limit: code = 413
+		    elif [x for x in samples if srv.reject in x]: code = 400
+		    else:
+			code = 200
+			srv.received.extend(samples)
+		elif 'sensData[%s]' % srv.reject in urlparse.parse_qs(body): code = 400
+		else:
+		    code = 200
+		    srv.received.append(body)
+
+	    self.send_response(code)
+	    self.send_header('Content-Length', '0')
+	    self.end_headers()
+
+	def log_message(self, *args):
+	    pass
+
+    def handle_error(self, request, client_address):
+	pass		# connections cut by shutdown()
+
+    def __init__(self):
+	BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), stand_in_server.handler)
+	self.lock = threading.Lock()
+	self.down = False
+	self.batch = True
+	self.batch_limit = 60 * 24	# samples per batch (more: 413)
+	self.reject = None		# 400 for a sample with this key
+	self.requests = 0
+	self.bytes = 0
+	self.connections = set()
+	self.received = []
+	th = threading.Thread(target = self.serve_forever)
+	th.setDaemon(True)
+	th.start()
+
+    def url(self, path = '/postData'):
+	return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+def _wait_for(cond, timeout = 30):
+    t = time.time()
+    while not cond() and time.time() - t < timeout:
+	time.sleep(0.01)
+    return cond()
+
+######################################################################
+#  [upload] store-and-forward uploader against the stand-in server
+#====================================================================#
+
+def _sample(i):
+    # a minute sample like postToGAE makes (isoformat with microseconds)
+    from datetime import datetime, timedelta
+    ts = datetime(2026, 1, 1) + timedelta(minutes = i, microseconds = (i * 7919) % 1000000)
+    return { "timestamp" : ts.isoformat(), "T-SHT-31" : 21.5 + 2 * math.sin(i / 90.0) + (i * 37 % 11) / 100.0,
+	     "H-SHT-31" : 45.0 + 5 * math.cos(i / 70.0) + (i * 13 % 7) / 10.0, "C-HC501" : i * 31 % 7,
+	     "T-cpu_emily" : 48.0 + (i * 17 % 13) * 0.538 }
+
+def bench_upload(samples = 300):
+    srv = stand_in_server()
+    spool = tempfile.mkdtemp()
+    try:
+	uploader.BACKOFF_MIN = 0.05
+	uploader.init(url = srv.url(), spool_dir = spool, url_batch = srv.url('/postBatch'))
+
+	# outage: put() must not block, samples stay in the spool
+	srv.down = True
+	t = time.time()
+	for i in range(samples):
+	    uploader.put(_sample(i))
+	e = time.time() - t
+	print "%-28s %7.1f us/put (%d spooled)" % ("upload: put during outage", e * 1000000.0 / samples, len(uploader.spooled()))
+	time.sleep(0.3)
+
+	# the endpoint comes back: the backlog is drained
+	srv.down = False
+	srv.requests = 0
+	srv.bytes = 0
+	srv.connections = set()
+	t = time.time()
+	ok = _wait_for(lambda: len(uploader.spooled()) == 0)
+	e = time.time() - t
+	print "%-28s %7.1f ms for %d samples, %d requests, %d connections, %.0f bytes/sample%s" % (
+	    "upload: drain backlog", e * 1000.0, len(srv.received), srv.requests, len(srv.connections),
+	    srv.bytes / float(max(1, len(srv.received))), "" if ok else " (TIMEOUT)")
+    finally:
+	srv.shutdown()
+	shutil.rmtree(spool)
+
+######################################################################
+#  [batch] bytes on wire / requests per sample: legacy form vs batch
+#====================================================================#
+
+def bench_batch(samples = 1440):
+    srv = stand_in_server()
+    spool = tempfile.mkdtemp()
+    try:
+	uploader.init(url = srv.url(), spool_dir = spool, url_batch = srv.url('/postBatch'))
+	for mode in ('legacy', 'batch'):
+	    srv.batch = (mode == 'batch')
+	    uploader._batch_ok = srv.batch
+	    uploader._t_probe = time.time()
+
+	    srv.down = True
+	    for i in range(samples):
+		uploader.put(_sample(i))
+	    srv.down = False
+	    srv.requests = 0
+	    srv.bytes = 0
+	    srv.received = []
+	    t = time.time()
+	    uploader._event.set()
+	    ok = _wait_for(lambda: len(uploader.spooled()) == 0, 120)
+	    e = time.time() - t
+	    print "%-28s %8.4f requests/sample %7.1f bytes/sample %8.1f ms total%s" % (
+		"batch: " + mode, srv.requests / float(samples), srv.bytes / float(samples),
+		e * 1000.0, "" if ok and len(srv.received) == samples else " (INCOMPLETE)")
+
+	# negotiated fallback: the server does not know /postBatch
+	srv.batch = False
+	uploader._batch_ok = True
+	srv.received = []
+	for i in range(10):
+	    uploader.put(_sample(i))
+	ok = _wait_for(lambda: len(uploader.spooled()) == 0)
+	print "%-28s %s (%d samples by legacy form)" % ("batch: fallback", "ok" if ok and not uploader._batch_ok else "NG", len(srv.received))
+
+	# 413: the batch size is halved until the server takes it
+	batch_max = uploader.BATCH_MAX
+	srv.batch = True
+	srv.batch_limit = 100
+	uploader._batch_ok = True
+	srv.received = []
+	srv.requests = 0
+	srv.down = True
+	for i in range(samples):
+	    uploader.put(_sample(i))
+	srv.down = False
+	uploader._event.set()
+	ok = _wait_for(lambda: len(uploader.spooled()) == 0)
+	print "%-28s %s (%d samples, %d requests, BATCH_MAX %d)" % ("batch: too large", "ok" if ok and uploader._batch_ok and len(srv.received) == samples else "NG",
+	    len(srv.received), srv.requests, uploader.BATCH_MAX)
+	uploader.BATCH_MAX = batch_max
+
+	# 400: only the rejected sample is lost
+	srv.received = []
+	srv.reject = 'bad'
+	srv.down = True
+	for i in range(50):
+	    x = _sample(i)
+	    if i == 20: x['bad'] = 1
+	    uploader.put(x)
+	srv.down = False
+	uploader._event.set()
+	ok = _wait_for(lambda: len(uploader.spooled()) == 0)
+	print "%-28s %s (%d of 50 samples by legacy form, batch mode %s)" % ("batch: rejected",
+	    "ok" if ok and len(srv.received) == 49 and uploader._batch_ok else "NG", len(srv.received), "kept" if uploader._batch_ok else "OFF")
+	srv.reject = None
+    finally:
+	srv.shutdown()
+	shutil.rmtree(spool)
+
+######################################################################
+#  MAIN
+#====================================================================#
+
+benches = {
+    'led'  : bench_led,
+    'anim' : bench_anim,
+    'display' : bench_display,
+    'so1602'  : bench_so1602,
+    'transit' : bench_transit,
+    'arbiter' : bench_arbiter,
+    'presence' : bench_presence,
+    'alarm'  : bench_alarm,
+    'audio'  : bench_audio,
+    'render' : bench_render,
+    'upload' : bench_upload,
+    'batch'  : bench_batch,
+}
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.ERROR)
+    names = sys.argv[1:] or sorted(benches.keys())
+    for name in names:
+	benches[name]()
@@ -0,0 +1,2625 @@
+#!/usr/bin/python
+#
+#  shared library for monitorBase / monitorUI
+#
+#	device independent parts (no RPi.GPIO / smbus import here)
+#	so that they can be loaded on a plain linux box for benchmarks
+#
+import os
+import sys
+import time
+import math
+import mmap
+import struct
+import json
+import logging
+import threading
+import zlib
+import heapq
+import select
+import fcntl
+import bisect
+import errno
+import socket
+import operator
+import inspect
+import audioop
+import subprocess
+from array import array
+from collections import deque
+from datetime import datetime, timedelta, date
+
+######################################################################
+#  APA102 frame encoder (LED on the button shim)
+#
+#	The LED is bit-banged through the output register of the I2C
+#	expander. Every bit needs 2 output values (data, data + clock),
+#	so one byte is 16 values and a whole frame is 128 values.
+#	The expander accepts repeated writes to the output register
+#	within one block transfer, so the frame is sent in as few
+#	SMBus blocks (max 32 bytes) as possible.
+#====================================================================#
+
+class apa102:
+
+    LED_DATA  = 7
+    LED_CLOCK = 6
+
+    BLOCK_MAX = 32		# SMBus block write limit
+
+    START_FRAME = (0, 0)
+    END_FRAME   = (0, 0)
+    GLOBAL_BRIGHTNESS = 0b11101111
+
+    _wave = None		# byte -> 16 output values (precomputed)
+
+    GAMMA = [
+	  0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,
+	  0,   0,   0,   0,   0,   0,   1,   1,   1,   1,   1,   1,   1,   2,   2,   2,
+	  2,   2,   2,   3,   3,   3,   3,   3,   4,   4,   4,   4,   5,   5,   5,   5,
+	  6,   6,   6,   7,   7,   7,   8,   8,   8,   9,   9,   9,  10,  10,  11,  11,
+	 11,  12,  12,  13,  13,  13,  14,  14,  15,  15,  16,  16,  17,  17,  18,  18,
+	 19,  19,  20,  21,  21,  22,  22 , 23,  23,  24,  25,  25,  26,  27,  27,  28,
+	 29,  29,  30,  31,  31,  32,  33,  34,  34,  35,  36,  37,  37,  38,  39,  40,
+	 40,  41,  42,  43,  44,  45,  46,  46,  47,  48,  49,  50,  51,  52,  53,  54,
+	 55,  56,  57,  58,  59,  60,  61,  62,  63,  64,  65,  66,  67,  68,  69,  70,
+	 71,  72,  73,  74,  76,  77,  78,  79,  80,  81,  83,  84,  85,  86,  88,  89,
+	 90,  91,  93,  94,  95,  96,  98,  99, 100, 102, 103, 104, 106, 107, 109, 110,
+	111, 113, 114, 116, 117, 119, 120, 121, 123, 124, 126, 128, 129, 131, 132, 134,
+	135, 137, 138, 140, 142, 143, 145, 146, 148, 150, 151, 153, 155, 157, 158, 160,
+	162, 163, 165, 167, 169, 170, 172, 174, 176, 178, 179, 181, 183, 185, 187, 189,
+	191, 193, 194, 196, 198, 200, 202, 204, 206, 208, 210, 212, 214, 216, 218, 220,
+	222, 224, 227, 229, 231, 233, 235, 237, 239, 241, 244, 246, 248, 250, 252, 255]
+
+    @staticmethod
+    def _build_wave():
+	wave = []
+	for byte in range(256):
+	    w = []
+	    for x in range(8):
+		if (byte << x) & 0b10000000 : d = (1 << apa102.LED_DATA)
+		else:			      d = 0
+		w.append(d)
+		w.append(d | (1 << apa102.LED_CLOCK))
+	    wave.append(tuple(w))
+	apa102._wave = tuple(wave)
+
+    #
+    #  encode a whole frame (start frame, pixel, end frame)
+    #
+    #    r, g, b are already gamma corrected values (0..255)
+    #    returns a list of blocks for write_i2c_block_data
+    #
+    @staticmethod
+    def encode(r, g, b):
+	if apa102._wave is None: apa102._build_wave()
+	wave = apa102._wave
+
+	frame = apa102.START_FRAME + (apa102.GLOBAL_BRIGHTNESS, b, g, r) + apa102.END_FRAME
+	values = []
+	for byte in frame:
+	    values.extend(wave[byte])
+
+	n = apa102.BLOCK_MAX
+	return [values[i:i + n] for i in range(0, len(values), n)]
+
+######################################################################
+#  SO1602 (US2066) command transfer
+#
+#	Every byte after the address is preceded by a control byte
+#	(Co, D/C#). With Co = 1 another control byte follows, so a
+#	sequence of commands is one block transfer:
+#
+#	  addr 0x80 cmd1 0x80 cmd2 ... 0x00 cmdN
+#
+#	Data (D/C# = 1) may follow the last command in the same transfer
+#	(a set DDRAM address and the characters written there):
+#
+#	  addr 0x80 cmd1 ... 0x80 cmdN 0x40 data1 data2 ...
+#
+#	Each command carries its execution delay. Short delays are
+#	covered by the transfer of the next byte (~90us at 100kHz), a
+#	command with a longer delay closes the transfer and the sender
+#	sleeps for the longest delay of the transfer.
+#====================================================================#
+
+class so1602:
+
+    CO_CMD   = 0x80		# control byte: command, another control byte follows
+    LAST_CMD = 0x00		# control byte: command, last control byte
+    DATA     = 0x40		# control byte: data stream
+
+    BLOCK_MAX = 32		# SMBus block write limit (cmd1 + 2 bytes per further command)
+    DELAY     = 5		# default execution delay (us)
+    DELAYS    = { 0x01 : 2000,	# clear display
+		  0x02 : 2000 }	# return home
+    INLINE_MAX = 90		# delays up to one byte time need no sleep inside a transfer
+
+    @staticmethod
+    def delay(c):
+	return so1602.DELAYS.get(c, so1602.DELAY)
+
+    #
+    #  send [(cmd, delay us), ...] and then data [byte, ...] in as few transfers as possible
+    #
+    @staticmethod
+    def send(i2c, addr, cmds, data = ()):
+	n = (so1602.BLOCK_MAX + 1) // 2
+	data = list(data)
+	i = 0
+	while i < len(cmds):
+	    chunk = []
+	    while i < len(cmds) and len(chunk) < n:
+		chunk.append(cmds[i])
+		i += 1
+		if chunk[-1][1] > so1602.INLINE_MAX: break
+
+	    room = so1602.BLOCK_MAX - 2 * len(chunk)		# data bytes after the commands
+	    vals = [chunk[0][0]]
+	    for c, d in chunk[1:-1]:
+		vals += [so1602.CO_CMD, c]
+	    if i == len(cmds) and data and room > 0 and chunk[-1][1] <= so1602.INLINE_MAX:
+		if len(chunk) > 1: vals += [so1602.CO_CMD, chunk[-1][0]]
+		vals += [so1602.DATA] + data[:room]
+		data = data[room:]
+		i2c.write_i2c_block_data(addr, so1602.CO_CMD, vals)
+	    elif len(chunk) == 1:
+		i2c.write_byte_data(addr, so1602.LAST_CMD, chunk[0][0])
+	    else:
+		vals += [so1602.LAST_CMD, chunk[-1][0]]
+		i2c.write_i2c_block_data(addr, so1602.CO_CMD, vals)
+	    clock.sleep(max([d for c, d in chunk]) / 1000000.0)
+
+	for i in range(0, len(data), so1602.BLOCK_MAX):
+	    i2c.write_i2c_block_data(addr, so1602.DATA, data[i:i + so1602.BLOCK_MAX])
+
+######################################################################
+#  SHT-31 temperature / humidity sensor
+#
+#	A command is 16 bit: the MSB goes as the SMBus command byte and
+#	the LSB as data. Every 16 bit word the sensor returns is followed
+#	by its CRC-8 (poly 0x31, init 0xff).
+#
+#	Single shot uses the commands without clock stretching: the
+#	sensor NACKs a read until the conversion has finished. measure()
+#	only starts the conversion and reads the result from a sched
+#	timer after the conversion time (poll = True: polls from the
+#	typical time on), so nobody sleeps on the bus. A frame with a bad
+#	CRC is measured again (the sensor clears its result when read).
+#
+#	Periodic mode (0.5 .. 10 mps, ART: 4 mps) keeps converting,
+#	fetch() returns the latest result or None if there is none yet.
+#====================================================================#
+
+class sht31:
+
+    ADDR = 0x45
+
+    HIGH   = 0			# repeatability: accuracy vs conversion time
+    MEDIUM = 1
+    LOW    = 2
+
+    SINGLE   = (0x2400, 0x240b, 0x2416)	# single shot, no clock stretching
+    DURATION = (0.0155, 0.0065, 0.0045)	# max conversion time (sec)
+    TYPICAL  = (0.0125, 0.0045, 0.0025)	# typical conversion time (sec)
+    PERIODIC = {			# measurements per second -> command
+	0.5 : (0x2032, 0x2024, 0x202f),
+	1   : (0x2130, 0x2126, 0x212d),
+	2   : (0x2236, 0x2220, 0x222b),
+	4   : (0x2334, 0x2322, 0x2329),
+	10  : (0x2737, 0x2721, 0x272a) }
+
+    ART        = 0x2b32		# periodic with accelerated response time (4 mps)
+    FETCH      = 0xe000
+    BREAK      = 0x3093		# stop periodic mode
+    RESET      = 0x30a2
+    HEATER_ON  = 0x306d
+    HEATER_OFF = 0x3066
+    STATUS     = 0xf32d
+    CLEAR      = 0x3041		# clear status
+
+    RETRY = 3			# measurements of a frame with a bad CRC
+    POLL  = 0.001		# poll interval until the result is ready
+
+    _crc = None			# CRC-8 table (precomputed)
+
+    def __init__(self, i2c, addr = ADDR):
+	self.i2c  = i2c
+	self.addr = addr
+	self.crc_errors = 0
+	self.timeouts   = 0
+	self._timer = None
+	self._t0 = 0			# start of measure()
+	self.latency = metrics.histogram('monitor_sht31_measure_seconds', 'measure() until the result')
+	metrics.func('monitor_sht31_crc_errors_total', 'counter', lambda: self.crc_errors, 'results with a bad CRC')
+	metrics.func('monitor_sht31_timeouts_total', 'counter', lambda: self.timeouts, 'measurements without a result')
+
+    @staticmethod
+    def _build_crc():
+	table = array('B')
+	for byte in range(256):
+	    crc = byte
+	    for i in range(8):
+		if crc & 0x80: crc = ((crc << 1) ^ 0x31) & 0xff
+		else:	       crc = (crc << 1) & 0xff
+	    table.append(crc)
+	sht31._crc = table
+
+    @staticmethod
+    def crc8(data):
+	if sht31._crc is None: sht31._build_crc()
+	table = sht31._crc
+	crc = 0xff
+	for b in data:
+	    crc = table[crc ^ b]
+	return crc
+
+    @staticmethod
+    def convert(t, h):
+	return (175 * t / 65535.0) - 45, 100 * h / 65535.0
+
+    def command(self, cmd):
+	self.i2c.write_i2c_block_data(self.addr, cmd >> 8, [cmd & 0xff])
+
+    #
+    #  n words of the result (IOError: not ready, None: bad CRC)
+    #
+    def _words(self, n):
+	data = self.i2c.read_i2c_block_data(self.addr, 0, n * 3)
+	words = []
+	for i in range(0, n * 3, 3):
+	    if sht31.crc8(data[i:i + 2]) != data[i + 2]:
+		self.crc_errors += 1
+		return None
+	    words.append(data[i] << 8 | data[i + 1])
+	return words
+
+    #
+    #  single shot: callback((temp, humidity)) from sched, None on failure
+    #
+    def measure(self, callback, rep = HIGH, poll = False):
+	sched.cancel(self._timer)
+	self._callback = callback
+	self._rep   = rep
+	self._poll  = poll
+	self._tries = 0
+	self._t0 = clock.monotonic()
+	self._start()
+
+    def _start(self):
+	self._tries += 1
+	self.command(sht31.SINGLE[self._rep])
+	self._deadline = clock.monotonic() + sht31.DURATION[self._rep] * 2
+	wait = (sht31.DURATION, sht31.TYPICAL)[self._poll][self._rep]
+	self._timer = sched.call_later(wait, self._collect)
+
+    def _collect(self):
+	self._timer = None
+	try:
+	    words = self._words(2)
+	except IOError:
+	    if clock.monotonic() < self._deadline:
+		self._timer = sched.call_later(sht31.POLL, self._collect)
+		return
+	    self.timeouts += 1
+	    words = None
+
+	if words is None and self._tries < sht31.RETRY:
+	    self._start()
+	    return
+	self.latency.observe(clock.monotonic() - self._t0)
+	self._callback(words and sht31.convert(*words))
+
+    #
+    #  periodic mode
+    #
+    def start_periodic(self, mps, rep = HIGH):
+	self.command(sht31.PERIODIC[mps][rep])
+
+    def start_art(self):
+	self.command(sht31.ART)
+
+    def stop_periodic(self):
+	self.command(sht31.BREAK)
+
+    def fetch(self):
+	# the latest result, None: no new result (or bad CRC)
+	self.command(sht31.FETCH)
+	try:
+	    words = self._words(2)
+	except IOError:
+	    return None
+	return words and sht31.convert(*words)
+
+    #
+    #  heater / status
+    #
+    def heater(self, on):
+	self.command((sht31.HEATER_OFF, sht31.HEATER_ON)[bool(on)])
+
+    def status(self):
+	# status register (bit 13: heater on, 15: alert pending), None on failure
+	for i in range(sht31.RETRY):
+	    self.command(sht31.STATUS)
+	    try:
+		words = self._words(1)
+	    except IOError:
+		continue
+	    if words is not None: return words[0]
+	return None
+
+    def clear_status(self):
+	self.command(sht31.CLEAR)
+
+    def reset(self):
+	self.command(sht31.RESET)
+
+######################################################################
+#  metrics
+#
+#	counters and fixed bucket histograms of a daemon. Recording is an
+#	increment (histogram: a bisect and two increments), nothing else
+#	is done until export() writes all series in the Prometheus text
+#	format to DIR/monitor_<daemon>.prom (temp file + rename) for the
+#	textfile collector of node_exporter. Values the code counts
+#	anyway are registered as funcs and read only by export().
+#
+#	Durations are measured with time.time() (a clock step spoils one
+#	sample), the ctypes monotonic() of python 2 costs more than the
+#	short calls it would measure.
+#====================================================================#
+
+class metric_counter:
+
+    def __init__(self):
+	self.value = 0
+
+    def inc(self, n = 1):
+	self.value += n
+
+class metric_hist:
+
+    def __init__(self, buckets):
+	self.buckets = buckets		# upper bounds (sec)
+	self.counts = [0] * (len(buckets) + 1)	# last: more than buckets[-1]
+	self.sum = 0.0
+
+    def observe(self, v):
+	self.counts[bisect.bisect_left(self.buckets, v)] += 1
+	self.sum += v
+
+class metrics:
+
+    DIR = '/tmp'
+    EXPORT = 60.0		# sec between exports
+    SECONDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    daemon = None		# value of the 'daemon' label of every series (set by start())
+    _families = {}		# name -> [type, help, {labels: metric or func}]
+    _names = {}			# function -> 'class.method' (name())
+    _lines = {}			# (name, labels) -> line heads of a series (text())
+
+    @staticmethod
+    def _add(name, kind, help, labels, metric):
+	family = metrics._families.setdefault(name, [kind, help, {}])
+	family[2][tuple(sorted(labels.items()))] = metric
+	return metric
+
+    @staticmethod
+    def counter(name, help = '', **labels):
+	return metrics._add(name, 'counter', help, labels, metric_counter())
+
+    @staticmethod
+    def histogram(name, help = '', buckets = None, **labels):
+	return metrics._add(name, 'histogram', help, labels, metric_hist(buckets or metrics.SECONDS))
+
+    @staticmethod
+    def func(name, kind, func, help = '', **labels):
+	# func() -> the value at export time (kind: 'counter' or 'gauge')
+	metrics._add(name, kind, help, labels, func)
+
+    #
+    #  decorator: run time of a function in monitor_call_seconds{func=name}
+    #
+    @staticmethod
+    def timed(name):
+	hist = metrics.histogram('monitor_call_seconds', 'run time of instrumented functions', func = name)
+	def wrap(func):
+	    def timed_call(*args, **kwargs):
+		t = time.time()
+		try:
+		    return func(*args, **kwargs)
+		finally:
+		    hist.observe(time.time() - t)
+	    timed_call.__name__ = func.__name__
+	    return timed_call
+	return wrap
+
+    @staticmethod
+    def name(func):
+	# 'class.method' of a sched job (cached, the classes of the module are searched once)
+	key = getattr(func, 'im_func', func)
+	name = metrics._names.get(key)
+	if name is not None: return name
+
+	name = getattr(func, '__name__', str(func))
+	if hasattr(func, 'im_class'):
+	    name = func.im_class.__name__ + '.' + name
+	else:
+	    mod = sys.modules.get(getattr(func, '__module__', None))
+	    for k, v in (vars(mod).items() if mod else []):
+		if inspect.isclass(v) and isinstance(vars(v).get(name), staticmethod) and vars(v)[name].__get__(None, v) is func:
+		    name = k + '.' + name
+		    break
+	metrics._names[key] = name
+	return name
+
+    @staticmethod
+    def start(daemon):
+	metrics.daemon = daemon
+	metrics._lines = {}
+	sched.every(metrics.EXPORT, metrics.export)
+
+    @staticmethod
+    def _labels(key, extra = ()):
+	pairs = [('daemon', metrics.daemon)] + list(key) + list(extra)
+	return '{' + ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs]) + '}'
+
+    @staticmethod
+    def _num(v):
+	return str(v) if isinstance(v, (int, long)) else repr(float(v))
+
+    @staticmethod
+    def _heads(name, key, m):
+	# 'name{labels} ' of the lines of a series (histogram: buckets, _sum, _count)
+	heads = metrics._lines.get((name, key))
+	if heads is None:
+	    if isinstance(m, metric_hist):
+		heads = [name + '_bucket' + metrics._labels(key, [('le', le)]) + ' ' for le in ['%g' % b for b in m.buckets] + ['+Inf']]
+		heads += [name + '_sum' + metrics._labels(key) + ' ', name + '_count' + metrics._labels(key) + ' ']
+	    else:
+		heads = [name + metrics._labels(key) + ' ']
+	    metrics._lines[(name, key)] = heads
+	return heads
+
+    @staticmethod
+    def text():
+	lines = []
+	for name in sorted(metrics._families.keys()):
+	    kind, help, series = metrics._families[name]
+	    if help: lines.append('# HELP %s %s' % (name, help))
+	    lines.append('# TYPE %s %s' % (name, kind))
+	    for key in sorted(series.keys()):
+		m = series[key]
+		heads = metrics._heads(name, key, m)
+		if isinstance(m, metric_hist):
+		    n = 0
+		    for head, c in zip(heads, m.counts):
+			n += c
+			lines.append(head + str(n))
+		    lines.append(heads[-2] + metrics._num(m.sum))
+		    lines.append(heads[-1] + str(n))
+		else:
+		    value = m.value if isinstance(m, metric_counter) else m()
+		    lines.append(heads[0] + metrics._num(value))
+	return lines
+
+    @staticmethod
+    def export():
+	logger = logging.getLogger(__name__)
+	if metrics.daemon is None: return
+	path = os.path.join(metrics.DIR, 'monitor_%s.prom' % metrics.daemon)
+	try:
+	    with open(path + '.tmp', 'w') as f:
+		f.write('\n'.join(metrics.text()) + '\n')
+	    os.rename(path + '.tmp', path)
+	except EnvironmentError as e:
+	    logger.warning("metrics export: " + str(e))
+
+######################################################################
+#  I2C bus arbiter
+#
+#	monitorBase and monitorUI share I2C bus 1 (expander 0x3f, SO1602
+#	0x3c). Every transaction goes through an i2c_bus client which
+#	holds the bus lock for it: a lock between the threads of the
+#	process and flock() on LOCK_PATH between the processes.
+#	'with client:' holds the bus over several transactions.
+#
+#	Priority: a HIGH client (buttons, sensor, display) holds a shared
+#	flock on PRIO_PATH while it waits for or holds the bus. A LOW
+#	client (LED frames) takes the bus only when no HIGH client is
+#	waiting, and gives it back between the blocks of a frame when one
+#	shows up (yield_bus). An APA102 frame may pause at any clock edge,
+#	so the frame itself is not broken by that.
+#
+#	Every client keeps a histogram of the time it waited for the bus
+#	and counts its transfers (metrics).
+#====================================================================#
+
+class i2c_bus:
+
+    HIGH = 0
+    LOW  = 1
+
+    LOCK_PATH = '/dev/shm/monitor_i2c.lock'
+    PRIO_PATH = '/dev/shm/monitor_i2c.prio'
+    BUCKETS   = (0.0001, 0.001, 0.01, 0.1, 1.0)	# wait time histogram (upper bounds, sec) + overflow
+    POLL      = 0.001				# LOW client: recheck interval while HIGH clients use the bus
+
+    # per process
+    _lock  = threading.RLock()		# owner thread of the bus
+    _depth = 0
+    _fd    = None			# LOCK_PATH
+    _pfd   = None			# PRIO_PATH
+    _plock = threading.Lock()		# _high and the flock on _pfd
+    _high  = 0				# HIGH clients of this process waiting or holding
+    clients = []
+
+    def __init__(self, bus, name, prio = HIGH):
+	self.bus  = bus
+	self.name = name
+	self.prio = prio
+	self.hist = metrics.histogram('monitor_i2c_wait_seconds', 'wait for the I2C bus', i2c_bus.BUCKETS, client = name)
+	self.trans = metrics.counter('monitor_i2c_transactions_total', 'I2C transfers', client = name)
+	self.bytes = metrics.counter('monitor_i2c_bytes_total', 'I2C command and data bytes', client = name)
+	self.errors = metrics.counter('monitor_i2c_errors_total', 'I2C transfers failed with IOError (also SHT-31 not ready)', client = name)
+	self.count = 0
+	self.wait  = 0.0
+	self.wait_max = 0.0
+	i2c_bus.clients.append(self)
+
+    @staticmethod
+    def _open():
+	if i2c_bus._fd is None:
+	    i2c_bus._fd  = os.open(i2c_bus.LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o666)
+	    i2c_bus._pfd = os.open(i2c_bus.PRIO_PATH, os.O_RDWR | os.O_CREAT, 0o666)
+
+    @staticmethod
+    def _want(n):
+	with i2c_bus._plock:
+	    i2c_bus._high += n
+	    if n > 0 and i2c_bus._high == 1:
+		fcntl.flock(i2c_bus._pfd, fcntl.LOCK_SH)
+	    elif i2c_bus._high == 0:
+		fcntl.flock(i2c_bus._pfd, fcntl.LOCK_UN)
+
+    #
+    #  a HIGH client waits for or holds the bus (in any process)
+    #
+    @staticmethod
+    def high_waiting():
+	with i2c_bus._plock:
+	    if i2c_bus._high: return True
+	    i2c_bus._open()
+	    try:
+		fcntl.flock(i2c_bus._pfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	    except IOError:
+		return True
+	    fcntl.flock(i2c_bus._pfd, fcntl.LOCK_UN)
+	    return False
+
+    def acquire(self):
+	if i2c_bus._depth and i2c_bus._lock._is_owned():
+	    i2c_bus._lock.acquire()		# nested in the same thread
+	    i2c_bus._depth += 1
+	    return
+
+	t = clock.monotonic()
+	i2c_bus._open()
+	if self.prio == i2c_bus.HIGH:
+	    i2c_bus._want(1)
+	    i2c_bus._lock.acquire()
+	    fcntl.flock(i2c_bus._fd, fcntl.LOCK_EX)
+	else:
+	    while True:
+		while i2c_bus.high_waiting(): clock.sleep(i2c_bus.POLL)
+		i2c_bus._lock.acquire()
+		fcntl.flock(i2c_bus._fd, fcntl.LOCK_EX)
+		if not i2c_bus.high_waiting(): break
+		fcntl.flock(i2c_bus._fd, fcntl.LOCK_UN)
+		i2c_bus._lock.release()
+	i2c_bus._depth = 1
+
+	w = clock.monotonic() - t
+	self.hist.observe(w)
+	self.count += 1
+	self.wait += w
+	if w > self.wait_max: self.wait_max = w
+
+    def release(self):
+	i2c_bus._depth -= 1
+	if i2c_bus._depth == 0:
+	    fcntl.flock(i2c_bus._fd, fcntl.LOCK_UN)
+	    i2c_bus._lock.release()
+	    if self.prio == i2c_bus.HIGH: i2c_bus._want(-1)
+	else:
+	    i2c_bus._lock.release()
+
+    #
+    #  LOW client holding the bus: let a waiting HIGH client in
+    #
+    def yield_bus(self):
+	if self.prio == i2c_bus.LOW and i2c_bus._depth == 1 and i2c_bus.high_waiting():
+	    self.release()
+	    self.acquire()
+
+    def __enter__(self):
+	self.acquire()
+	return self
+
+    def __exit__(self, *exc):
+	self.release()
+
+    def _xfer(self, n, func, *args):
+	# one transfer of n bytes (command + data), its time on the bus follows from n
+	with self:
+	    try:
+		result = func(*args)
+	    except IOError:
+		self.errors.value += 1
+		raise
+	self.trans.value += 1
+	self.bytes.value += n
+	return result
+
+    # smbus.SMBus methods used by the daemons
+
+    def write_byte_data(self, addr, cmd, val):
+	return self._xfer(2, self.bus.write_byte_data, addr, cmd, val)
+
+    def read_byte_data(self, addr, cmd):
+	return self._xfer(2, self.bus.read_byte_data, addr, cmd)
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+	return self._xfer(1 + len(vals), self.bus.write_i2c_block_data, addr, cmd, vals)
+
+    def read_i2c_block_data(self, addr, cmd, n):
+	return self._xfer(1 + n, self.bus.read_i2c_block_data, addr, cmd, n)
+
+    #
+    #  wait time histograms of the clients of this process
+    #
+    @staticmethod
+    def report():
+	labels = ['<%gms' % (b * 1000) for b in i2c_bus.BUCKETS] + ['more']
+	lines = []
+	for c in i2c_bus.clients:
+	    lines.append("i2c %-8s %-4s %7d acq  avg %7.3fms  max %7.3fms  %s" % (
+		c.name, ('HIGH', 'LOW')[c.prio], c.count, c.wait * 1000 / max(1, c.count), c.wait_max * 1000,
+		' '.join(['%s:%d' % (l, n) for l, n in zip(labels, c.hist.counts)])))
+	return lines
+
+    @staticmethod
+    def log_stats():
+	logger = logging.getLogger(__name__)
+	for line in i2c_bus.report():
+	    logger.info(line)
+
+######################################################################
+#  LED animation engine
+#
+#	A pattern is precomputed into 3 array('B') tables (one per color,
+#	brightness and gamma already applied). Each table covers a whole
+#	period of its channel, so playback is only an index increment.
+#	The channels may have different period lengths.
+#====================================================================#
+
+class led_anim:
+
+    _cache = {}			# pattern name -> (table_r, table_g, table_b)
+    _tables = None		# tables of the current pattern
+    _idx = [0, 0, 0]		# playback position of each channel
+    _name = None
+
+    _gamma = None
+    _brightness = 1.0
+    _dt = 1/4.0			# frame interval (sec)
+
+    @staticmethod
+    def init(gamma, brightness, dt):
+	led_anim._gamma = gamma
+	led_anim._brightness = brightness
+	led_anim._dt = dt
+	led_anim._cache = {}
+
+    @staticmethod
+    def _correct(levels):
+	g = led_anim._gamma
+	k = led_anim._brightness
+	return array('B', [g[int(x * k) & 0xff] for x in levels])
+
+    #
+    #  breathing (the original c3_m animation)
+    #
+    #    the brightness follows sin() of a phase whose speed is modulated
+    #    by a triangle wave of (2 * half) seconds. One triangle period
+    #    does not bring the phase back to a multiple of 2, so the table
+    #    covers m periods and the phase speed is scaled slightly to close
+    #    the loop without a jump.
+    #
+    @staticmethod
+    def _breath_channel(half, offset):
+	dt = led_anim._dt
+	ticks = int(round(2 * half / dt))
+
+	steps = []
+	t1 = 0
+	for i in range(ticks):
+	    t1 += dt
+	    steps.append(dt / (abs((t1 % (2 * half)) - half) + offset))
+	adv = sum(steps)
+
+	best = None
+	for m in range(1, 9):
+	    k = max(1, int(round(m * adv / 2)))
+	    err = abs(m * adv - 2 * k) / (m * adv)
+	    if best is None or err < best[0]: best = (err, m, k)
+	err, m, k = best
+	scale = 2.0 * k / (m * adv)
+
+	levels = []
+	t2 = 0
+	for i in range(m * ticks):
+	    t2 += steps[i % ticks] * scale
+	    levels.append(max(0, math.sin(t2 * math.pi) * 180 + 60))
+	return led_anim._correct(levels)
+
+    @staticmethod
+    def _build_breath():
+	return (led_anim._breath_channel(40, 10.0),
+		led_anim._breath_channel(41, 10.1),
+		led_anim._breath_channel(42,  9.9))
+
+    @staticmethod
+    def _build_pulse():
+	# all channels together, 8 sec period
+	n = int(round(8 / led_anim._dt))
+	t = led_anim._correct([(1 - math.cos(2 * math.pi * i / n)) * 120 for i in range(n)])
+	return (t, t, t)
+
+    @staticmethod
+    def _build_steady():
+	return (led_anim._correct([0]), led_anim._correct([100]), led_anim._correct([200]))
+
+    @staticmethod
+    def _build_off():
+	t = array('B', [0])
+	return (t, t, t)
+
+    _builders = {
+	'breath' : '_build_breath',
+	'pulse'  : '_build_pulse',
+	'steady' : '_build_steady',
+	'off'    : '_build_off',
+    }
+
+    @staticmethod
+    def patterns():
+	return sorted(led_anim._builders.keys())
+
+    @staticmethod
+    def is_static():
+	return max([len(t) for t in led_anim._tables]) == 1
+
+    #
+    #  select the pattern (may be called from another thread)
+    #
+    @staticmethod
+    def load(name):
+	if name not in led_anim._builders:
+	    raise ValueError("unknown led pattern: " + str(name))
+
+	tables = led_anim._cache.get(name)
+	if tables is None:
+	    tables = getattr(led_anim, led_anim._builders[name])()
+	    led_anim._cache[name] = tables
+
+	led_anim._idx = [0, 0, 0]
+	led_anim._tables = tables
+	led_anim._name = name
+
+    #
+    #  next frame -> gamma corrected (r, g, b)
+    #
+    @staticmethod
+    def next_frame():
+	tables = led_anim._tables
+	idx = led_anim._idx
+	for c in (0, 1, 2):
+	    i = idx[c] + 1
+	    if i >= len(tables[c]): i = 0
+	    idx[c] = i
+	return tables[0][idx[0]], tables[1][idx[1]], tables[2][idx[2]]
+
+######################################################################
+#  shared memory sample channel (monitorBase -> monitorUI)
+#
+#	fixed layout record in a memory mapped file on tmpfs:
+#
+#	  header  : magic(4s) version(H) active slot(B) pad(B)
+#	  slot x2 : seq(I) pad(I) timestamp(d) temp_s(d) temp_c(d) humidity(d)
+#
+#	The writer fills the inactive slot under a seqlock (seq is odd
+#	while writing) and then flips the active slot index. A reader
+#	takes the active slot and, if it has been torn by a concurrent
+#	write, the other slot which holds the previous complete sample.
+#	So a read never loops and never sleeps.
+#====================================================================#
+
+class sens_shm:
+
+    PATH = '/dev/shm/monitor_sens'
+
+    MAGIC   = 'SENS'
+    VERSION = 1
+
+    _hdr  = struct.Struct('=4sHBB')
+    _seq  = struct.Struct('=I')
+    _data = struct.Struct('=dddd')
+    SLOT_SIZE = 8 + _data.size
+    SIZE = _hdr.size + 2 * SLOT_SIZE
+
+    _mm = None			# mmap object
+    _writable = False
+
+    @staticmethod
+    def _slot_offset(slot):
+	return sens_shm._hdr.size + slot * sens_shm.SLOT_SIZE
+
+    #
+    #  writer side (monitorBase)
+    #
+    @staticmethod
+    def open_writer(path = None):
+	path = path or sens_shm.PATH
+	fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+	try:
+	    if os.fstat(fd).st_size < sens_shm.SIZE:
+		os.ftruncate(fd, sens_shm.SIZE)
+	    mm = mmap.mmap(fd, sens_shm.SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+	finally:
+	    os.close(fd)
+
+	magic, version, slot, pad = sens_shm._hdr.unpack_from(mm, 0)
+	if magic != sens_shm.MAGIC or version != sens_shm.VERSION:
+	    mm[0:sens_shm.SIZE] = '\0' * sens_shm.SIZE
+	    sens_shm._hdr.pack_into(mm, 0, sens_shm.MAGIC, sens_shm.VERSION, 0, 0)
+
+	sens_shm._mm = mm
+	sens_shm._writable = True
+
+    @staticmethod
+    def write(ts, temp_s, temp_c, humidity):
+	mm = sens_shm._mm
+	magic, version, active, pad = sens_shm._hdr.unpack_from(mm, 0)
+	slot = 1 - active
+	off  = sens_shm._slot_offset(slot)
+
+	seq = sens_shm._seq.unpack_from(mm, off)[0]
+	sens_shm._seq.pack_into(mm, off, (seq + 1) & 0xffffffff)			# odd: writing
+	sens_shm._data.pack_into(mm, off + 8, ts, temp_s, temp_c, humidity)
+	sens_shm._seq.pack_into(mm, off, (seq + 2) & 0xffffffff)			# even: complete
+
+	sens_shm._hdr.pack_into(mm, 0, sens_shm.MAGIC, sens_shm.VERSION, slot, 0)
+
+    #
+    #  reader side (monitorUI)
+    #
+    @staticmethod
+    def open_reader(path = None):
+	path = path or sens_shm.PATH
+	try:
+	    fd = os.open(path, os.O_RDONLY)
+	except OSError:
+	    return False
+	try:
+	    if os.fstat(fd).st_size < sens_shm.SIZE: return False
+	    sens_shm._mm = mmap.mmap(fd, sens_shm.SIZE, mmap.MAP_SHARED, mmap.PROT_READ)
+	finally:
+	    os.close(fd)
+	sens_shm._writable = False
+	return True
+
+    #
+    #  latest sample -> (timestamp, temp_s, temp_c, humidity) or None
+    #
+    @staticmethod
+    def read():
+	mm = sens_shm._mm
+	if mm is None and not sens_shm.open_reader(): return None
+	mm = sens_shm._mm
+
+	magic, version, active, pad = sens_shm._hdr.unpack_from(mm, 0)
+	if magic != sens_shm.MAGIC or version != sens_shm.VERSION: return None
+
+	for slot in (active, 1 - active):
+	    off = sens_shm._slot_offset(slot)
+	    seq1 = sens_shm._seq.unpack_from(mm, off)[0]
+	    data = sens_shm._data.unpack_from(mm, off + 8)
+	    seq2 = sens_shm._seq.unpack_from(mm, off)[0]
+	    if seq1 == seq2 and seq1 != 0 and (seq1 & 1) == 0:
+		return data
+
+	return None
+
+######################################################################
+#  sample ring with per window aggregates
+#
+#	Channels of float samples in preallocated array('d') rings.
+#	window() aggregates the samples added since its last call:
+#	(min, max, mean, stddev, count) per channel. The work runs in
+#	builtins over array slices (min, max, math.fsum, map), not in a
+#	Python loop per sample.
+#====================================================================#
+
+class sample_ring:
+
+    def __init__(self, names, size):
+	self.names = tuple(names)
+	self.size  = size
+	self.data  = [array('d', [0.0] * size) for n in self.names]
+	self.head  = 0			# next slot
+	self.count = 0			# samples since the last window() (<= size)
+
+    def add(self, *values):
+	i = self.head
+	for a, v in zip(self.data, values):
+	    a[i] = v
+	self.head  = (i + 1) % self.size
+	self.count = min(self.count + 1, self.size)
+
+    def _last(self, a, n):
+	s = self.head - n
+	if s >= 0: return a[s:self.head]
+	return a[s:] + a[:self.head]
+
+    #
+    #  -> {name : (min, max, mean, stddev, count) or None}
+    #
+    def window(self):
+	n = self.count
+	self.count = 0
+	res = {}
+	for name, a in zip(self.names, self.data):
+	    if n == 0:
+		res[name] = None
+		continue
+	    x = self._last(a, n)
+	    mean = math.fsum(x) / n
+	    var  = math.fsum(map(operator.mul, x, x)) / n - mean * mean
+	    res[name] = (min(x), max(x), mean, math.sqrt(max(0.0, var)), n)
+	return res
+
+######################################################################
+#  sensor history (on-device time series store)
+#
+#	One file per resolution: 1 min raw samples and 15 min / 1 hour /
+#	1 day rollups of them. A file is a ring of fixed size records in
+#	a memory mapped file, appended in timestamp order, so the oldest
+#	records fall out at the retention limit and a range query is a
+#	binary search on the timestamps.
+#
+#	  header  : magic(4s) version(H) pad(H) period(I) capacity(I) head(I) count(I)
+#	  raw     : ts(I) temp_s(f) temp_c(f) humidity(f)
+#	  rollup  : ts(I) n(H) pad(H) (min(f) max(f) mean(f)) x 3
+#
+#	A rollup bucket is written when the first sample of the next
+#	bucket arrives and then feeds the next coarser level. The open
+#	buckets are rebuilt from the finer level on open().
+#
+#	SD card wear: appended records stay in memory and go to the
+#	mapping + msync every FLUSH sec (one dirty page per file instead
+#	of one per minute). A power cut loses at most FLUSH sec.
+#	A reader (writable = False) gets the samples of that tail by
+#	other means (monitorUI: 'sens:' of ipc) and add()s them: they
+#	stay in its memory until the writer has flushed them.
+#====================================================================#
+
+class ts_file:
+
+    MAGIC   = 'TSDB'
+    VERSION = 1
+
+    _hdr = struct.Struct('=4sHHIIII')
+    _ts  = struct.Struct('=I')
+
+    def __init__(self, path, period, capacity, rec):
+	self.path = path
+	self.period = period
+	self.capacity = capacity
+	self.rec = rec
+	self.size = ts_file._hdr.size + capacity * rec.size
+	self._mm = None
+	self._pending = []		# records not yet in the mapping
+	self._writable = False
+
+    def open(self, writable = True):
+	if writable:
+	    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+	else:
+	    try:
+		fd = os.open(self.path, os.O_RDONLY)
+	    except OSError:
+		return False
+	try:
+	    if os.fstat(fd).st_size != self.size:
+		if not writable: return False
+		os.ftruncate(fd, self.size)
+	    prot = mmap.PROT_READ | (mmap.PROT_WRITE if writable else 0)
+	    mm = mmap.mmap(fd, self.size, mmap.MAP_SHARED, prot)
+	finally:
+	    os.close(fd)
+
+	magic, version, pad, period, capacity, head, count = ts_file._hdr.unpack_from(mm, 0)
+	if (magic, version, period, capacity) != (ts_file.MAGIC, ts_file.VERSION, self.period, self.capacity):
+	    if not writable: return False
+	    ts_file._hdr.pack_into(mm, 0, ts_file.MAGIC, ts_file.VERSION, 0, self.period, self.capacity, 0, 0)
+	self._mm = mm
+	self._writable = writable
+	return True
+
+    def _state(self):
+	# -> (index of the oldest record, count)
+	head, count = struct.unpack_from('=II', self._mm, ts_file._hdr.size - 8)
+	return (head - count) % self.capacity, count
+
+    def _offset(self, first, i):
+	return ts_file._hdr.size + (first + i) % self.capacity * self.rec.size
+
+    def append(self, *values):
+	self._pending.append(values)
+
+    def _mapped_ts(self):
+	# ts of the last record in the mapping (None: empty)
+	first, count = self._state()
+	if count == 0: return None
+	return ts_file._ts.unpack_from(self._mm, self._offset(first, count - 1))[0]
+
+    def last_ts(self):
+	last = self._mapped_ts()
+	if self._pending and (last is None or self._pending[-1][0] > last): return self._pending[-1][0]
+	return last
+
+    #
+    #  records with t0 <= ts < t1 (oldest first)
+    #
+    def query(self, t0, t1):
+	mm = self._mm
+	first, count = self._state()
+
+	lo, hi = 0, count		# first record with ts >= t0
+	while lo < hi:
+	    mid = (lo + hi) // 2
+	    if ts_file._ts.unpack_from(mm, self._offset(first, mid))[0] < t0: lo = mid + 1
+	    else: hi = mid
+
+	res = []
+	for i in range(lo, count):
+	    r = self.rec.unpack_from(mm, self._offset(first, i))
+	    if r[0] >= t1: return res
+	    res.append(r)
+	last = self._mapped_ts() or 0
+	return res + [r for r in self._pending if t0 <= r[0] < t1 and r[0] > last]
+
+    def flush(self):
+	if not self._pending: return
+	if not self._writable:
+	    # a reader only drops what the writer has put into the mapping meanwhile
+	    last = self._mapped_ts() or 0
+	    self._pending = [r for r in self._pending if r[0] > last]
+	    return
+	mm = self._mm
+	first, count = self._state()
+	head = (first + count) % self.capacity
+	for r in self._pending:
+	    self.rec.pack_into(mm, ts_file._hdr.size + head * self.rec.size, *r)
+	    head = (head + 1) % self.capacity
+	count = min(count + len(self._pending), self.capacity)
+	struct.pack_into('=II', mm, ts_file._hdr.size - 8, head, count)
+	mm.flush()
+	self._pending = []
+
+class history:
+
+    DIR = "/home/pi/projects/monitor_project/history"
+
+    LEVELS = (			# (period sec, retention sec)
+	(60,    7 * 86400),
+	(900,   92 * 86400),
+	(3600,  366 * 86400),
+	(86400, 10 * 366 * 86400) )
+    FLUSH = 900			# write the appended records every FLUSH sec
+
+    _raw    = struct.Struct('=Ifff')
+    _rollup = struct.Struct('=IHxx9f')
+
+    files = []
+    _acc  = []			# open bucket per level: [ts, n, mins, maxs, sums] or None
+    _synced = 0
+    _writable = False
+
+    @staticmethod
+    def open(path = None, writable = True):
+	path = path or history.DIR
+	if writable and not os.path.isdir(path):
+	    os.makedirs(path)
+	files = []
+	for i, (period, retention) in enumerate(history.LEVELS):
+	    f = ts_file(os.path.join(path, 'sens_%d.tsdb' % period), period, retention // period,
+			(history._raw, history._rollup)[i > 0])
+	    if not f.open(writable): return False
+	    files.append(f)
+	history.files = files
+	history._writable = writable
+	history._synced = clock.monotonic()
+
+	history._acc = [None] * len(history.LEVELS)
+	for i in range(1, len(history.LEVELS)):
+	    last = history.files[i - 1].last_ts()
+	    if last is None: continue
+	    bucket = last // history.files[i].period * history.files[i].period
+	    for r in history.files[i - 1].query(bucket, last + 1):
+		history._feed(i, *history._summary(i - 1, r))
+	return True
+
+    @staticmethod
+    def _summary(level, r):
+	# record -> (ts, n, mins, maxs, sums)
+	if level == 0: return r[0], 1, r[1:], r[1:], r[1:]
+	n = r[1]
+	return r[0], n, r[2::3], r[3::3], [x * n for x in r[4::3]]
+
+    @staticmethod
+    def _feed(level, ts, n, mins, maxs, sums):
+	f = history.files[level]
+	bucket = ts // f.period * f.period
+	acc = history._acc[level]
+	if acc is not None and acc[0] != bucket:
+	    if bucket < acc[0]: return
+	    history._acc[level] = None
+	    rec = [acc[0], acc[1]]
+	    for mn, mx, sm in zip(acc[2], acc[3], acc[4]):
+		rec += [mn, mx, sm / acc[1]]
+	    f.append(*rec)
+	    if level + 1 < len(history.files):
+		history._feed(level + 1, *acc)
+	    acc = None
+
+	if acc is None:
+	    history._acc[level] = [bucket, n, list(mins), list(maxs), list(sums)]
+	else:
+	    acc[1] += n
+	    acc[2] = map(min, acc[2], mins)
+	    acc[3] = map(max, acc[3], maxs)
+	    acc[4] = map(operator.add, acc[4], sums)
+
+    #
+    #  store a (1 minute) sample
+    #
+    @staticmethod
+    def add(ts, temp_s, temp_c, humidity):
+	ts = int(ts)
+	raw = history.files[0]
+	last = raw.last_ts()
+	if last is not None and ts <= last: return		# clock went back
+	raw.append(ts, temp_s, temp_c, humidity)
+	values = (temp_s, temp_c, humidity)
+	history._feed(1, ts, 1, values, values, values)
+
+	if clock.monotonic() - history._synced >= history.FLUSH:
+	    history.flush()
+
+    @staticmethod
+    def flush():
+	for f in history.files:
+	    f.flush()
+	history._synced = clock.monotonic()
+
+    @staticmethod
+    def last_ts():
+	# ts of the newest sample (None: none)
+	return history.files[0].last_ts()
+
+    #
+    #  records of the level with period sec, t0 <= ts < t1
+    #
+    #    raw    : (ts, temp_s, temp_c, humidity)
+    #    rollup : (ts, n, min, max, mean of temp_s, ... temp_c, ... humidity)
+    #
+    @staticmethod
+    def query(period, t0, t1):
+	for f in history.files:
+	    if f.period == period: return f.query(t0, t1)
+	raise ValueError("no history level of %d sec" % period)
+
+    #
+    #  t0 .. t1 in width columns: [mean of channel or None]
+    #
+    #    reads the coarsest level with at least one record per column,
+    #    so the work is O(width) and not O(samples)
+    #
+    @staticmethod
+    def series(t0, t1, width, channel):
+	col = float(t1 - t0) / width
+	level = 0
+	while level + 1 < len(history.files) and history.files[level + 1].period <= col:
+	    level += 1
+
+	sums = [0.0] * width
+	ns   = [0] * width
+	recs = [history._summary(level, r) for r in history.files[level].query(t0, t1)]
+	acc = history._acc[level] if level else None		# the open bucket
+	if acc is not None and t0 <= acc[0] < t1: recs.append(acc)
+	for ts, n, mins, maxs, s in recs:
+	    i = min(width - 1, int((ts - t0) / col))
+	    sums[i] += s[channel]
+	    ns[i]   += n
+	return [(s / n if n else None) for s, n in zip(sums, ns)]
+
+######################################################################
+#  message channel between monitorBase and monitorUI
+#
+#	Unix domain stream socket: monitorBase listens (ipc_server),
+#	monitorUI connects (ipc_client). A frame is length(!H) + message:
+#
+#	  UI -> base :  hsd:<0|1>   led:<pattern>
+#	  base -> UI :  sens:<ts>,<temp_s>,<temp_c>,<humidity>   pir:<0|1>
+#
+#	The sockets are non-blocking and read by the select() of
+#	sched.run(). send() never blocks: what the socket does not take
+#	at once is sent when it becomes writable. The client reconnects
+#	with backoff and calls on_connect() to resend its state.
+#====================================================================#
+
+class ipc_conn:
+
+    HEADER = struct.Struct('!H')
+    OUT_MAX = 65536		# unsent bytes of a peer which does not read: the connection is dropped
+
+    def __init__(self, sock, on_message, on_close):
+	sock.setblocking(False)
+	self.sock = sock
+	self.fd = sock.fileno()
+	self.on_message = on_message
+	self.on_close = on_close
+	self.closed = False
+	self._in  = ''
+	self._out = ''
+	self._lock = threading.Lock()
+	sched.add_reader(self.fd, self._readable)
+
+    def _flush(self):
+	# (under _lock) -> False: the connection is broken
+	try:
+	    n = self.sock.send(self._out)
+	    self._out = self._out[n:]
+	except socket.error as e:
+	    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK): return False
+	if self._out: sched.add_writer(self.fd, self._writable)
+	else:	      sched.remove_writer(self.fd)
+	return True
+
+    def send(self, msg):
+	if isinstance(msg, unicode): msg = msg.encode('utf-8')
+	with self._lock:
+	    if self.closed: return False
+	    self._out += ipc_conn.HEADER.pack(len(msg)) + msg
+	    ok = len(self._out) <= ipc_conn.OUT_MAX and self._flush()
+	if not ok: self.close()
+	return ok
+
+    def _writable(self, fd):
+	with self._lock:
+	    ok = self.closed or self._flush()
+	if not ok: self.close()
+
+    def _readable(self, fd):
+	try:
+	    data = self.sock.recv(4096)
+	except socket.error as e:
+	    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK): return
+	    data = ''
+	if not data:
+	    self.close()
+	    return
+
+	self._in += data
+	h = ipc_conn.HEADER.size
+	while len(self._in) >= h:
+	    n, = ipc_conn.HEADER.unpack_from(self._in)
+	    if len(self._in) < h + n: break
+	    msg = self._in[h:h + n]
+	    self._in = self._in[h + n:]
+	    self.on_message(msg)
+
+    def close(self):
+	with self._lock:
+	    if self.closed: return
+	    self.closed = True
+	sched.remove_reader(self.fd)
+	sched.remove_writer(self.fd)
+	self.sock.close()
+	if self.on_close is not None: self.on_close(self)
+
+class ipc_server:
+
+    PATH = '/tmp/monitor.sock'
+
+    _sock = None
+    _conns = []
+    _on_message = None
+
+    @staticmethod
+    def listen(on_message, path = None):
+	path = path or ipc_server.PATH
+	try:
+	    os.unlink(path)
+	except OSError:
+	    pass
+	ipc_server._on_message = staticmethod(on_message)
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	s.bind(path)
+	s.listen(4)
+	s.setblocking(False)
+	ipc_server._sock = s
+	sched.add_reader(s.fileno(), ipc_server._accept)
+
+    @staticmethod
+    def _accept(fd):
+	try:
+	    sock, addr = ipc_server._sock.accept()
+	except socket.error:
+	    return
+	ipc_server._conns.append(ipc_conn(sock, ipc_server._on_message, ipc_server._closed))
+
+    @staticmethod
+    def _closed(conn):
+	if conn in ipc_server._conns: ipc_server._conns.remove(conn)
+
+    #
+    #  send to every connected client (nobody connected: dropped)
+    #
+    @staticmethod
+    def broadcast(msg):
+	for conn in list(ipc_server._conns):
+	    conn.send(msg)
+
+class ipc_client:
+
+    PATH = ipc_server.PATH
+    RETRY_MIN = 1.0
+    RETRY_MAX = 60.0
+
+    _conn = None
+    _path = None
+    _on_message = None
+    _on_connect = None
+    _retry = RETRY_MIN
+    _timer = None
+
+    @staticmethod
+    def connect(on_message, on_connect = None, path = None):
+	ipc_client._path = path or ipc_client.PATH
+	ipc_client._on_message = staticmethod(on_message)
+	ipc_client._on_connect = None if on_connect is None else staticmethod(on_connect)
+	ipc_client._connect()
+
+    @staticmethod
+    def _connect():
+	logger = logging.getLogger(__name__)
+	ipc_client._timer = None
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	s.setblocking(False)
+	try:
+	    s.connect(ipc_client._path)
+	except socket.error as e:
+	    s.close()
+	    logger.info("ipc: cannot connect (%s), retry in %gs" % (e, ipc_client._retry))
+	    ipc_client._timer = sched.call_later(ipc_client._retry, ipc_client._connect)
+	    ipc_client._retry = min(ipc_client._retry * 2, ipc_client.RETRY_MAX)
+	    return
+
+	ipc_client._retry = ipc_client.RETRY_MIN
+	ipc_client._conn = ipc_conn(s, ipc_client._on_message, ipc_client._closed)
+	logger.info("ipc: connected")
+	if ipc_client._on_connect is not None: ipc_client._on_connect()
+
+    @staticmethod
+    def _closed(conn):
+	logging.getLogger(__name__).warning("ipc: disconnected")
+	ipc_client._conn = None
+	if ipc_client._timer is None:
+	    ipc_client._timer = sched.call_later(ipc_client._retry, ipc_client._connect)
+
+    #
+    #  -> False: not connected (the message is dropped, on_connect resends the state)
+    #
+    @staticmethod
+    def send(msg):
+	conn = ipc_client._conn
+	return conn is not None and conn.send(msg)
+
+######################################################################
+#  batch upload format
+#
+#	N samples packed into one columnar payload:
+#
+#	  { "v":1, "n":N, "keys":[...],
+#	    "t0":"<timestamp of the 1st sample>", "dt":[sec from previous, ...],
+#	    "scale":{key:10**k, ...}, "cols":{key:[int(value*scale), ...], ...} }
+#
+#	serialized as compact JSON and compressed with zlib.
+#====================================================================#
+
+class sens_batch:
+
+    VERSION = 1
+    CONTENT_TYPE = 'application/x-sensdata-batch'
+
+    # fixed point scale of each column (unknown keys: 1000)
+    SCALE = {
+	"T-SHT-31"    : 100 ,
+	"H-SHT-31"    : 100 ,
+	"C-HC501"     : 1 ,
+	"T-cpu_emily" : 1000 }
+
+    @staticmethod
+    def _parse_ts(ts):
+	if '.' in ts:	return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S.%f')
+	else:		return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S')
+
+    @staticmethod
+    def encode(samples):
+	keys = sorted(set([k for x in samples for k in x if k != 'timestamp']))
+	scale = dict([(k, sens_batch.SCALE.get(k, 1000)) for k in keys])
+
+	t0 = sens_batch._parse_ts(samples[0]['timestamp'])
+	dt = []
+	prev = t0
+	for x in samples:
+	    t = sens_batch._parse_ts(x['timestamp'])
+	    d = t - prev
+	    dt.append(int(round(d.days * 86400 + d.seconds + d.microseconds / 1000000.0)))
+	    prev = t
+
+	cols = {}
+	for k in keys:
+	    cols[k] = [None if x.get(k) is None else int(round(x[k] * scale[k])) for x in samples]
+
+	doc = { "v" : sens_batch.VERSION, "n" : len(samples), "keys" : keys,
+		"t0" : samples[0]['timestamp'], "dt" : dt, "scale" : scale, "cols" : cols }
+	return zlib.compress(json.dumps(doc, separators = (',', ':'), sort_keys = True), 9)
+
+    #
+    #  payload -> list of samples (timestamps are rounded to seconds)
+    #
+    @staticmethod
+    def decode(payload):
+	doc = json.loads(zlib.decompress(payload))
+	t = sens_batch._parse_ts(doc['t0']).replace(microsecond = 0)
+	samples = []
+	for i in range(doc['n']):
+	    t += timedelta(seconds = doc['dt'][i])
+	    x = { 'timestamp' : t.isoformat() }
+	    for k in doc['keys']:
+		v = doc['cols'][k][i]
+		if v is not None: x[k] = v / float(doc['scale'][k])
+	    samples.append(x)
+	return samples
+
+######################################################################
+#  store-and-forward uploader (monitorBase -> GAE server)
+#
+#	put() only stores the sample as a file in the spool directory
+#	and wakes the worker thread, so the main loop never waits for
+#	the network. The worker posts the spooled samples (oldest first)
+#	over one keep-alive session and deletes the files when the server
+#	accepted them. On errors it backs off exponentially.
+#	Spooled samples survive outages and reboots.
+#
+#	The spooled samples are sent as one sens_batch payload to
+#	URL_BATCH. If the server does not know the batch endpoint
+#	(404/405/415/501) the worker falls back to the legacy per sample
+#	form and probes the batch endpoint again after PROBE_INTERVAL.
+#	The server may limit the batch size by a 'X-Batch-Max' header,
+#	on 413 the batch size is halved. A batch rejected otherwise (4xx)
+#	is sent again sample by sample, so only the rejected sample is
+#	lost; the next batches go to URL_BATCH as before.
+#====================================================================#
+
+class uploader:
+
+    URL       = "https://jebaxxmonitor.appspot.com/postData"
+    URL_BATCH = "https://jebaxxmonitor.appspot.com/postBatch"
+    SPOOL_DIR = "/home/pi/projects/monitor_project/spool"
+
+    TIMEOUT   = (5, 20)		# (connect, read) sec
+    BATCH     = 30		# samples sent in a row (legacy form) before checking for new ones
+    BATCH_MAX = 60 * 24		# samples in one batch payload
+    MAX_SPOOL = 60 * 24 * 7	# keep at most a week of samples
+    BACKOFF_MIN = 5.0
+    BACKOFF_MAX = 600.0
+    PROBE_INTERVAL = 6 * 3600	# retry the batch endpoint after a fallback
+    REJECTED  = 'rejected'	# _send_batch(): the server refused the batch (4xx)
+
+    _session = None
+    _event = None
+    _th = None
+    _seq = 0
+    _backoff = 0
+    _batch_ok = True		# False: the server does not support the batch endpoint
+    _t_probe = 0		# time of the fallback to the legacy form
+
+    # metrics
+    _m_post = metrics.histogram('monitor_upload_seconds', 'POST to the server (connection errors included)')
+    _m_result = { 'ok'       : metrics.counter('monitor_upload_requests_total', 'POST requests by result', result = 'ok'),
+		  'rejected' : metrics.counter('monitor_upload_requests_total', 'POST requests by result', result = 'rejected'),
+		  'retry'    : metrics.counter('monitor_upload_requests_total', 'POST requests by result', result = 'retry'),
+		  'error'    : metrics.counter('monitor_upload_requests_total', 'POST requests by result', result = 'error') }
+    _m_samples = metrics.counter('monitor_upload_samples_total', 'samples removed from the spool (sent or rejected)')
+
+    @staticmethod
+    def init(url = None, spool_dir = None, url_batch = None):
+	if url is not None: uploader.URL = url
+	if url_batch is not None: uploader.URL_BATCH = url_batch
+	if spool_dir is not None: uploader.SPOOL_DIR = spool_dir
+	if not os.path.isdir(uploader.SPOOL_DIR):
+	    os.makedirs(uploader.SPOOL_DIR)
+	metrics.func('monitor_upload_spooled', 'gauge', lambda: len(uploader.spooled()), 'samples waiting in the spool')
+
+	uploader._event = threading.Event()
+	uploader._th = threading.Thread(target = uploader.worker)
+	uploader._th.setDaemon(True)
+	uploader._th.start()
+
+    #
+    #  store a sample (dict) to the spool (called from the main loop)
+    #
+    @staticmethod
+    def put(sample):
+	uploader._seq = (uploader._seq + 1) % 1000
+	name = "%014.3f-%03d" % (time.time(), uploader._seq)
+	path = os.path.join(uploader.SPOOL_DIR, name)
+	with open(path + '.tmp', 'w') as f:
+	    json.dump(sample, f)
+	os.rename(path + '.tmp', path + '.json')
+	uploader._event.set()
+
+    @staticmethod
+    def spooled():
+	files = [x for x in os.listdir(uploader.SPOOL_DIR) if x.endswith('.json')]
+	files.sort()
+	return files
+
+    @staticmethod
+    def _trim(files):
+	logger = logging.getLogger(__name__)
+	while len(files) > uploader.MAX_SPOOL:
+	    logger.warning("spool full: drop " + files[0])
+	    os.remove(os.path.join(uploader.SPOOL_DIR, files.pop(0)))
+
+    #
+    #  POST -> response, or None on a connection error
+    #
+    @staticmethod
+    def _post(url, **kwargs):
+	import requests
+	logger = logging.getLogger(__name__)
+
+	if uploader._session is None:
+	    uploader._session = requests.Session()
+
+	t = time.time()
+	try:
+	    response = uploader._session.post(url, timeout = uploader.TIMEOUT, **kwargs)
+	except (EnvironmentError, requests.exceptions.RequestException) as e:
+	    uploader._m_post.observe(time.time() - t)
+	    uploader._m_result['error'].inc()
+	    logger.warning("connection error: " + str(e))
+	    uploader._session.close()
+	    uploader._session = None
+	    return None
+
+	uploader._m_post.observe(time.time() - t)
+	if uploader._retriable(response):	uploader._m_result['retry'].inc()
+	elif response.status_code >= 400:	uploader._m_result['rejected'].inc()
+	else:					uploader._m_result['ok'].inc()
+	logger.debug("response.code = %d" % response.status_code)
+	return response
+
+    @staticmethod
+    def _retriable(response):
+	return response is None or response.status_code >= 500 or response.status_code in (408, 429)
+
+    #
+    #  post one sample (legacy form) -> True: done (sent or rejected), False: retry later
+    #
+    @staticmethod
+    def _send(sample):
+	logger = logging.getLogger(__name__)
+
+	params = dict([("sensData[%s]" % k, v) for k, v in sample.items()])
+	response = uploader._post(uploader.URL, data = params)
+	if uploader._retriable(response):
+	    return False
+	if response.status_code >= 400:
+	    logger.error("sample rejected (%d): %s" % (response.status_code, str(sample)))
+	return True
+
+    #
+    #  post samples as one batch -> True: done, False: retry later,
+    #  None: not supported, REJECTED: send this batch in the legacy form
+    #
+    @staticmethod
+    def _send_batch(samples):
+	logger = logging.getLogger(__name__)
+
+	headers = { 'Content-Type' : sens_batch.CONTENT_TYPE }
+	response = uploader._post(uploader.URL_BATCH, data = sens_batch.encode(samples), headers = headers)
+	if response is not None and response.status_code in (404, 405, 415, 501):
+	    return None
+	if uploader._retriable(response):
+	    return False
+
+	n = response.headers.get('X-Batch-Max')
+	if n is not None and n.isdigit() and int(n) > 0:
+	    uploader.BATCH_MAX = int(n)
+	if response.status_code == 413 and len(samples) > 1:
+	    uploader.BATCH_MAX = min(uploader.BATCH_MAX, len(samples) // 2)
+	    logger.warning("batch too large (%d samples): %d samples per batch" % (len(samples), uploader.BATCH_MAX))
+	    return False
+	if response.status_code >= 400:
+	    logger.error("batch rejected (%d): %d samples" % (response.status_code, len(samples)))
+	    return uploader.REJECTED
+	return True
+
+    @staticmethod
+    def _load(files):
+	logger = logging.getLogger(__name__)
+	loaded = []
+	for name in files:
+	    path = os.path.join(uploader.SPOOL_DIR, name)
+	    try:
+		with open(path) as f:
+		    loaded.append((path, json.load(f)))
+	    except ValueError:
+		logger.error("broken spool file: " + name)
+		os.remove(path)
+	    except EnvironmentError as e:
+		logger.error("cannot read spool file: %s (%s)" % (name, str(e)))
+	return loaded
+
+    @staticmethod
+    def _failed(n):
+	logger = logging.getLogger(__name__)
+	uploader._backoff = min(max(uploader._backoff * 2, uploader.BACKOFF_MIN), uploader.BACKOFF_MAX)
+	logger.warning("upload failed: retry after %d sec (%d spooled)" % (uploader._backoff, n))
+	time.sleep(uploader._backoff)
+
+    @staticmethod
+    def _send_each(loaded, n):
+	# legacy form, stops at the first failure (n: spooled samples)
+	for path, sample in loaded:
+	    if not uploader._send(sample):
+		uploader._failed(n)
+		return
+	    uploader._backoff = 0
+	    os.remove(path)
+	    uploader._m_samples.inc()
+
+    @staticmethod
+    def worker():
+	logger = logging.getLogger(__name__)
+
+	while True:
+	    files = []
+	    try:
+		files = uploader.spooled()
+		if not files:
+		    uploader._event.wait()
+		    uploader._event.clear()
+		    continue
+
+		uploader._trim(files)
+
+		if not uploader._batch_ok and time.time() - uploader._t_probe > uploader.PROBE_INTERVAL:
+		    uploader._batch_ok = True
+
+		if uploader._batch_ok:
+		    loaded = uploader._load(files[:uploader.BATCH_MAX])
+		    if not loaded:
+			uploader._failed(len(files))		# none readable: do not spin on them
+			continue
+		    result = uploader._send_batch([x[1] for x in loaded])
+		    if result is None:
+			logger.warning("batch upload is not supported: fall back to the legacy form")
+			uploader._batch_ok = False
+			uploader._t_probe = time.time()
+		    elif result == uploader.REJECTED:
+			# one sample at a time loses only the rejected one
+			uploader._send_each(loaded, len(files))
+			continue
+		    elif result:
+			uploader._backoff = 0
+			for path, sample in loaded:
+			    os.remove(path)
+			uploader._m_samples.inc(len(loaded))
+			continue
+		    else:
+			if len(loaded) > uploader.BATCH_MAX: continue	# 413: at once in smaller batches
+			uploader._failed(len(files))
+			continue
+
+		uploader._send_each(uploader._load(files[:uploader.BATCH]), len(files))
+	    except Exception:
+		# keep the thread alive: uploads would stop until a restart
+		logger.exception("upload worker")
+		uploader._failed(len(files))
+
+######################################################################
+#  scheduler (replaces the 250 ms polling main loops)
+#
+#	timers are kept in a heap ordered by monotonic deadline and the
+#	main thread sleeps in select() exactly until the next one.
+#	Other threads (GPIO callbacks, fifo listener) may add or cancel
+#	timers; they wake the sleeping main thread through a self-pipe.
+#
+#	Wall clock timers (call_at, every_minute) are checked against
+#	time.time() when they come due, so they stay aligned to the
+#	minute even if NTP steps the clock.
+#====================================================================#
+
+def _monotonic_source():
+    if hasattr(time, 'monotonic'): return time.monotonic
+    try:
+	import ctypes, ctypes.util
+
+	class timespec(ctypes.Structure):
+	    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+	librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno = True)
+	clock_gettime = librt.clock_gettime
+	clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+	ts = timespec()
+	def monotonic():
+	    clock_gettime(1, ctypes.byref(ts))		# CLOCK_MONOTONIC
+	    return ts.tv_sec + ts.tv_nsec * 1e-9
+	monotonic()
+	return monotonic
+    except (OSError, AttributeError):
+	return time.time
+
+monotonic = _monotonic_source()
+
+#
+#  injectable clock
+#
+#	every timing decision of the daemons goes through clock, so a
+#	simulation can replace the real clock with a virtual one that
+#	only advances by advance() / sleep().
+#
+def _cpu_source():
+    if hasattr(time, 'process_time'): return time.process_time
+    return time.clock
+
+cpu_time = _cpu_source()		# CPU time of this process
+
+class clock:
+
+    _virtual = None		# virtual monotonic time (None: real clock)
+    _base = 0.0			# wall clock at virtual monotonic time 0
+
+    @staticmethod
+    def time():
+	if clock._virtual is None: return time.time()
+	return clock._base + clock._virtual
+
+    @staticmethod
+    def monotonic():
+	if clock._virtual is None: return monotonic()
+	return clock._virtual
+
+    @staticmethod
+    def now():
+	return datetime.fromtimestamp(clock.time())
+
+    @staticmethod
+    def sleep(sec):
+	if clock._virtual is None: time.sleep(sec)
+	else:			   clock._virtual += max(0, sec)
+
+    #
+    #  simulation
+    #
+    @staticmethod
+    def set_virtual(wall):
+	clock._virtual = 0.0
+	clock._base = wall
+
+    @staticmethod
+    def advance(sec):
+	clock._virtual += max(0, sec)
+
+    @staticmethod
+    def is_virtual():
+	return clock._virtual is not None
+
+class sched_timer:
+
+    def __init__(self, func, args, interval = None, wall = None, offset = None):
+	self.func = func
+	self.args = args
+	self.interval = interval	# periodic timer (sec)
+	self.wall = wall		# wall clock deadline (clock.time())
+	self.offset = offset		# every_minute: sec from the minute boundary
+	self.deadline = None		# monotonic deadline
+	self.active = True
+
+class sched:
+
+    WALL_RECHECK = 60.0		# max sleep while wall clock timers are pending
+
+    _heap = []
+    _seq = 0
+    _lock = threading.RLock()
+    _wake_r = None
+    _wake_w = None
+    _thread = None		# thread running run()
+    _running = False
+    _readers = {}		# fd -> func(fd), called by run() when readable
+    _writers = {}		# fd -> func(fd), called by run() when writable
+
+    _profile = None		# _profile(func, cpu_sec) is called after each timer (simulation)
+    _job_metrics = {}		# function -> (lateness, run time) histograms
+
+    @staticmethod
+    def init():
+	if sched._wake_r is None:
+	    sched._wake_r, sched._wake_w = os.pipe()
+
+    @staticmethod
+    def _push(timer):
+	with sched._lock:
+	    sched._seq += 1
+	    heapq.heappush(sched._heap, (timer.deadline, sched._seq, timer))
+	    first = sched._heap[0][2] is timer
+	if first: sched._wake()
+	return timer
+
+    @staticmethod
+    def _wake():
+	# let run() recompute its select() arguments
+	if sched._running and threading.current_thread() is not sched._thread:
+	    os.write(sched._wake_w, 'x')
+
+    @staticmethod
+    def _wall_deadline(timer):
+	# monotonic deadline of a wall clock target (never later than WALL_RECHECK)
+	return clock.monotonic() + max(0, min(timer.wall - clock.time(), sched.WALL_RECHECK))
+
+    #
+    #  PUBLIC METHODS
+    #
+    @staticmethod
+    def call_later(delay, func, *args):
+	timer = sched_timer(func, args)
+	timer.deadline = clock.monotonic() + max(0, delay)
+	return sched._push(timer)
+
+    @staticmethod
+    def call_soon(func, *args):
+	return sched.call_later(0, func, *args)
+
+    @staticmethod
+    def call_at(wall, func, *args):
+	timer = sched_timer(func, args, wall = wall)
+	timer.deadline = sched._wall_deadline(timer)
+	return sched._push(timer)
+
+    @staticmethod
+    def every(interval, func, *args):
+	timer = sched_timer(func, args, interval = interval)
+	timer.deadline = clock.monotonic() + interval
+	return sched._push(timer)
+
+    #
+    #  every minute at (minute boundary + offset), e.g. offset = -2 : hh:mm:58
+    #
+    @staticmethod
+    def every_minute(offset, func, *args):
+	timer = sched_timer(func, args, offset = offset)
+	timer.wall = sched._next_minute(offset, clock.time())
+	timer.deadline = sched._wall_deadline(timer)
+	return sched._push(timer)
+
+    @staticmethod
+    def _next_minute(offset, now):
+	# the first (boundary + offset) after now
+	return ((now - offset) // 60 + 1) * 60 + offset
+
+    @staticmethod
+    def set_profile(func):
+	sched._profile = None if func is None else staticmethod(func)
+
+    @staticmethod
+    def cancel(timer):
+	if timer is not None: timer.active = False
+
+    #
+    #  file descriptors served by the select() of run()
+    #
+    @staticmethod
+    def add_reader(fd, func):
+	with sched._lock:
+	    sched._readers[fd] = func
+	sched._wake()
+
+    @staticmethod
+    def remove_reader(fd):
+	with sched._lock:
+	    sched._readers.pop(fd, None)
+	sched._wake()
+
+    @staticmethod
+    def add_writer(fd, func):
+	with sched._lock:
+	    if sched._writers.get(fd) == func: return
+	    sched._writers[fd] = func
+	sched._wake()
+
+    @staticmethod
+    def remove_writer(fd):
+	with sched._lock:
+	    if sched._writers.pop(fd, None) is None: return
+	sched._wake()
+
+    @staticmethod
+    def _call(func, args):
+	logger = logging.getLogger(__name__)
+	try:
+	    if sched._profile is None:
+		func(*args)
+	    else:
+		t = cpu_time()
+		func(*args)
+		sched._profile(func, cpu_time() - t)
+	except Exception:
+	    logger.exception("sched: error in " + getattr(func, '__name__', str(func)))
+
+    @staticmethod
+    def _fire(timer):
+	sched._call(timer.func, timer.args)
+
+    @staticmethod
+    def _metrics(func):
+	key = getattr(func, 'im_func', func)
+	m = sched._job_metrics.get(key)
+	if m is None:
+	    name = metrics.name(func)
+	    m = sched._job_metrics[key] = (
+		metrics.histogram('monitor_sched_lateness_seconds', 'timer fired after its deadline', job = name),
+		metrics.histogram('monitor_sched_job_seconds', 'run time of sched jobs', job = name))
+	return m
+
+    @staticmethod
+    def run_once():
+	# run the due timers -> sec until the next deadline (None: no timer)
+	while True:
+	    with sched._lock:
+		if not sched._heap: return None
+		deadline, seq, timer = sched._heap[0]
+		if not timer.active:
+		    heapq.heappop(sched._heap)
+		    continue
+		now = clock.monotonic()
+		if deadline > now: return deadline - now
+		heapq.heappop(sched._heap)
+
+	    if timer.wall is not None:
+		wall_now = clock.time()
+		if wall_now < timer.wall - 0.001:
+		    # not yet by the wall clock (long wait or clock stepped back)
+		    timer.deadline = sched._wall_deadline(timer)
+		    sched._push(timer)
+		    continue
+
+	    if timer.offset is not None:
+		# within the tolerance wall_now may be short of timer.wall: not the same minute again
+		timer.wall = sched._next_minute(timer.offset, max(wall_now, timer.wall))
+		timer.deadline = sched._wall_deadline(timer)
+		sched._push(timer)
+	    elif timer.interval is not None:
+		timer.deadline = max(deadline + timer.interval, now)
+		sched._push(timer)
+	    else:
+		timer.active = False
+
+	    late, run = sched._metrics(timer.func)
+	    late.observe(now - deadline)
+	    t = time.time()
+	    sched._fire(timer)
+	    run.observe(time.time() - t)
+
+    @staticmethod
+    def run():
+	sched._thread = threading.current_thread()
+	sched._running = True
+	while sched._running:
+	    timeout = sched.run_once()
+	    if not sched._running: break
+	    with sched._lock:
+		rl = [sched._wake_r] + sched._readers.keys()
+		wl = sched._writers.keys()
+	    r, w, x = select.select(rl, wl, [], timeout)
+	    for fd in r:
+		if fd == sched._wake_r:
+		    os.read(sched._wake_r, 4096)
+		else:
+		    func = sched._readers.get(fd)
+		    if func is not None: sched._call(func, (fd,))
+	    for fd in w:
+		func = sched._writers.get(fd)
+		if func is not None: sched._call(func, (fd,))
+
+    #
+    #  run the timers until the (virtual) monotonic time t (simulation)
+    #
+    @staticmethod
+    def run_until(t):
+	while True:
+	    timeout = sched.run_once()
+	    now = clock.monotonic()
+	    if timeout is None or now + timeout > t:
+		if t > now: clock.advance(t - now)
+		return
+	    clock.advance(timeout)
+
+    @staticmethod
+    def stop():
+	sched._running = False
+	if sched._wake_w is not None: os.write(sched._wake_w, 'x')
+
+######################################################################
+#  key input (debounce, long press / auto repeat)
+#
+#	capture() is called by the interrupt of the key device in any
+#	thread: it only reads the keys and appends (ts, keys) to a deque
+#	(append / popleft are atomic, no lock). The events are handled by
+#	the sched thread: a key state counts when it has been stable for
+#	DEBOUNCE, on_press(keys, 0) gets the newly pressed keys. While
+#	keys are held they are read again every REPEAT_DELAY (a lost
+#	release interrupt would block the next press of the same key),
+#	and if repeatable(keys) on_press(keys, n) is called with an
+#	interval that shrinks by REPEAT_FACTOR down to REPEAT_MIN.
+#====================================================================#
+
+class key_input:
+
+    DEBOUNCE = 0.02
+    REPEAT_DELAY = 0.5
+    REPEAT_FIRST = 0.25
+    REPEAT_MIN = 0.05
+    REPEAT_FACTOR = 0.8
+
+    def __init__(self, read, on_press, repeatable = None):
+	self.read = read		# read() -> bits of the pressed keys
+	self.on_press = on_press	# on_press(keys, repeat count)
+	self.repeatable = repeatable or (lambda keys: False)
+	self._events = deque()		# (clock.monotonic(), keys)
+	self._posted = False		# a _dispatch is scheduled
+	self._last = None		# the latest event
+	self._state = 0			# debounced keys
+	self._timer = None		# _settle / _held
+	self._repeat = 0
+
+    def capture(self):
+	keys = self.read()
+	self._events.append((clock.monotonic(), keys))
+	if not self._posted:
+	    self._posted = True
+	    sched.call_soon(self._dispatch)
+	return keys
+
+    def _dispatch(self):
+	self._posted = False
+	if not self._events: return
+	while self._events:
+	    self._last = self._events.popleft()
+
+	# wait until the keys are stable (also stops a repeat)
+	sched.cancel(self._timer)
+	self._timer = sched.call_later(self._last[0] + self.DEBOUNCE - clock.monotonic(), self._settle)
+
+    def _settle(self):
+	keys = self._last[1]
+	pressed = keys & ~self._state
+	self._state = keys
+	self._repeat = 0
+	self._timer = None
+	if keys: self._timer = sched.call_later(self.REPEAT_DELAY, self._held)
+	if pressed: self.on_press(pressed, 0)
+
+    def _held(self):
+	self._timer = None
+	keys = self.read()
+	if keys != self._state:
+	    # the interrupt of the change is lost or not handled yet
+	    self._events.append((clock.monotonic(), keys))
+	    self._dispatch()
+	    return
+
+	if not self.repeatable(keys):
+	    self._timer = sched.call_later(self.REPEAT_DELAY, self._held)
+	    return
+
+	self._repeat += 1
+	self._timer = sched.call_later(max(self.REPEAT_MIN, self.REPEAT_FIRST * self.REPEAT_FACTOR ** (self._repeat - 1)), self._held)
+	self.on_press(keys, self._repeat)
+
+######################################################################
+#  render cache
+#
+#	texts of the screens by a key that holds only what the text
+#	shows (form, minute / quantised reading), so a redraw is a
+#	dictionary lookup. Cleared when MAX keys are reached.
+#====================================================================#
+
+class render_cache:
+
+    MAX = 256
+
+    def __init__(self, render):
+	self.render = render		# render(*key) -> str
+	self._texts = {}
+	self.hits = 0
+	self.misses = 0
+
+    def get(self, key):
+	text = self._texts.get(key)
+	if text is not None:
+	    self.hits += 1
+	    return text
+
+	self.misses += 1
+	if len(self._texts) >= self.MAX: self._texts.clear()
+	text = self._texts[key] = self.render(*key)
+	return text
+
+######################################################################
+#  alarm queue
+#
+#	binary heap of [fire time, name] with the index of every name
+#	in the heap, so set (insert / reschedule) and remove are
+#	O(log n) sift operations and the next alarm is heap[0].
+#====================================================================#
+
+class alarm_queue:
+
+    def __init__(self):
+	self._heap = []			# [[ts, name], ...]
+	self._pos  = {}			# name -> index in _heap
+
+    def __len__(self):
+	return len(self._heap)
+
+    def __contains__(self, name):
+	return name in self._pos
+
+    def get(self, name):
+	i = self._pos.get(name)
+	return None if i is None else self._heap[i][0]
+
+    def _swap(self, i, j):
+	h = self._heap
+	h[i], h[j] = h[j], h[i]
+	self._pos[h[i][1]] = i
+	self._pos[h[j][1]] = j
+
+    def _up(self, i):
+	h = self._heap
+	while i > 0:
+	    parent = (i - 1) // 2
+	    if h[parent] <= h[i]: break
+	    self._swap(i, parent)
+	    i = parent
+
+    def _down(self, i):
+	h = self._heap
+	n = len(h)
+	while True:
+	    child = 2 * i + 1
+	    if child >= n: break
+	    if child + 1 < n and h[child + 1] < h[child]: child += 1
+	    if h[i] <= h[child]: break
+	    self._swap(i, child)
+	    i = child
+
+    def set(self, name, ts):
+	i = self._pos.get(name)
+	if i is None:
+	    self._heap.append([ts, name])
+	    i = self._pos[name] = len(self._heap) - 1
+	else:
+	    self._heap[i][0] = ts
+	    self._down(i)
+	self._up(i)
+
+    def remove(self, name):
+	i = self._pos.pop(name, None)
+	if i is None: return None
+	h = self._heap
+	ts = h[i][0]
+	last = h.pop()
+	if i < len(h):
+	    h[i] = last
+	    self._pos[last[1]] = i
+	    self._down(i)
+	    self._up(i)
+	return ts
+
+    def peek(self):
+	# -> (ts, name) of the next alarm or None
+	if not self._heap: return None
+	return tuple(self._heap[0])
+
+    def first(self, k):
+	# the next k alarms [(ts, name), ...] in O(k log k)
+	h = self._heap
+	res = []
+	front = [(h[0], 0)] if h else []
+	while front and len(res) < k:
+	    item, i = heapq.heappop(front)
+	    res.append(tuple(item))
+	    for c in (2 * i + 1, 2 * i + 2):
+		if c < len(h): heapq.heappush(front, (h[c], c))
+	return res
+
+######################################################################
+#  holiday calendar
+#
+#	Holidays are read from text files (national list + custom list):
+#
+#	  2026-01-01 New Year	    a holiday (the rest of the line is a comment)
+#	  -2026-12-28		    a working day (even on a weekend)
+#	  # comment
+#
+#	Per year every day class is a bitmap (bit i: day i of the year):
+#	weekday 0..6, 'workday' and 'holiday' (Saturday, Sunday and the
+#	listed days). The bitmaps are built once per year and kind, so
+#	the next day of a recurrence is a bit scan.
+#====================================================================#
+
+class holiday_cal:
+
+    PATHS = ("/home/pi/projects/monitor_project/holidays.txt",
+	     "/home/pi/projects/monitor_project/holidays_custom.txt")
+    YEARS = 8			# next_day() looks this many years ahead
+
+    _listed = {}		# year -> bitmap of listed holidays
+    _working = {}		# year -> bitmap of listed working days
+    _masks = {}			# (kind, year, skip) -> bitmap
+
+    @staticmethod
+    def load(paths = None):
+	logger = logging.getLogger(__name__)
+	holiday_cal._listed = {}
+	holiday_cal._working = {}
+	holiday_cal._masks = {}
+	for path in paths or holiday_cal.PATHS:
+	    try:
+		f = open(path)
+	    except IOError:
+		logger.info("no holiday file: " + path)
+		continue
+	    with f:
+		for line in f:
+		    words = line.split()
+		    if not words or words[0].startswith('#'): continue
+		    d = words[0]
+		    table = holiday_cal._listed
+		    if d.startswith('-'):
+			d = d[1:]
+			table = holiday_cal._working
+		    try:
+			d = date(*[int(x) for x in d.split('-')])
+		    except (ValueError, TypeError):
+			logger.warning("holiday file %s: bad line %r" % (path, line))
+			continue
+		    table[d.year] = table.get(d.year, 0) | (1 << holiday_cal._index(d))
+
+    @staticmethod
+    def _index(d):
+	return d.toordinal() - date(d.year, 1, 1).toordinal()
+
+    @staticmethod
+    def _days(year):
+	return date(year + 1, 1, 1).toordinal() - date(year, 1, 1).toordinal()
+
+    #
+    #  bitmap of a day class: weekday 0 (mon) .. 6 (sun), 'workday', 'holiday'
+    #  minus the dates in skip (a frozenset)
+    #
+    @staticmethod
+    def mask(kind, year, skip = None):
+	key = (kind, year, skip)
+	m = holiday_cal._masks.get(key)
+	if m is not None: return m
+
+	if skip:
+	    m = holiday_cal.mask(kind, year)
+	    for d in skip:
+		if d.year == year: m &= ~(1 << holiday_cal._index(d))
+	elif kind == 'holiday':
+	    m = holiday_cal.mask(5, year) | holiday_cal.mask(6, year) | holiday_cal._listed.get(year, 0)
+	    m &= ~holiday_cal._working.get(year, 0)
+	elif kind == 'workday':
+	    m = ((1 << holiday_cal._days(year)) - 1) & ~holiday_cal.mask('holiday', year)
+	else:
+	    first = (kind - date(year, 1, 1).weekday()) % 7
+	    m = 0
+	    for i in range(first, holiday_cal._days(year), 7):
+		m |= 1 << i
+
+	holiday_cal._masks[key] = m
+	return m
+
+    @staticmethod
+    def is_holiday(d):
+	return bool(holiday_cal.mask('holiday', d.year) >> holiday_cal._index(d) & 1)
+
+    #
+    #  the first day >= d of the day class (None: not within YEARS)
+    #
+    @staticmethod
+    def next_day(kind, d, skip = None):
+	i = holiday_cal._index(d)
+	for year in range(d.year, d.year + holiday_cal.YEARS):
+	    m = holiday_cal.mask(kind, year, skip) >> i
+	    if m:
+		i += (m & -m).bit_length() - 1
+		return date.fromordinal(date(year, 1, 1).toordinal() + i)
+	    i = 0
+	return None
+
+######################################################################
+#  alarm sound player
+#
+#	The sounds are decoded once (DECODER: raw 16 bit PCM on stdout)
+#	into PCM strings in memory, at most MAX_SEC each: an alarm rings
+#	60 sec and then snoozes. The decoder resamples to RATE and
+#	CHANNELS, the format the sink is opened with, whatever the file
+#	has (a mono or 22.05 kHz file would play too fast otherwise).
+#	A worker thread waits for play() and writes CHUNK frames at a
+#	time to a sink which is already open:
+#
+#	  aplay_sink : a long-lived aplay process reading from a pipe
+#	  null_sink  : takes the samples in real time (benchmarks, tests)
+#
+#	so a trigger costs no process start and no decode. The volume
+#	fades in over fade_in sec; stop() fades out over FADE_OUT sec to
+#	avoid a click. The sounds are decoded in the worker thread: play()
+#	returns False for a sound not decoded (yet, or failed), so the
+#	caller can use another player meanwhile.
+#====================================================================#
+
+class aplay_sink:
+
+    CMD = ['/usr/bin/aplay', '-q', '-t', 'raw', '-f', 'S16_LE']
+
+    def __init__(self, rate, channels):
+	self.cmd = aplay_sink.CMD + ['-r', str(rate), '-c', str(channels)]
+	self._proc = None
+
+    def open(self):
+	if self._proc is not None and self._proc.poll() is None: return True
+	try:
+	    with open(os.devnull, 'w') as null:
+		self._proc = subprocess.Popen(self.cmd, stdin = subprocess.PIPE, stderr = null)
+	except EnvironmentError:
+	    logging.getLogger(__name__).error("aplay_sink: cannot start " + self.cmd[0])
+	    self._proc = None
+	    return False
+	return True
+
+    def write(self, data):
+	if not self.open(): return
+	try:
+	    self._proc.stdin.write(data)
+	except IOError:
+	    self._proc = None			# aplay has gone: restarted by the next write
+
+    def flush(self):
+	if self._proc is not None:
+	    try:
+		self._proc.stdin.flush()
+	    except IOError:
+		self._proc = None
+
+class null_sink:
+
+    def __init__(self, rate, frame_size, realtime = True):
+	self.rate = rate
+	self.frame_size = frame_size
+	self.realtime = realtime
+	self.reset()
+
+    def reset(self):
+	self.first_write = None		# time.time() of the first write after reset()
+	self.bytes = 0
+
+    def open(self):
+	return True
+
+    def write(self, data):
+	if self.first_write is None: self.first_write = time.time()
+	self.bytes += len(data)
+	if self.realtime: time.sleep(len(data) / float(self.frame_size * self.rate))
+
+    def flush(self):
+	pass
+
+class audio_player:
+
+    DECODER  = ['/usr/bin/mpg123', '-q', '-s']	# + output format options of decode()
+    RATE     = 44100
+    CHANNELS = 2
+    WIDTH    = 2			# bytes per sample
+    MAX_SEC  = 60			# decoded length per sound
+    CHUNK    = 1024			# frames per write (23 ms)
+    FADE_OUT = 0.05
+
+    _sink   = None
+    _sounds = {}			# name -> PCM string
+    _thread = None
+    _event  = threading.Event()
+    _lock   = threading.Lock()
+    _gen    = 0				# play() / stop() counter: a playback runs while it is unchanged
+    _req    = None			# (gen, name, volume, fade_in, loop)
+
+    @staticmethod
+    def init(sink = None, sounds = {}):
+	audio_player._sink = sink or aplay_sink(audio_player.RATE, audio_player.CHANNELS)
+	audio_player._sink.open()
+	audio_player._thread = threading.Thread(target = audio_player._run, args = (dict(sounds),))
+	audio_player._thread.setDaemon(True)
+	audio_player._thread.start()
+
+    @staticmethod
+    def decode(path):
+	# PCM of the first MAX_SEC of path (None: failed)
+	logger = logging.getLogger(__name__)
+	limit = audio_player.MAX_SEC * audio_player.RATE * audio_player.CHANNELS * audio_player.WIDTH
+	fmt = ['-r', str(audio_player.RATE), ('--mono', '--stereo')[audio_player.CHANNELS == 2]]
+	try:
+	    with open(os.devnull, 'w') as null:
+		proc = subprocess.Popen(audio_player.DECODER + fmt + [path], stdout = subprocess.PIPE, stderr = null)
+	except EnvironmentError:
+	    logger.error("audio_player: cannot start " + audio_player.DECODER[0])
+	    return None
+	pcm = proc.stdout.read(limit)
+	if proc.poll() is None: proc.terminate()
+	proc.wait()
+	if not pcm: logger.error("audio_player: cannot decode " + path)
+	return pcm or None
+
+    @staticmethod
+    def add(name, pcm):
+	audio_player._sounds[name] = pcm
+
+    @staticmethod
+    def loaded(name):
+	return name in audio_player._sounds
+
+    #
+    #  start / stop (from any thread)
+    #
+    @staticmethod
+    def play(name, volume = 1.0, fade_in = 0.0, loop = True):
+	if not audio_player.loaded(name): return False
+	with audio_player._lock:
+	    audio_player._gen += 1
+	    audio_player._req = (audio_player._gen, name, volume, fade_in, loop)
+	audio_player._event.set()
+	return True
+
+    @staticmethod
+    def stop():
+	with audio_player._lock:
+	    audio_player._gen += 1
+	    audio_player._req = None
+
+    @staticmethod
+    def is_playing():
+	req = audio_player._req
+	return req is not None and req[0] == audio_player._gen
+
+    #
+    #  worker thread
+    #
+    @staticmethod
+    def _run(sounds):
+	for name, path in sounds.items():
+	    pcm = audio_player.decode(path)
+	    if pcm is not None: audio_player.add(name, pcm)
+
+	while True:
+	    audio_player._event.wait()
+	    audio_player._event.clear()
+	    req = audio_player._req
+	    if req is None: continue
+	    audio_player._play(*req)
+	    with audio_player._lock:
+		if audio_player._gen == req[0]: audio_player._req = None	# played to the end (loop = False)
+
+    @staticmethod
+    def _play(gen, name, volume, fade_in, loop):
+	pcm = audio_player._sounds.get(name)
+	if not pcm: return
+	sink = audio_player._sink
+	frame = audio_player.CHANNELS * audio_player.WIDTH
+	step = audio_player.CHUNK * frame
+	fade = max(1, int(fade_in * audio_player.RATE))
+	pos = 0
+	played = 0				# frames
+	while audio_player._gen == gen:
+	    if pos >= len(pcm):
+		if not loop: break
+		pos = 0
+	    chunk = pcm[pos:pos + step]
+	    pos += len(chunk)
+	    gain = volume * min(1.0, played / float(fade))
+	    if gain != 1.0: chunk = audioop.mul(chunk, audio_player.WIDTH, gain)
+	    sink.write(chunk)
+	    played += len(chunk) // frame
+
+	# fade out from the current gain
+	n = int(audio_player.FADE_OUT * audio_player.RATE) * frame
+	tail = pcm[pos:pos + n]
+	pieces = 4
+	size = len(tail) // pieces // frame * frame
+	gain = volume * min(1.0, played / float(fade))
+	for k in range(pieces):
+	    sink.write(audioop.mul(tail[k * size:(k + 1) * size], audio_player.WIDTH, gain * (pieces - 1 - k) / pieces))
+	sink.flush()
+
+######################################################################
+#  event trace (input of monitorSim)
+#
+#	one line per event:  <clock.time()>,<kind>[,<value>...]
+#
+#	  pir			PIR sensor rising edge
+#	  key,<mask>		button state read by d_m.button_callback
+#	  sht,<temp>,<hum>	SHT-31 measurement
+#	  cpu,<temp>		CPU temperature
+#
+#	Both daemons may append to the same file (one write per line).
+#====================================================================#
+
+class trace:
+
+    _f = None
+
+    @staticmethod
+    def open(path):
+	if path: trace._f = open(path, 'a')
+
+    @staticmethod
+    def record(kind, *values):
+	if trace._f is None: return
+	trace._f.write(','.join(['%.3f' % clock.time(), kind] + [str(v) for v in values]) + '\n')
+	trace._f.flush()
+
+    #
+    #  -> [(ts, kind, [value, ...]), ...] sorted by ts
+    #
+    @staticmethod
+    def load(path):
+	events = []
+	with open(path) as f:
+	    for line in f:
+		line = line.strip()
+		if not line or line.startswith('#'): continue
+		x = line.split(',')
+		events.append((float(x[0]), x[1], x[2:]))
+	events.sort(key = lambda e: e[0])
+	return events
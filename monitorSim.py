@@ -0,0 +1,250 @@
+#!/usr/bin/python
+#
+#  simulation of monitorBase + monitorUI on a virtual clock
+#
+#	Both daemons run in this process with the fake smbus / RPi.GPIO
+#	modules in sim/ and replay an event trace (see monitorLib.trace)
+#	as fast as possible. A trace is recorded on the device by setting
+#	MONITOR_TRACE=<file> for both daemons, or generated by 'gen'.
+#
+#	usage:  python monitorSim.py gen [days] > trace.csv
+#		python monitorSim.py run trace.csv [--alarm] [--sht-rate=N]
+#
+#	  --alarm      : alarm1 (weekday 6:30) is ON
+#	  --sht-rate=N : SHT-31 periodic acquisition at N Hz (monitorBase.sht_rate)
+#
+import os
+import sys
+import time
+import math
+import random
+import inspect
+import tempfile
+import shutil
+import logging
+from datetime import datetime, timedelta
+from monitorLib import clock, sched, trace, uploader, sens_shm, cpu_time, i2c_bus, ipc_server, ipc_client, history, audio_player, metrics
+
+######################################################################
+#  synthetic trace
+#====================================================================#
+
+def gen(days = 7):
+    rnd = random.Random(1)
+    start = datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0) - timedelta(days = days)
+    t0 = time.mktime(start.timetuple())
+    events = []
+
+    for i in range(days * 24 * 6):
+	# temperature / humidity / cpu every 10 minutes
+	ts = t0 + i * 600
+	h = (i % 144) / 6.0
+	temp = 22 + 3 * math.sin(2 * math.pi * (h - 9) / 24) + rnd.uniform(-0.2, 0.2)
+	events.append((ts, 'sht', ['%.2f' % temp, '%.1f' % (55 - 2 * (temp - 22) + rnd.uniform(-1, 1))]))
+	events.append((ts, 'cpu', ['%.3f' % (45 + rnd.uniform(-3, 3))]))
+
+    for d in range(days):
+	day = start + timedelta(days = d)
+	t_day = time.mktime(day.timetuple())
+	weekday = day.weekday() < 5
+	active = [(6, 8), (18, 23)] if weekday else [(8, 23)]
+
+	# PIR: somebody is around now and then (bursts of edges)
+	for h0, h1 in active:
+	    ts = t_day + h0 * 3600
+	    while ts < t_day + h1 * 3600:
+		if rnd.random() < 0.6:
+		    for k in range(rnd.randint(2, 6)):
+			events.append((ts + k * rnd.uniform(1, 6), 'pir', []))
+		ts += rnd.uniform(60, 600)
+
+	# buttons: stop the weekday alarm (snooze, then 3 times the same key)
+	if weekday:
+	    events.append((t_day + 6 * 3600 + 30 * 60 + 20, 'key', ['2']))
+	    for k in range(3):
+		events.append((t_day + 6 * 3600 + 36 * 60 + k, 'key', ['4']))
+
+	# buttons: look around the screens in the evening
+	for k in range(4):
+	    events.append((t_day + 19 * 3600 + k * 30, 'key', ['1']))
+
+    events.sort(key = lambda e: e[0])
+    for ts, kind, values in events:
+	print ','.join(['%.3f' % ts, kind] + values)
+
+######################################################################
+#  replay
+#====================================================================#
+
+class sim:
+
+    prof = {}			# name -> [calls, cpu sec]
+    names = {}			# function -> name
+    uploads = []		# clock.time() of postToGAE
+    alarms = []			# (clock.time(), alarm name)
+    display = []		# (clock.time(), on/off) of monitorBase ld.display_sw
+
+    @staticmethod
+    def collect_names(*mods):
+	for mod in mods:
+	    for k, v in vars(mod).items():
+		if inspect.isfunction(v) and v.__module__ == mod.__name__:
+		    sim.names[v] = mod.__name__ + '.' + k
+		elif inspect.isclass(v) and v.__module__ == mod.__name__:
+		    for k2, v2 in vars(v).items():
+			if isinstance(v2, staticmethod):
+			    sim.names[v2.__get__(None, v)] = mod.__name__ + '.' + k + '.' + k2
+
+    @staticmethod
+    def profile(func, cpu):
+	name = sim.names.get(func)
+	if name is None:
+	    name = getattr(func, '__name__', str(func))
+	    if hasattr(func, 'im_class'): name = func.im_class.__name__ + '.' + name	# method of an instance
+	p = sim.prof.setdefault(name, [0, 0.0])
+	p[0] += 1
+	p[1] += cpu
+
+    @staticmethod
+    def fire(GPIO, port):
+	t = cpu_time()
+	GPIO.fire(port)
+	cpu = cpu_time() - t
+	for cb in GPIO._callbacks.get(port, []):
+	    sim.profile(cb, cpu)
+
+def run(path, alarm = False, sht_rate = 0):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim'))
+    import smbus
+    import RPi.GPIO as GPIO
+
+    events = trace.load(path)
+    base_ts = events[0][0] // 60 * 60
+    clock.set_virtual(base_ts)
+    tmp = tempfile.mkdtemp()
+    logging.basicConfig(level = logging.ERROR)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')		# no console output of the daemons
+    try:
+	import monitorBase as base
+	import monitorUI as ui
+
+	# no real files, processes or network
+	sens_shm.PATH = os.path.join(tmp, 'sens_shm')
+	history.DIR = os.path.join(tmp, 'history')
+	metrics.DIR = tmp
+	i2c_bus.LOCK_PATH = os.path.join(tmp, 'i2c.lock')
+	i2c_bus.PRIO_PATH = os.path.join(tmp, 'i2c.prio')
+	base.sens_file = os.path.join(tmp, 'sens_data.txt')
+	base.sht_rate = sht_rate
+	ipc_server.listen = staticmethod(lambda on_message, path = None: None)
+	ipc_server.broadcast = staticmethod(lambda msg: ui.d_m.on_message(msg))
+	ipc_client.connect = staticmethod(lambda on_message, on_connect = None, path = None: on_connect and on_connect())
+	cpu = [45.0]
+	base.get_cpu_thermal = lambda: cpu[0]
+	uploader.init = staticmethod(lambda *args, **kwargs: None)
+	uploader.put = staticmethod(lambda sample: sim.uploads.append(clock.time()))
+	display_sw = base.ld.display_sw
+	def _display_sw(sw):
+	    sim.display.append((clock.time(), sw))
+	    display_sw(sw)
+	base.ld.display_sw = staticmethod(_display_sw)
+
+	ui.c_m._conf_fname = os.path.join(tmp, 'conf.json')
+	ui.c_m._legacy_fname = os.path.join(tmp, 'conf.pickle')
+	if alarm: ui.c_m._b['alarm']['alarm1']['sw ']['value'] = 'ON'
+	ui.d_m.send_message = staticmethod(base.m_a.on_message)		# instead of the socket
+	ui.al_a.exec_player = staticmethod(lambda: sim.alarms.append((clock.time(), ui.al_a._recent_alarm)))
+	ui.al_a.stop_player = staticmethod(lambda: None)
+	audio_player.init = staticmethod(lambda *args, **kwargs: None)
+
+	sim.collect_names(base, ui)
+	sched.set_profile(sim.profile)
+
+	t_real = time.time()
+	c_real = cpu_time()
+	base.init()
+	sched.run_until(1)				# first measurement of monitorBase
+	ui.init()
+
+	for ts, kind, values in events:
+	    # sensor values are a state: set them before a measurement at the same time
+	    if kind in ('sht', 'cpu'): ts -= 1
+	    sched.run_until(ts - base_ts)
+
+	    if kind == 'pir':
+		sim.fire(GPIO, 10)
+	    elif kind == 'key':
+		smbus.keys = int(values[0])
+		sim.fire(GPIO, 27)
+		smbus.keys = 0
+	    elif kind == 'sht':
+		smbus.temp, smbus.hum = float(values[0]), float(values[1])
+	    elif kind == 'cpu':
+		cpu[0] = float(values[0])
+
+	sched.run_until(events[-1][0] + 60 - base_ts)
+	t_real = time.time() - t_real
+	c_real = cpu_time() - c_real
+    finally:
+	sys.stdout = stdout
+
+    report(base, ui, smbus, base_ts, t_real, c_real)
+    shutil.rmtree(tmp)
+
+def report(base, ui, smbus, base_ts, t_real, c_real):
+    span = clock.time() - base_ts
+    days = span / 86400.0
+    fmt = lambda ts: datetime.fromtimestamp(ts).strftime('%a %m/%d %H:%M:%S')
+
+    print "replayed %s .. %s (%.2f days) in %.1f sec (x%d), cpu %.1f sec" % (
+	fmt(base_ts), fmt(clock.time()), days, t_real, span / max(t_real, 1e-6), c_real)
+
+    print
+    print "-- CPU per module"
+    mods = {}
+    for name, (n, cpu) in sim.prof.items():
+	m = mods.setdefault('.'.join(name.split('.')[:2]), [0, 0.0])
+	m[0] += n
+	m[1] += cpu
+    for name, (n, cpu) in sorted(mods.items(), key = lambda x: -x[1][1]):
+	print "  %-28s %9d calls %9.1f ms %8.1f ms/day" % (name, n, cpu * 1000, cpu * 1000 / days)
+
+    print
+    print "-- CPU per job"
+    for name, (n, cpu) in sorted(sim.prof.items(), key = lambda x: -x[1][1]):
+	print "  %-36s %9d calls %9.1f ms %8.1f us/call" % (name, n, cpu * 1000, cpu * 1000000 / n)
+
+    print
+    print "-- I2C"
+    for daemon in (base, ui):
+	bus = getattr(daemon, '__i2c').bus
+	for addr, (n, b) in sorted(bus.stats.items()):
+	    print "  %-12s %-9s 0x%02x %9d trans %10d bytes %9.0f trans/day" % (
+		daemon.__name__, smbus.NAMES.get(addr, '?'), addr, n, b, n / days)
+
+    for line in i2c_bus.report():
+	print "  " + line
+
+    print
+    print "-- uploads: %d (%.0f/day)" % (len(sim.uploads), len(sim.uploads) / days)
+    print "-- history: " + ', '.join(['%d sec %d' % (f.period, len(f.query(0, 2 ** 32))) for f in history.files])
+    print "-- display on/off: %d switches" % len(sim.display)
+    print "-- metrics: %d lines exported" % len(metrics.text())
+    print "-- alarms: %d" % len(sim.alarms)
+    for ts, name in sim.alarms:
+	print "  %s %s" % (fmt(ts), name)
+
+######################################################################
+#  MAIN
+#====================================================================#
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'gen':
+	gen(int(sys.argv[2]) if len(sys.argv) > 2 else 7)
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'run':
+	rate = [float(a.split('=')[1]) for a in sys.argv[3:] if a.startswith('--sht-rate=')]
+	run(sys.argv[2], alarm = '--alarm' in sys.argv[3:], sht_rate = rate[-1] if rate else 0)
+    else:
+	print "usage: monitorSim.py gen [days] | run trace.csv [--alarm] [--sht-rate=N]"
@@ -12,6 +12,7 @@ from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
 from shutil import copyfile
+from monitorLib import sens_shm, sched, clock, trace, so1602, i2c_bus, ipc_client, history, alarm_queue, holiday_cal, audio_player, key_input, render_cache, metrics
 
 __i2c = None
 
@@ -102,117 +103,400 @@ class ld():
     cursor = 2		# cursor On/Off
     blink  = 1		# cursor blink sw
     #---------------------------------------------------------------------------------
+    COLS   = 16		# visible columns
+    DDRAM  = 40		# DDRAM columns per line
+    GAP    = 5		# unchanged cells cheaper to rewrite than a cursor move (ctrl, cmd, ctrl, addr: 4 bytes + a transfer)
+    BLOCK_MAX = 32	# SMBus block write limit
+    BLANK  = ord(' ')
+    CGRAM  = 8		# user defined characters (code 0..7, 5x8 dots)
+    CONTRAST = 0x38	# normal contrast (tr_m 'fade' goes down to 0 and back)
+    #---------------------------------------------------------------------------------
+
+    # framebuffer
+    #
+    #	screen modules write into _fb (a shadow of the DDRAM), flush() sends
+    #	only the changed cell runs. mode changes (double height, cursor) are
+    #	requested here and sent by flush() when they differ from the panel.
+
+    _fb    = None	# requested DDRAM contents  [line][col]
+    _panel = None	# DDRAM contents on the panel
+    _pos   = (0, 0)	# write position (and cursor position)
+    _addr  = None	# address counter of the panel (None: unknown)
+    _shift = 0		# display shift from home
+    _dh    = 0		# requested double height (ld.DH is the panel state)
+    _cur   = 0		# requested cursor sw
+    _cur_panel = 0	# cursor sw on the panel
+    _cg    = None	# requested CGRAM bitmaps [code] (8 rows of 5 bits, None: unused)
+    _cg_panel = None	# CGRAM bitmaps on the panel (None: unknown)
+    _contrast = None	# contrast on the panel
+    _epoch = 0		# count of clear_display() (texts written before are gone)
+    _lock  = threading.RLock()
+
+    _batch = None	# commands queued between batch_begin() and batch_end()
+    _batch_depth = 0
 
     # # INTERNAL methods # #
 
     @staticmethod
     def ms_delay(n):
-	time.sleep(n / 1000000.0)
+	clock.sleep(n / 1000000.0)
+
+    @staticmethod
+    def so_cmd(c, delay = None) :
+	if delay is None: delay = so1602.delay(c)
+	if ld._batch is not None:
+	    ld._batch.append((c, delay))
+	else:
+	    so1602.send(ld._i2c, ld.i2cAddr_LD, [(c, delay)])
+
+    #
+    #  command batch: so_cmd() between begin and end goes in one transfer
+    #
+    @staticmethod
+    def batch_begin():
+	if ld._batch_depth == 0: ld._batch = []
+	ld._batch_depth += 1
+
+    @staticmethod
+    def batch_end():
+	ld._batch_depth -= 1
+	if ld._batch_depth == 0:
+	    cmds, ld._batch = ld._batch, None
+	    so1602.send(ld._i2c, ld.i2cAddr_LD, cmds)
 
+    #
+    #  DDRAM / CGRAM data, in one transfer with the commands queued before it
+    #
     @staticmethod
-    def so_cmd(c) :
-	ld._i2c.write_byte_data(ld.i2cAddr_LD, 0, c)
-	ld.ms_delay(5)
+    def _write(data):
+	cmds, ld._batch = ld._batch, []
+	so1602.send(ld._i2c, ld.i2cAddr_LD, cmds, data)
 
     @staticmethod
     def set_Line_mode_1_2() :
         
+	ld.batch_begin()
 	ld.so_cmd(0x20 | (ld.N  & ld.N) | (ld.BE & 0) | (ld.RE & ld.RE) | (ld.REV & 0))	# RE = 1 , N = 1 : 2 or 4 line
 	ld.so_cmd(0x08 | (ld.FW & 0) | (ld.BW & 0) | (ld.NW & 0))		        # NW = 0 :  1 or 2 line
 	ld.so_cmd(0x20 | (ld.N  & ld.N) | (ld.DH)     | (ld.RE &  0) | (ld.IS &  0))	# RE = 0 , n = 1 : 2 or 4 line
+	ld.batch_end()
 
     @staticmethod
     def init_1602() :
 
 	ld.DH  = 0
+	ld._dh = 0
+	ld.batch_begin()
 	ld.set_shift_mode()
 	ld.set_Line_mode_1_2()
-	ld.clear_display()
+	ld.batch_end()
+	ld._clear()
 	ld.ms_delay(20)
 	ld.return_to_home()
 	ld.display_sw(1)
 	ld.return_to_home()
 	ld.ms_delay(20)
 
+    @staticmethod
+    def _clear():
+	ld.so_cmd(0x01)
+	ld._panel = [bytearray([ld.BLANK] * ld.DDRAM) for l in range(2)]
+	ld._addr  = (0, 0)
+	ld._shift = 0
+
+    @staticmethod
+    def _locate(l, c):
+	c = c + 0x80		# 1st line is start with 0x80
+	if l == 1:
+	    c = c + 0x40	# 2nd line is start with 0xc0
+
+	ld.so_cmd(c)
+	ld._addr = (l, c & 0x3f)
+
+    @staticmethod
+    def _cursor_sw(sw):
+	if sw & 1: 
+	    ld.curosr = 2
+	    ld.blink  = 1
+	else :
+	    ld.cursor = 0
+	    ld.blink = 0
+	cmd = 8 | ld.led | ld.cursor | ld.blink
+	ld.so_cmd(cmd)
+	ld._cur_panel = sw & 1
+
+    @staticmethod
+    def _runs(base):
+	# changed cell runs [(line, start, end)], close runs are merged
+	runs = []
+	for l in range(2):
+	    fb = ld._fb[l]
+	    b  = base[l]
+	    run = None
+	    for c in range(ld.DDRAM):
+		if fb[c] == b[c]: continue
+		if run is not None and c - run[2] < ld.GAP:
+		    run[2] = c + 1
+		else:
+		    run = [l, c, c + 1]
+		    runs.append(run)
+	return runs
+
+    @staticmethod
+    def _cost(runs):
+	# bytes on the bus: one transfer per run (addr, ctrl, cmd, ctrl, data)
+	return sum([4 + (e - s) for l, s, e in runs])
+
     # # PUBLIC METHODS # #
 
     @staticmethod
     def init(i2c):
 	ld._i2c = i2c
+	ld._fb = [bytearray([ld.BLANK] * ld.DDRAM) for l in range(2)]
+	ld._pos = (0, 0)
+	ld._cur = 0
+	ld._cur_panel = 0
+	ld._cg = [None] * ld.CGRAM
+	ld._cg_panel = [None] * ld.CGRAM
 	ld.init_1602()
-	ld.set_contrast(0x38)
-	ld.clear_display()
+	ld.set_contrast(ld.CONTRAST)
+	ld._clear()
+
+    #
+    #  send the changes of the framebuffer to the panel
+    #
+    @staticmethod
+    @metrics.timed('ld.flush')
+    def flush():
+	with ld._lock:
+	    ld.batch_begin()
+	    if ld._dh != ld.DH:
+		ld.DH = ld._dh
+		ld.so_cmd(0x20 | (ld.N  & ld.N) | (ld.DH)     | (ld.RE &  0) | (ld.IS &  0))	# RE = 0 , n = 1 : 2 or 4 line
+	    if ld._cur_panel and not ld._cur:
+		ld._cursor_sw(0)
+
+	    # changed CGRAM characters, consecutive ones in one block (the address increments)
+	    i = 0
+	    while i < ld.CGRAM:
+		if ld._cg[i] is None or ld._cg[i] == ld._cg_panel[i]:
+		    i += 1
+		    continue
+		j = i + 1
+		while j < min(ld.CGRAM, i + (ld.BLOCK_MAX - 2) // 8) and ld._cg[j] is not None and ld._cg[j] != ld._cg_panel[j]:
+		    j += 1
+		ld.so_cmd(0x40 | (i * 8))				# set CGRAM address
+		data = []
+		for k in range(i, j): data += ld._cg[k]
+		ld._write(data)
+		ld._cg_panel[i:j] = ld._cg[i:j]
+		ld._addr = None					# the address counter points into CGRAM
+		i = j
+
+	    # clear the panel only when it is cheaper than the diff (also resets the shift)
+	    runs = ld._runs(ld._panel)
+	    blank = [bytearray([ld.BLANK] * ld.DDRAM) for l in range(2)]
+	    from_blank = ld._runs(blank)
+	    if ld._cost(from_blank) + 3 < ld._cost(runs) + (3 if ld._shift else 0):
+		ld._clear()
+		runs = from_blank
+	    elif ld._shift:
+		ld.return_to_home()
+
+	    for l, s, e in runs:
+		if ld._addr != (l, s): ld._locate(l, s)
+		ld._write(list(ld._fb[l][s:e]))		# mode commands, cursor move and the run in one transfer
+		ld._panel[l][s:e] = ld._fb[l][s:e]
+		ld._addr = (l, e) if e < ld.DDRAM else None
+
+	    if ld._cur:
+		if ld._addr != ld._pos: ld._locate(*ld._pos)
+		if not ld._cur_panel: ld._cursor_sw(1)
+	    ld.batch_end()
 
     @staticmethod
     def clear_display() :
-	ld.so_cmd(0x01)
+	# visible columns only: the rest keeps what tr_m put there (it writes them whole)
+	for l in range(2):
+	    ld._fb[l][0:ld.COLS] = bytearray([ld.BLANK] * ld.COLS)
+	ld._pos = (0, 0)
+	ld._epoch += 1
 
     @staticmethod
     def return_to_home():
 	ld.so_cmd(2)
+	ld._addr  = (0, 0)
+	ld._shift = 0
 
     @staticmethod
     def display_sw(sw):
 	ld.led    = (sw & 1)     << 2
 	cmd = 8 | ld.led | ld.cursor | ld.blink
 	ld.so_cmd(cmd)
+	ld._cur_panel = 1 if ld.cursor | ld.blink else 0
 
     @staticmethod
     def cursor_sw(sw):
-	if sw & 1: 
-	    ld.curosr = 2
-	    ld.blink  = 1
-	else :
-	    ld.cursor = 0
-	    ld.blink = 0
-	cmd = 8 | ld.led | ld.cursor | ld.blink
-	ld.so_cmd(cmd)
+	ld._cur = sw & 1
 
     @staticmethod
     def set_double_height(sw):
-	if sw == 0:	ld.DH = 0
-	else:		ld.DH = 4
-	ld.so_cmd(0x20 | (ld.N  & ld.N) | (ld.DH)     | (ld.RE &  0) | (ld.IS &  0))	# RE = 0 , n = 1 : 2 or 4 line
+	if sw == 0:	ld._dh = 0
+	else:		ld._dh = 4
 
     @staticmethod
     def set_contrast(c) :
 
+	ld.batch_begin()
 	ld.so_cmd(0x20 | (ld.N  & ld.N) | (ld.BE & 0) | (ld.RE & ld.RE) | (ld.REV & 0))		# RE = 1
 	ld.so_cmd(0x79)										# SD = 1
 	ld.so_cmd(0x81)										# set contrast
 	ld.so_cmd(c)										# value
 	ld.so_cmd(0x78)										# SD = 0
 	ld.so_cmd(0x20 | (ld.N  & ld.N) | (ld.DH)     | (ld.RE &  0) | (ld.IS & 0))		# RE = 0
+	ld.batch_end()
+	ld._contrast = c
 
     @staticmethod
     def set_location(l, c):
-	c = c + 0x80		# 1st line is start with 0x80
-	if l == 1:
-	    c = c + 0x40	# 2nd line is start with 0xc0
-
-	ld.so_cmd(c)
+	ld._pos = (l, c)
 
     @staticmethod
+    @metrics.timed('ld.write_char')
     def write_char(str, l = None, c = None):
 	if (c != None) :
 	    ld.set_location(l, c)
 
-	ld._i2c.write_i2c_block_data(ld.i2cAddr_LD, 0x40, map(ord, str))
+	l, c = ld._pos
+	data = bytearray(map(ord, str[:max(0, ld.DDRAM - c)]))
+	ld._fb[l][c:c + len(data)] = data
+	ld._pos = (l, c + len(data))
+
+    #
+    #  char codes for 5x8 bitmaps (tuples of 8 rows), sent by flush()
+    #
+    #	loaded bitmaps keep their codes, so only new ones are written
+    #	to CGRAM. An empty bitmap is a blank.
+    #
+    @staticmethod
+    def set_glyphs(bitmaps):
+	need = []
+	for b in bitmaps:
+	    if any(b) and b not in need: need.append(b)
+	if len(need) > ld.CGRAM: raise ValueError("more than %d glyphs" % ld.CGRAM)
+
+	free = [i for i in range(ld.CGRAM) if ld._cg[i] not in need]
+	for b in need:
+	    if b not in ld._cg: ld._cg[free.pop(0)] = b
+	return [(ld._cg.index(b) if any(b) else ld.BLANK) for b in bitmaps]
 
     @staticmethod
     def set_shift_mode():
 	ld.DHD = 1
+	ld.batch_begin()
 	ld.so_cmd(0x20 | ld.N | (ld.BE & 0) | ld.RE       | (ld.REV & 0))			# RE = 1
 	ld.so_cmd(0x10 | ld.UD1 | ld.UD2 | ld.DHD)						# DHD = 1 : display shift mode
 	ld.so_cmd(0x20 | ld.N | ld.DH       | (ld.RE & 0) | (ld.IS & 0))			# RE = 0
+	ld.batch_end()
 
+    #
+    #  display shift is sent at once (flush() first)
+    #
     @staticmethod
     def shift_Right():
 	ld.so_cmd(0x10 | (ld.SC & ld.SC) | (ld.RL & ld.RL))
+	ld._shift += 1
 
     @staticmethod
     def shift_Left():
 	ld.so_cmd(0x10 | (ld.SC & ld.SC) | (ld.RL & 0))
+	ld._shift -= 1
+
+
+######################################################################
+#  screen transition
+#
+#	A transition is a precomputed list of frames ([(func, args), ...],
+#	sec to the next frame) played by sched timers in the thread of the
+#	other jobs, so alarms and the clock keep running. start() of the
+#	next transition or cancel() just drops the next frame.
+
+class tr_m:
+
+    FRAME = 0.04		# sec per frame
+    HOLD  = 10			# frames the state name stays after the animation
+    STYLES = ('shift', 'wipe', 'fade', 'none')
+
+    _frames = {}		# (style, label) -> frames
+    _seq  = None		# frames being played (None: no transition)
+    _i    = 0			# next frame
+    _timer = None
+    _on_done = None
+
+    @staticmethod
+    def _build(style, label):
+	F = tr_m.FRAME
+	head = [(ld.clear_display, ()), (ld.cursor_sw, (0,)), (ld.set_double_height, (1,))]
+	if style == 'shift':
+	    # 画面外に書いてシフトで見せる (前の状態名が残らないよう16桁分書く)
+	    frames = [(head + [(ld.write_char, (label.ljust(ld.COLS), 0, ld.COLS)), (ld.flush, ())], F)]
+	    for i in range(ld.COLS // 2):
+		frames.append(([(ld.batch_begin, ()), (ld.shift_Left, ()), (ld.shift_Left, ()), (ld.batch_end, ())], F))
+	    frames.append(([], F * tr_m.HOLD))
+
+	elif style == 'wipe':
+	    # 左から2桁ずつ消してから状態名
+	    frames = [([(ld.cursor_sw, (0,))], 0)]
+	    for c in range(0, ld.COLS, 2):
+		frames.append(([(ld.write_char, ('  ', 0, c)), (ld.write_char, ('  ', 1, c)), (ld.flush, ())], F))
+	    frames.append((head + [(ld.write_char, (label, 0, 0)), (ld.flush, ())], F * tr_m.HOLD))
+
+	elif style == 'fade':
+	    # コントラストを下げて状態名に切り替え、元に戻す
+	    steps = 6
+	    frames = [([(ld.set_contrast, (ld.CONTRAST * (steps - i) // steps,))], F) for i in range(1, steps + 1)]
+	    frames.append((head + [(ld.write_char, (label, 0, 0)), (ld.flush, ())], F))
+	    frames += [([(ld.set_contrast, (ld.CONTRAST * i // steps,))], F) for i in range(1, steps + 1)]
+	    frames[-1] = (frames[-1][0], F * tr_m.HOLD)
+
+	else:
+	    frames = []
+	return frames
+
+    @staticmethod
+    def start(style, label, on_done):
+	tr_m.cancel()
+	key = (style, label)
+	if key not in tr_m._frames: tr_m._frames[key] = tr_m._build(style, label)
+	tr_m._seq = tr_m._frames[key]
+	tr_m._i = 0
+	tr_m._on_done = staticmethod(on_done)
+	tr_m._step()
+
+    @staticmethod
+    def _step():
+	tr_m._timer = None
+	if tr_m._i == len(tr_m._seq):
+	    on_done = tr_m._on_done
+	    tr_m._seq = tr_m._on_done = None
+	    on_done()
+	    return
+
+	ops, sec = tr_m._seq[tr_m._i]
+	tr_m._i += 1
+	for func, args in ops: func(*args)
+	tr_m._timer = sched.call_later(sec, tr_m._step)
+
+    @staticmethod
+    def cancel():
+	sched.cancel(tr_m._timer)
+	tr_m._timer = None
+	tr_m._seq = tr_m._on_done = None
+	if ld._contrast != ld.CONTRAST: ld.set_contrast(ld.CONTRAST)	# fade の途中
+
+    @staticmethod
+    def running():
+	return tr_m._seq is not None
 
 
 ######################################################################
@@ -222,7 +506,7 @@ class d_m():
 
     _i2c = None
     _state = ""
-    _states = [ 'config', 'clock', 'sensor' , 'alarm' ]
+    _states = [ 'config', 'clock', 'sensor' , 'history', 'alarm' ]
 
     I2CADDR_BTN  = 0x3f  # button shim I2C Address
     _key_state   = 0
@@ -251,10 +535,19 @@ class d_m():
 			' {temp:05.2f}C   {hum:04.1f}%' ,
 			'  {temp:05.2f}C  {hum:04.1f}%' ]
 
-    _th = None			# LED描画用スレッド
-    _drw_event = None		# 描画開始指示用イベントオブジェクト
-    _drw_cond  = None		# 描画中止指示用コンディションオブジェクト
-    _transit_state = None	# 画面遷移状態（None: 停止中、drawing: 描画中、interrupt: 中断要求中、canceled: 中断要求を受領済）
+    # history: channel of monitorLib.history, unit, index of read_sens_data()
+    _hist_sens = { 'T':(0, 'C', 0), 'H':(2, '%', 2), 'C':(1, 'C', 1) }
+    HIST_CELLS = 8		# graph width in characters (5 dots each)
+
+    # refresh_displayの文字列: (書式, 分) と (書式番号, 温度*100, 湿度*10) でキャッシュ
+    _clock_text = render_cache(lambda form, minute: datetime.fromtimestamp(minute * 60).strftime(form))
+    _sens_text  = render_cache(lambda form, temp, hum: d_m._sens_form[form].format(temp = temp / 100.0, hum = hum / 10.0))
+    _drawn = {}			# line -> (ld._epoch, key) refresh_displayが書いた内容
+
+    _sample = None		# monitorBaseから受け取った最新の測定値 (ts, temp_s, temp_c, humidity)
+    _presence = 0		# monitorBaseから受け取った在室状態
+    _keys = None		# ボタン入力（チャタリング除去、長押しリピート）
+    _flush_posted = False	# キー処理後の表示転送を予約済
 
     @staticmethod
     def init(__i2c) :
@@ -263,62 +556,11 @@ class d_m():
 	d_m._state = c_m.get('initial_dm_state')
 	GPIO.setmode( GPIO.BCM )
 	GPIO.setup( 27, GPIO.IN )
+	d_m._keys = key_input(d_m.read_keys, d_m.on_keys, d_m.repeatable)
 	GPIO.add_event_detect( 27, GPIO.FALLING, callback = d_m.button_callback )
-	ld.init(__i2c)
 	d_m._current_mode = str(c_m.get('hsd_mode'))
 	d_m.redraw_display()
-
-	d_m._drw_event = threading.Event()
-	d_m._drw_cond  = threading.Condition()
-	d_m._th = threading.Thread(target = d_m.transit_action)
-	d_m._th.setDaemon(True)
-	d_m._th.start()
-
-    #
-    #   LED panel redrawing with 'transit action'
-    #
-    @staticmethod
-    def transit_action():
-	logger = logging.getLogger(__name__)
-
-	while True:
-	    logger.debug("transit_wait")
-	    d_m._drw_event.wait()				# 描画指示待ち
-	    d_m._drw_event.clear()				# 描画指示を受けて、Eventをリセットする
-	    logger.debug("transit_start")
-
-	    # transit描画開始
-	    ld.clear_display()
-	    ld.cursor_sw(0)
-	    ld.set_double_height(1)
-	    ld.write_char(d_m._state, 0, 16)
-
-	    # transitループ
-	    for i in range(18) :
-		with d_m._drw_cond:
-		    if d_m._transit_state == 'interrupt':	# 描画中止指示のチェック
-			logger.debug("transit_interrupt")
-			d_m._transit_state = 'canceled'
-			d_m._drw_cond.notify()			# 中止要求受領を通知
-			break
-
-		if i < 8:
-		    ld.shift_Left()
-		    ld.shift_Left()
-
-		time.sleep(0.04)
-
-	    if d_m._transit_state == 'canceled': continue	# 中断指示によるループ脱出
-
-	    d_m.redraw_display()				# 移行先画面描画
-
-	    with d_m._drw_cond:
-		if d_m._transit_state == 'interrupt':		# 中断指示が出ていたが描画完了してしまった時
-		    logger.debug("transit_interrupt_but...")
-		    d_m._drw_cond.notify()			# 終了を通知
-
-	    logger.debug("transit_end")
-	    d_m._transit_state = None
+	ld.flush()
 
     #
     #   expected to be called periodically
@@ -331,14 +573,24 @@ class d_m():
     #  button_callback
     #
     #   get button state(whitch button has been pushed)
+    #   GPIOのスレッドではキーの読み取りだけ、処理はschedのスレッド（d_m.on_keys）
     #
     @staticmethod
     def button_callback(portNo):
-        
-	logger = logging.getLogger(__name__)
+	trace.record('key', d_m._keys.capture())
+
+    @staticmethod
+    def read_keys():
 	key_state = d_m._i2c.read_byte_data(d_m.I2CADDR_BTN, d_m.REG_INPUT)
-	key_state = ~key_state & 0b011111
+	return ~key_state & 0b011111
 
+    #
+    #  押されたキー（repeat > 0: 長押しのリピート）
+    #
+    @staticmethod
+    def on_keys(key_state, repeat):
+
+	logger = logging.getLogger(__name__)
 	if (key_state & 0b000001) > 0 :
 	    #
 	    # change _state
@@ -346,13 +598,33 @@ class d_m():
 	    d_m.change_state(None)
 
 	if key_state & 0b011110 :
-	    if d_m._state == 'clock' or d_m._state == 'sensor' :
+	    if d_m._state == 'clock' or d_m._state == 'sensor' or d_m._state == 'history' :
 		d_m.key_event(key_state)
 	    elif d_m._state == 'config':
 		c_m.key_event(key_state)
 	    elif d_m._state == 'alarm':
 		al_a.key_event(key_state)
 
+	# 同時に処理されるキー（リピートの遅れ等）の表示はまとめて転送する
+	if not d_m._flush_posted:
+	    d_m._flush_posted = True
+	    sched.call_soon(d_m.flush_keys)
+
+    @staticmethod
+    def flush_keys():
+	d_m._flush_posted = False
+	if not tr_m.running():				# 遷移中ならば遷移の最後に描画される
+	    ld.flush()
+
+    #
+    #  長押しでリピートするキー: config画面の数値（範囲指定のある項目: 時、分など）
+    #
+    @staticmethod
+    def repeatable(key_state):
+	if d_m._state != 'config': return False
+	i = c_m.value_target(key_state)
+	return i is not None and c_m._nodes[i].range is not None
+
     #
     #  Change d_m_status
     #
@@ -374,15 +646,14 @@ class d_m():
 
 	logger.debug("change_state:next_state="+d_m._state)
 
-	with d_m._drw_cond:
-	    if d_m._transit_state is not None:			# スレッドがまだ描画中
-		logger.debug("transit_over")
-		d_m._transit_state = 'interrupt'		# 描画中断指示
-		d_m._drw_cond.wait()				# 中断指示受領を待つ
+	# 遷移中なら次のフレームは来ない（中断して新しい遷移）
+	tr_m.start(c_m.get('transit'), d_m._state, d_m.transit_done)
+	al_a.arm()						# snoozeカウントダウン表示の有無が変わる
 
-	    d_m._transit_state = 'drawing'
-	    logger.debug("transit_trigger")
-	    d_m._drw_event.set()				# 描画指示を出して終了
+    @staticmethod
+    def transit_done():
+	d_m.redraw_display()				# 移行先画面描画
+	ld.flush()
 
 
     #
@@ -418,6 +689,16 @@ class d_m():
 
 	    d_m.redraw_display()
 
+	elif d_m._state == 'history':
+	    style = c_m._c['hist_style']
+	    if key_state & 0b000110 : item = style['hours']
+	    else		    : item = style['sens']
+	    step = 1 if key_state & 0b001010 else -1
+	    cand = item['candidate']
+	    item['value'] = cand[(cand.index(item['value']) + step) % len(cand)]
+
+	    d_m.redraw_display()
+
     #
     #  redraw display
     #
@@ -431,7 +712,8 @@ class d_m():
 	    d_m.enable_hsd()
 	    ld.clear_display()
 	    ld.cursor_sw(0)
-	    if d_m._state == 'clock' or c_m._c['sens_style']['clock']['value'] == 0 : ld.set_double_height(1)
+	    if   d_m._state == 'history'	: ld.set_double_height(0)
+	    elif d_m._state == 'clock' or c_m._c['sens_style']['clock']['value'] == 0 : ld.set_double_height(1)
 	    else			: ld.set_double_height(0)
 	    d_m.refresh_display()
 
@@ -439,12 +721,20 @@ class d_m():
     def read_sens_data():
 	logger = logging.getLogger(__name__)
 
+	# 新しい方: 切断後の _sample は更新されない
+	data = sens_shm.read()
+	if d_m._sample is not None and (data is None or d_m._sample[0] >= data[0]): data = d_m._sample
+	if data is not None:
+	    ts, temp_s, temp_c, humidity = data
+	    return [temp_s, temp_c, humidity]
+
+	# monitorBase without the shared memory channel
 	try:
 	    with open('/tmp/sens_data.txt', 'r') as f:
 		return [float(d) for d in f.read().split(',')]
 	except:
 	    logger.info("read_sens_data: retrying")
-	    time.sleep(0.5)
+	    clock.sleep(0.5)
 	    try:
 		with open('/tmp/sens_data.txt', 'r') as f:
 		    return [float(d) for d in f.read().split(',')]
@@ -456,25 +746,85 @@ class d_m():
     #  (periodical) refresh display
     #
     @staticmethod
+    @metrics.timed('d_m.refresh_display')
     def refresh_display():
 
 	logger = logging.getLogger(__name__)
 	logger.debug('d_m.refresh_display:'+d_m._state)
+	minute = int(clock.time() // 60)
 	if d_m._state == 'clock':
-	    ld.write_char(datetime.now().strftime(d_m._clock_form[c_m._c['clock_style']['value']]), 0, 0)
+	    return d_m.draw(0, d_m._clock_text, (d_m._clock_form[c_m._c['clock_style']['value']], minute))
 	elif d_m._state == 'sensor':
 	    temp, temp_c, hum = d_m.read_sens_data()
+	    sens = (c_m._c['sens_style']['sens']['value'], int(round(temp * 100)), int(round(hum * 10)))
 	    if c_m._c['sens_style']['clock']['value'] != 0 :
-		ld.write_char(datetime.now().strftime(d_m._clock_form[c_m._c['sens_style']['clock']['value']-1]), 0, 0)
-		ld.write_char(d_m._sens_form[c_m._c['sens_style']['sens']['value']].format(temp=temp, hum=hum), 1, 0)
+		changed = d_m.draw(0, d_m._clock_text, (d_m._clock_form[c_m._c['sens_style']['clock']['value']-1], minute))
+		return d_m.draw(1, d_m._sens_text, sens) or changed
 	    else :
-		ld.write_char(d_m._sens_form[c_m._c['sens_style']['sens']['value']].format(temp=temp, hum=hum), 0, 0)
+		return d_m.draw(0, d_m._sens_text, sens)
+	elif d_m._state == 'history':
+	    d_m.refresh_history()
 	elif d_m._state == 'config':
 	    c_m.refresh_display()
 	elif d_m._state == 'alarm':
 	    al_a.refresh_display()
 	else:
 	    ld.write_char('unknown', 0, 0)
+	return True
+
+    #
+    #  the text of key on the line (False: it is there already, no bus write needed)
+    #
+    @staticmethod
+    def draw(line, cache, key):
+	drawn = (ld._epoch, key)
+	if d_m._drawn.get(line) == drawn: return False
+	d_m._drawn[line] = drawn
+	ld.write_char(cache.get(key), line, 0)
+	return True
+
+    @staticmethod
+    def clock_text(form, ts):
+	return d_m._clock_text.get((form, int(ts // 60)))
+
+    #
+    #  history: range of the last hours and a bar graph of HIST_CELLS characters
+    #
+    #	T 24h 18.2-25.1
+    #	 24.5C  ########
+    #
+    @staticmethod
+    def refresh_history():
+	style = c_m._c['hist_style']
+	name  = style['sens']['value']
+	hours = style['hours']['value']
+	channel, unit, idx = d_m._hist_sens[name]
+
+	if not history.files and not history.open(writable = False):
+	    ld.write_char('no history', 0, 0)
+	    return
+
+	# グラフは最新のデータまで (データのない右端の列を空の棒にしない)
+	width = d_m.HIST_CELLS * 5
+	now = min(clock.time(), (history.last_ts() or 0) + 60)
+	values = history.series(now - hours * 3600, now, width, channel)
+	known = [v for v in values if v is not None]
+	if not known:
+	    ld.write_char('{} {}h no data'.format(name, hours), 0, 0)
+	    return
+
+	lo, hi = min(known), max(known)
+	ld.write_char('{} {}h {:.1f}-{:.1f}'.format(name, hours, lo, hi), 0, 0)
+	ld.write_char('{:5.1f}{}'.format(d_m.read_sens_data()[idx], unit), 1, 0)
+
+	# bar height 1..8 dots (0: no data)
+	heights = [(0 if v is None else 1 + int((v - lo) * 7 / (hi - lo)) if hi > lo else 4) for v in values]
+	bitmaps = []
+	for k in range(0, width, 5):
+	    cell = heights[k:k + 5]
+	    bitmaps.append(tuple([sum([1 << (4 - x) for x, h in enumerate(cell) if h >= 8 - r]) for r in range(8)]))
+	codes = ld.set_glyphs(bitmaps)
+	ld.write_char(''.join(map(chr, codes)), 1, ld.COLS - d_m.HIST_CELLS)
 
     #
     # (temporary) disable & resume hsd mode
@@ -484,11 +834,7 @@ class d_m():
 	logger = logging.getLogger(__name__)
 	logger.debug("disable_hsd")
 	d_m._current_mode = '0'
-	try:
-	    with open('/tmp/pipe', 'w') as f:
-	        f.write(d_m._current_mode)
-	except EnvironmentError:
-	    logger.error("pipe cannot open")
+	d_m.send_message('hsd:' + d_m._current_mode)
 
     @staticmethod
     def enable_hsd():
@@ -496,34 +842,94 @@ class d_m():
 	logger.debug("enable_hsd")
 	if c_m.get('hsd_mode') == 1:
 	    d_m._current_mode = '1'
-	    try:
-		with open('/tmp/pipe', 'w') as f:
-		    f.write(d_m._current_mode)
-	    except EnvironmentError:
-		logger.error("pipe cannot open")
+	    d_m.send_message('hsd:' + d_m._current_mode)
 	else:
 	    logger.debug("-- stay disable")
 
+    @staticmethod
+    def set_led_pattern():
+	logger = logging.getLogger(__name__)
+	logger.debug("set_led_pattern")
+	d_m.send_message('led:' + c_m.get('led_pattern'))
+
     @staticmethod
     def resume_hsd():
 	logger = logging.getLogger(__name__)
 	logger.debug("resume_hsd")
-	try:
-	    with open('/tmp/pipe', 'w') as f:
-	        f.write(d_m._current_mode)
-	except EnvironmentError:
-	    logger.error("pipe cannot open")
+	d_m.send_message('hsd:' + d_m._current_mode)
+
+    #
+    # send a message to monitorBase
+    #
+    @staticmethod
+    def send_message(msg):
+	logger = logging.getLogger(__name__)
+	if not ipc_client.send(msg):
+	    logger.debug("not connected to monitorBase: " + msg)
+
+    #
+    # a message from monitorBase
+    #
+    @staticmethod
+    def on_message(msg):
+	logger = logging.getLogger(__name__)
+	if msg.startswith('sens:'):
+	    d_m._sample = tuple([float(x) for x in msg[5:].split(',')])
+	    # monitorBaseがまだ書き出していない履歴の末尾
+	    if history.files or history.open(writable = False): history.add(*d_m._sample)
+	elif msg.startswith('pir:'):
+	    d_m._presence = int(msg[4:])
+	    logger.debug("presence: " + msg[4:])
+	else:
+	    logger.warning("unknown message: " + repr(msg))
+
+    #
+    # (re)connected to monitorBase: send the current state
+    #
+    @staticmethod
+    def on_connect():
+	d_m.resume_hsd()
+	d_m.set_led_pattern()
 
 
 ######################################################################
 #  config manager class
-import copy
+#
+#	_b is the config tree with the defaults, _c the current one.
+#	Changed items are kept in _dirty as paths (('alarm', 'alarm1', 'h '))
+#	and handled when the config screen is left.
+#
+#	conf file: {"version": 1, "values": [[path, value], ...]} written to
+#	a temp file, fsync'ed and renamed over the old one. Items not in
+#	the file keep the default of _b.
+import json
 import pickle
 
+#
+#  an item of the config tree in c_m._nodes (indexes of the other items
+#  as links, item is the dict of the item in c_m._c)
+#
+class c_node:
+
+    def __init__(self, key, path, parent, schema):
+	self.key = key
+	self.path = path
+	self.parent = parent
+	self.leaf = 'value' in schema
+	self.range = schema.get('range') if self.leaf else None
+	self.cand = schema.get('candidate') if self.leaf else None
+	self.cand_pos = dict([(v, i) for i, v in enumerate(self.cand)]) if self.cand else None
+	self.children = []
+	self.first = None		# first child
+	self.next = None		# next sibling (the last one links to the first)
+	self.col = 0			# column of the key in the line of the siblings
+	self.child_line = ''		# keys of the children in a line
+	self.item = None
+
 class c_m:
         
     _b = OrderedDict()
-    _b['initial_dm_state'] = { 'value':'sensor', 'candidate':('clock', 'sensor', 'alarm', 'config') }
+    _b['initial_dm_state'] = { 'value':'sensor', 'candidate':('clock', 'sensor', 'history', 'alarm', 'config') }
     _b['hsd_mode'] = { 'value':1 , 'range':( 0, 1 ) }
     _b['clock_style'] = { 'value':6 , 'range':( 0, 10 ) }
 
@@ -531,6 +937,13 @@ class c_m:
     _b['sens_style']['sens'] = { 'value':0, 'range':( 0, 3 ) } 
     _b['sens_style']['clock'] = { 'value':7, 'range':( 0, 10) } 
 
+    _b['hist_style'] = OrderedDict()
+    _b['hist_style']['sens'] = { 'value':'T', 'candidate':( 'T', 'H', 'C' ) }
+    _b['hist_style']['hours'] = { 'value':24, 'candidate':( 3, 12, 24, 72, 168 ) }
+
+    _b['led_pattern'] = { 'value':'breath', 'candidate':( 'breath', 'pulse', 'steady', 'off' ) }
+    _b['transit'] = { 'value':'shift', 'candidate':tr_m.STYLES }
+
     _b['alarm'] =  OrderedDict()
     _b['alarm']['alarm1'] = OrderedDict()
     _b['alarm']['alarm1']['sw '] = { 'value':'OFF', 'candidate':( 'ON', 'OFF' ) }
@@ -554,102 +967,176 @@ class c_m:
 
     _c = {}
 
-    _conf_fname = "/home/pi/projects/monitor_project/_conf.pickle"
+    _conf_fname = "/home/pi/projects/monitor_project/_conf.json"
+    _legacy_fname = "/home/pi/projects/monitor_project/_conf.pickle"	# whole _c pickled (read when there is no _conf_fname)
+    CONF_VERSION = 1
+
+    _dirty = set()		# paths of the changed items
 
-    _iter0 = None
-    _iter1 = None
-    _iter2 = None
+    # view state: indexes of c_m._nodes selected on each level (None: not selected)
     _vy0 = None
     _vy1 = None
     _vy2 = None
     _sublevel = False
 
-    _cand = None
-    _range = None
+    _nodes = []			# c_node of every item of _b, depth first
+    _roots = []			# indexes of the level 0 items
 
     @staticmethod
     def init():
-	c_m._c = {}
+	if not c_m._nodes: c_m._roots = c_m._build_index(c_m._b, (), None)
+	c_m._c = c_m._copy(c_m._b)
+	c_m._dirty = set()
 	try:
-	    fh = open(c_m._conf_fname, 'r')
-	    c_m._c = pickle.loads(fh.read())
-	    fh.close()
+	    with open(c_m._conf_fname, 'r') as fh:
+		conf = json.load(fh)
+	    if conf.get('version') != c_m.CONF_VERSION:
+		raise ValueError("version " + str(conf.get('version')))
+	    values = conf['values']
 	    logger.info("c_m.init: initialize from conf_file")
+	except IOError:
+	    values = c_m._load_legacy()
+	except (ValueError, KeyError, AttributeError) as e:
+	    logger.error("c_m.init: broken conf_file ({}), initialize conf from _b".format(e))
+	    values = []
+
+	# items not in _b any more are dropped, new items keep the default
+	for path, value in values:
+	    node = c_m.node([str(key) for key in path])
+	    if node is None or 'value' not in node: continue
+	    if isinstance(value, unicode): value = value.encode('utf-8')
+	    node['value'] = value
+
+	# the index refers to the items of the new _c
+	for node in c_m._nodes:
+	    node.item = c_m.node(node.path)
+
+    @staticmethod
+    def _load_legacy():
+	try:
+	    with open(c_m._legacy_fname, 'r') as fh:
+		old = pickle.loads(fh.read())
 	except IOError:
 	    logger.info("c_m.init: initialize conf from _b")
-	    c_m._c = copy.deepcopy(c_m._b)
+	    return []
+
+	logger.info("c_m.init: initialize from " + c_m._legacy_fname)
+	values = []
+	for path, node in c_m.leaves(c_m._b):
+	    item = old
+	    for key in path:
+		item = item.get(key) if isinstance(item, dict) else None
+		if item is None: break
+	    if item is not None and 'value' in item: values.append((path, item['value']))
+	return values
+
+    @staticmethod
+    def _copy(tree):
+	# leaves are dicts of immutables: a shallow copy each
+	return OrderedDict([(key, dict(node) if 'value' in node else c_m._copy(node)) for key, node in tree.items()])
+
+    @staticmethod
+    def leaves(tree, path = ()):
+	# (path, node) of every item with a value
+	for key, node in tree.items():
+	    if 'value' in node:
+		yield path + (key,), node
+	    else:
+		for leaf in c_m.leaves(node, path + (key,)): yield leaf
+
+    @staticmethod
+    def node(path):
+	node = c_m._c
+	for key in path:
+	    node = node.get(key)
+	    if node is None: return None
+	return node
 
     @staticmethod
     def get(conf_name):
 	return c_m._c[conf_name]['value']
 
+    #
+    # index of the config tree: a c_node per item of _b with the links
+    # and the label layouts, so that the traversal needs no lookup in _c
+    #
+    @staticmethod
+    def _build_index(tree, path, parent):
+	idx = []
+	for key, schema in tree.items():
+	    i = len(c_m._nodes)
+	    node = c_node(key, path + (key,), parent, schema)
+	    c_m._nodes.append(node)
+	    idx.append(i)
+	    if not node.leaf:
+		node.children = c_m._build_index(schema, node.path, i)
+		node.first = node.children[0]
+		node.child_line = ' '.join([c_m._nodes[j].key for j in node.children])
+
+	# siblings are a ring, columns as written by refresh_display
+	col = 0
+	for i, j in zip(idx, idx[1:] + idx[:1]):
+	    c_m._nodes[i].next = j
+	    c_m._nodes[i].col = col
+	    col += len(c_m._nodes[i].key) + 1
+	return idx
+
     #
     # Traverse the config items of each level (lv0, lv1, lv2)
     #
     @staticmethod
     def rotate_vy0():
-	if c_m._vy0 == None: c_m._iter0 = iter(c_m._c.keys())
-
-	try:
-	    c_m._vy0 = next(c_m._iter0)
-	except StopIteration:
-	    c_m._iter0 = iter(c_m._c.keys())
-	    c_m._vy0 = next(c_m._iter0)
-
+	c_m._vy0 = c_m._roots[0] if c_m._vy0 is None else c_m._nodes[c_m._vy0].next
 	c_m._vy1 = None
 	c_m._vy2 = None
-	c_m._range = c_m._c[c_m._vy0].get('range')
-	c_m._cand  = c_m._c[c_m._vy0].get('candidate')
-	c_m._sublevel = not ('value' in c_m._c[c_m._vy0]) 
+	c_m._sublevel = not c_m._nodes[c_m._vy0].leaf
 
     @staticmethod
     def rotate_vy1():
-	if c_m._vy1 == None: c_m._iter1 = iter(c_m._c[c_m._vy0].keys())
-
-	try:
-	    c_m._vy1 = next(c_m._iter1)
-	except StopIteration:
-	    c_m._iter1 = iter(c_m._c[c_m._vy0].keys())
-	    c_m._vy1 = next(c_m._iter1)
-
+	c_m._vy1 = c_m._nodes[c_m._vy0].first if c_m._vy1 is None else c_m._nodes[c_m._vy1].next
 	c_m._vy2 = None
-	c_m._range = c_m._c[c_m._vy0][c_m._vy1].get('range')
-	c_m._cand  = c_m._c[c_m._vy0][c_m._vy1].get('candidate')
-	c_m._sublevel = not ('value' in c_m._c[c_m._vy0][c_m._vy1]) 
+	c_m._sublevel = not c_m._nodes[c_m._vy1].leaf
 
     @staticmethod
     def rotate_vy2():
-	if c_m._vy2 == None: c_m._iter2 = iter(c_m._c[c_m._vy0][c_m._vy1].keys())
+	c_m._vy2 = c_m._nodes[c_m._vy1].first if c_m._vy2 is None else c_m._nodes[c_m._vy2].next
+	c_m._sublevel = not c_m._nodes[c_m._vy2].leaf
 
-	try:
-	    c_m._vy2 = next(c_m._iter2)
-	except StopIteration:
-	    c_m._iter2 = iter(c_m._c[c_m._vy0][c_m._vy1].keys())
-	    c_m._vy2 = next(c_m._iter2)
-
-	c_m._range = c_m._c[c_m._vy0][c_m._vy1][c_m._vy2].get('range')
-	c_m._cand  = c_m._c[c_m._vy0][c_m._vy1][c_m._vy2].get('candidate')
-	c_m._sublevel = not ('value' in c_m._c[c_m._vy0][c_m._vy1][c_m._vy2]) 
+    @staticmethod
+    def rotate_value(i):
+	node = c_m._nodes[i]
+	item = node.item
+	if node.range is not None:
+	    item['value'] += 1
+	    if item['value'] > node.range[1]:
+		item['value'] = node.range[0]
+	if node.cand is not None:
+	    # a value not in the candidates (old conf file) restarts from the first
+	    idx = node.cand_pos.get(item['value'], -1) + 1
+	    item['value'] = node.cand[idx % len(node.cand)]
+	c_m._dirty.add(node.path)
 
     @staticmethod
-    def rotate_val_in_range(obj):
-	obj['value'] += 1
-	if obj['value'] > c_m._range[1]:
-	   obj['value'] = c_m._range[0]
+    def value_target(key_state):
+	# index of the item whose value key_event(key_state) changes (None: the key moves the cursor)
+	if c_m._sublevel or key_state & 0b000010: return None
+	if key_state & 0b000100: return c_m._vy0 if c_m._vy1 is None else None
+	if key_state & 0b001000: return c_m._vy1 if c_m._vy2 is None else None
+	if key_state & 0b010000: return c_m._vy2
+	return None
 
     @staticmethod
-    def rotate_val_from_cand(obj):
-	idx = c_m._cand.index(obj['value']) + 1
-	if idx >= len(c_m._cand) : idx = 0
-        obj['value'] = c_m._cand[idx]
-        
+    def _view():
+	# path of the selected item (for the log)
+	i = c_m._vy2 if c_m._vy2 is not None else c_m._vy1 if c_m._vy1 is not None else c_m._vy0
+	return c_m._nodes[i].path if i is not None else ()
 
     @staticmethod
     def key_event(key_state):
 	logger = logging.getLogger(__name__)
 
 	logger.debug("key_event:" + str(key_state) + " ******")
-	logger.debug("0: {} - {} - {} sublevel={}".format(c_m._vy0,c_m._vy1,c_m._vy2,c_m._sublevel))
+	logger.debug("0: {} sublevel={}".format(c_m._view(), c_m._sublevel))
 
 	if key_state & 0b000010 :
 	    logger.debug("shift level_vy0 item")
@@ -662,12 +1149,7 @@ class c_m:
 
 	    elif c_m._vy1 is None and not c_m._sublevel:
 		logger.debug("change the value of level_vy0")
-
-		if c_m._range is not None:
-		    c_m.rotate_val_in_range(c_m._c[c_m._vy0])
-		if c_m._cand is not None:
-		    c_m.rotate_val_from_cand(c_m._c[c_m._vy0])
-		c_m._c[c_m._vy0]['mod'] = 1
+		c_m.rotate_value(c_m._vy0)
 	    else: return
 
 	elif key_state & 0b001000 :
@@ -677,23 +1159,13 @@ class c_m:
 
 	    elif c_m._vy1 is not None and not c_m._sublevel:
 		logger.debug("change the value of level_vy1")
-
-		if c_m._range is not None:
-		    c_m.rotate_val_in_range(c_m._c[c_m._vy0][c_m._vy1])
-		if c_m._cand is not None:
-		    c_m.rotate_val_from_cand(c_m._c[c_m._vy0][c_m._vy1])
-		c_m._c[c_m._vy0][c_m._vy1]['mod'] = 1
+		c_m.rotate_value(c_m._vy1)
 	    else: return
 
 	elif key_state & 0b010000:
 	    if c_m._vy2 is not None and not c_m._sublevel:
 		logger.debug("change the value of level_vy2")
-
-		if c_m._range is not None:
-		    c_m.rotate_val_in_range(c_m._c[c_m._vy0][c_m._vy1][c_m._vy2])
-		if c_m._cand is not None:
-		    c_m.rotate_val_from_cand(c_m._c[c_m._vy0][c_m._vy1][c_m._vy2])
-		c_m._c[c_m._vy0][c_m._vy1][c_m._vy2]['mod'] = 1
+		c_m.rotate_value(c_m._vy2)
 	    else: return
 
 	ld.clear_display()
@@ -708,45 +1180,53 @@ class c_m:
 	logger = logging.getLogger(__name__)
 	logger.debug("check_modified_items")
 
-	isModified = False
-	for lv0 in c_m._c:
-	    mod_val =  c_m._c[lv0].pop('mod', None)
-	    if mod_val != None:
-		isModified = True
-		if lv0 == 'reset_settings':
-		    logger.debug("cmi: reset_settings")
-		    try:
-			os.remove(c_m._conf_fname)
-		    except OSError:
-			logger.debug("cmi: conf file not found")
-			pass
-		    c_m.init()
-		    al_a.setAlarm(None)
-		    return;
-	    if 'value' in c_m._c[lv0]: continue;
-
-	    for lv1 in c_m._c[lv0]:
-		mod_val = c_m._c[lv0][lv1].pop('mod', None)
-		if mod_val is not None: isModified = True
-		if 'value' in c_m._c[lv0][lv1]:  continue;
-
-		logger.debug("cmi: check " + lv1)
-		for lv2 in c_m._c[lv0][lv1]:
-		    mod_val = c_m._c[lv0][lv1][lv2].pop('mod', None)
-		    if mod_val != None:
-			isModified = True
-			if lv1.startswith('alarm'):
-			    logger.debug("cmi: reset " + lv1)
-			    al_a.setAlarm(lv1)
-
-	if isModified: c_m.saveConfig()
+	if not c_m._dirty: return
+	dirty, c_m._dirty = c_m._dirty, set()
+
+	if ('reset_settings',) in dirty:
+	    logger.debug("cmi: reset_settings")
+	    for fname in (c_m._conf_fname, c_m._legacy_fname):
+		try:
+		    os.remove(fname)
+		except OSError:
+		    logger.debug("cmi: conf file not found")
+	    c_m.init()
+	    al_a.setAlarm(None)
+	    d_m.set_led_pattern()
+	    return
 
+	for lv1 in set([path[1] for path in dirty if len(path) == 3 and path[1].startswith('alarm')]):
+	    logger.debug("cmi: reset " + lv1)
+	    al_a.setAlarm(lv1)
+
+	if ('led_pattern',) in dirty:
+	    logger.debug("cmi: led_pattern")
+	    d_m.set_led_pattern()
+
+	c_m.saveConfig()
+
+    #
+    #  atomic save: temp file, fsync, rename (and fsync of the directory)
+    #
     @staticmethod
     def saveConfig():
 	logger = logging.getLogger(__name__)
 	logger.debug("saveConfig:")
-	with open(c_m._conf_fname, 'w') as fh:
-	    fh.write(pickle.dumps(c_m._c))
+	conf = { 'version' : c_m.CONF_VERSION,
+		 'values'  : [[list(path), node['value']] for path, node in c_m.leaves(c_m._c)] }
+
+	tmp = c_m._conf_fname + '.tmp'
+	with open(tmp, 'w') as fh:
+	    json.dump(conf, fh, separators = (',', ':'))
+	    fh.flush()
+	    os.fsync(fh.fileno())
+	os.rename(tmp, c_m._conf_fname)
+
+	fd = os.open(os.path.dirname(c_m._conf_fname) or '.', os.O_RDONLY)
+	try:
+	    os.fsync(fd)
+	finally:
+	    os.close(fd)
 
     @staticmethod
     def redraw_display():
@@ -763,58 +1243,36 @@ class c_m:
 	logger = logging.getLogger(__name__)
 
 	logger.debug("refresh_display")
-	logger.debug("1: {} - {} - {} sublevel={}".format(c_m._vy0,c_m._vy1,c_m._vy2,c_m._sublevel))
+	logger.debug("1: {} sublevel={}".format(c_m._view(), c_m._sublevel))
 
 	if c_m._vy0 is None: c_m.rotate_vy0()
+	nodes = c_m._nodes
 
 	if c_m._vy2 is not None:
 	    logger.debug("hierical-2")
-	    n_objs = c_m._c[c_m._vy0][c_m._vy1]
-	    n_vx = 0
-	    for t_key, t_obj in n_objs.items():
-		ld.write_char(t_key, 0, n_vx)
-		ld.write_char(str(t_obj['value']), 1, n_vx)
-		n_objs[t_key]['vx'] = n_vx
-		n_vx += len(t_key) + 1
-
-	    ld.set_location(1, int(n_objs[c_m._vy2]['vx']))
-	    ld.cursor_sw(1)
-
-        elif c_m._vy1 is not None:
-	    if c_m._sublevel:
-		logger.debug("hierical-1")
-		ld.cursor_sw(0)
-		ld.write_char(c_m._vy1 + ' >', 0, 0)
-		n_vx = 0
-		for t_key in c_m._c[c_m._vy0][c_m._vy1].keys():
-		   ld.write_char(t_key, 1, n_vx)
-		   n_vx += len(t_key) + 1
+	    group = nodes[c_m._vy1]
+	    ld.write_char(group.child_line, 0, 0)
+	    for i in group.children:
+		ld.write_char(str(nodes[i].item['value']), 1, nodes[i].col)
 
-	    else:
-		logger.debug("val select(multi)")
-		ld.write_char(c_m._vy1, 0, 0)
-		ld.write_char(str(c_m._c[c_m._vy0][c_m._vy1]['value']), 1, 0)
+	    ld.set_location(1, nodes[c_m._vy2].col)
+	    ld.cursor_sw(1)
+	    return
 
-		ld.set_location(1, 0)
-		ld.cursor_sw(1)
+	node = nodes[c_m._vy1 if c_m._vy1 is not None else c_m._vy0]
+	if not node.leaf:
+	    logger.debug("item select(multi)")
+	    ld.cursor_sw(0)
+	    ld.write_char(node.key + ' >', 0, 0)
+	    ld.write_char(node.child_line, 1, 0)
 
 	else:
-	    if c_m._sublevel:
-		logger.debug("item select(multi)")
-		ld.cursor_sw(0)
-		ld.write_char(c_m._vy0 + ' >', 0, 0)
-		n_vx = 0
-		for t_key in c_m._c[c_m._vy0].keys():
-		   ld.write_char(t_key, 1, n_vx)
-		   n_vx += len(t_key) + 1
-
-	    else:
-		logger.debug("value select(single)")
-		ld.write_char(c_m._vy0, 0, 0)
-		ld.write_char(str(c_m._c[c_m._vy0]['value']), 1, 0)
+	    logger.debug("value select")
+	    ld.write_char(node.key, 0, 0)
+	    ld.write_char(str(node.item['value']), 1, 0)
 
-		ld.set_location(1, 0)
-		ld.cursor_sw(1)
+	    ld.set_location(1, 0)
+	    ld.cursor_sw(1)
 
 ######################################################################
 #  Alarm application
@@ -830,12 +1288,13 @@ class al_a:
     _submode = 0		# SNOOZE解除キー（どのキーでも良いが連続して3度同じキーが押されたら解除）
     _key_count = 0		# 3度押されるまでのカウンタ
 
-    _queue = {}			# アラーム毎の設定時刻
-    _ordered_queue = None	# _queueの中身を発動時刻順に並べ替えたOrderedDictクラス
+    _queue = alarm_queue()	# アラーム毎の設定時刻（発動時刻順のヒープ）
     _recent_val = None		# 直近のアラーム発動時刻  Alarmとsnoozeの両方で使われる  setAlarmメソッドで設定される
     _recent_alarm = None	# 直近に発動時刻が来るアラーム名  setAlarmメソッドで設定される
     _start_time = 0		# Alarm鳴動開始時刻
     _ts_monitor = 0		# 一回/Sec画面を更新するための時刻
+    _timer = None		# 次回pollingのタイマー
+    _day_kinds = (0, 1, 2, 3, 4, 5, 6, 'workday', 'holiday')	# 'wek'の候補 -> holiday_calの日の種類
 
     #
     #  init
@@ -843,6 +1302,8 @@ class al_a:
     @staticmethod
     def init(__i2c):
 	logger = logging.getLogger(__name__)
+	holiday_cal.load()
+	audio_player.init(sounds = { 'alarm' : al_a._sound })	# 起動時にデコードしておく
 	al_a.setAlarm(None)
 	al_a.__i2c = __i2c
 
@@ -869,7 +1330,7 @@ class al_a:
 		if al_a._key_count == 3:
 		    al_a._submode = 0
 		    al_a._key_count = 0
-		    al_a.setAlarm(None)         # 今回の動作は終了させて次回を再スケジュール
+		    al_a.reschedule_due()       # 今回の動作は終了させて次回を再スケジュール
 		    d_m.change_state(c_m.get('initial_dm_state'))
 	    else:
 		# 3回押される前に違うボタンが押されたらカウンターを１に戻してやり直し
@@ -892,40 +1353,34 @@ class al_a:
     @staticmethod
     def refresh_display():
 
-	sht = { 'alarm1':'A1', 'alarm2':'A2', 'alarm3':'A3' }	# 省略名
-
 	logger = logging.getLogger(__name__)
 	if al_a._mode == 'alarm':
 	    # 動作中の表示
 	    ld.write_char('<< '+al_a._recent_alarm+' >>' , 0, 0)
-	    ld.write_char(datetime.now().strftime("%m/%d %H:%M"), 1, 0)
+	    ld.write_char(d_m.clock_text("%m/%d %H:%M", clock.time()), 1, 0)
 
 	elif al_a._mode == 'snooze':
 	    # snooze待機中
-	    ld.write_char('<WAIT>  :'+sht[al_a._recent_alarm] , 0, 0)
-	    ld.write_char(str(int(al_a._recent_val - time.time())), 1, 0)
+	    ld.write_char('<WAIT>  :'+al_a.short_name(al_a._recent_alarm) , 0, 0)
+	    ld.write_char(str(int(al_a._recent_val - clock.time())), 1, 0)
 
 	else:
-	    # 動作待ち（アラーム待機、又は予約なし）
-	    iter_q = iter(al_a._ordered_queue)
-	    try:
-		next_key = next(iter_q)
-		next_val = al_a._ordered_queue[next_key]
-		dt = datetime.fromtimestamp(next_val)
-		next_time = dt.strftime(" %m/%d %H:%M")
-		ld.write_char(sht[next_key] + next_time , 0, 0)
-	    except StopIteration:
-		ld.write_char(" - - -", 0, 0)
-		return
+	    # 動作待ち（アラーム待機、又は予約なし）: 直近の2件
+	    nexts = al_a._queue.first(2)
+	    for l in range(2):
+		if l < len(nexts):
+		    next_val, next_key = nexts[l]
+		    next_time = d_m.clock_text(" %m/%d %H:%M", next_val)
+		    ld.write_char(al_a.short_name(next_key) + next_time , l, 0)
+		else:
+		    ld.write_char(" - - -", l, 0)
+		    return
 
-	    try:
-		next_key = next(iter_q)
-		next_val = al_a._ordered_queue[next_key]
-		dt = datetime.fromtimestamp(next_val)
-		next_time = dt.strftime(" %m/%d %H:%M")
-		ld.write_char(sht[next_key] + next_time , 1, 0)
-	    except StopIteration:
-		ld.write_char(" - - -", 1, 0)
+    @staticmethod
+    def short_name(alarm_name):
+	# 省略名  alarm1 -> A1
+	if alarm_name.startswith('alarm'): return 'A' + alarm_name[5:]
+	return alarm_name[:3]
 
     #
     #  polling
@@ -951,19 +1406,47 @@ class al_a:
 	    al_a._start_time = ts
 	    al_a.exec_player()
 
-	elif al_a._mode == 'snooze' and d_m._state == 'alarm':
+	elif al_a._mode == 'snooze' and d_m._state == 'alarm' and not tr_m.running():
 	    # 'snooze'中カウントダウン表示
 	    if al_a._ts_monitor != ts:
 		ld.write_char(str(int(al_a._recent_val - ts))+" ", 1, 0)
 		al_a._ts_monitor = ts
 
-    _cmd = ['/usr/bin/mpg321', '-g 100', '/home/pi/projects/monitor_project/rev2007.mp3']
+    #
+    #  arm the timer for the next polling
+    #
+    @staticmethod
+    def arm():
+	sched.cancel(al_a._timer)
+	al_a._timer = None
+
+	if al_a._mode == 'alarm':
+	    # 60秒鳴動後の停止
+	    al_a._timer = sched.call_at(al_a._start_time + 60.01, al_a.tick)
+	elif al_a._recent_val is not None:
+	    if al_a._mode == 'snooze' and d_m._state == 'alarm':
+		# 'snooze'中カウントダウン表示（一回/Sec）
+		al_a._timer = sched.call_at(min(al_a._recent_val, int(clock.time()) + 1), al_a.tick)
+	    else:
+		al_a._timer = sched.call_at(al_a._recent_val, al_a.tick)
+
+    @staticmethod
+    def tick():
+	al_a.polling(clock.time())
+	if not tr_m.running(): ld.flush()
+	al_a.arm()
+
+    _sound = '/home/pi/projects/monitor_project/rev2007.mp3'
+    _fade_in = 10.0		# 鳴動開始から最大音量までの秒数
+    _cmd = ['/usr/bin/mpg321', '-g 100', _sound]	# audio_playerでデコードできなかった場合
     _proc = None
 
     @staticmethod
     def exec_player():
 
 	logger = logging.getLogger(__name__)
+	if audio_player.play('alarm', fade_in = al_a._fade_in): return	# デコード前・失敗時は mpg321
+
 	try:
 	    al_a._proc = Popen(al_a._cmd)
 	except EnvironmentError:
@@ -972,7 +1455,10 @@ class al_a:
     @staticmethod
     def stop_player():
 
-	al_a._proc.terminate()
+	audio_player.stop()
+	if al_a._proc is not None:
+	    al_a._proc.terminate()
+	    al_a._proc = None
 	al_a.clear_speaker_level()
 
     #
@@ -986,52 +1472,65 @@ class al_a:
 
 	if alarm_name == 'snooze':
 	    al_a._mode = 'snooze'
-	    dt = datetime.now()
+	    dt = clock.now()
 	    dt += timedelta(minutes=5)
 	    ts = time.mktime(dt.timetuple())
 	    al_a._recent_val = ts
 	    logger.debug("snooze:" +  str(ts))
+	    al_a.arm()
 	    return                     # 'snooze'の場合は_recent_valのみを変更してqueueの中身は中身はそのまま
 
 	al_a._mode = 'none'
 
-	if alarm_name == None or alarm_name == 'alarm1':
-	    if c_m._c['alarm']['alarm1']['sw ']['value'] == 'ON':
-		ts = al_a.calc_next_alarm(c_m._c['alarm']['alarm1'])
-		al_a._queue['alarm1'] = ts
-		logger.debug("alarm1:" +  str(ts))
-	    else:
-		ts = al_a._queue.pop('alarm1', None)
-		if ts != None: logger.debug("remove alarm1:"+ str(ts))
-
-	if alarm_name == None or alarm_name == 'alarm2':
-	    if c_m._c['alarm']['alarm2']['sw ']['value'] == 'ON':
-		ts = al_a.calc_next_alarm(c_m._c['alarm']['alarm2'])
-		al_a._queue['alarm2'] = ts
-		logger.debug("alarm2:" +  str(ts))
-	    else:
-		ts = al_a._queue.pop('alarm2', None)
-		if ts != None: logger.debug("remove alarm2:"+ str(ts))
-
-	if alarm_name == None or alarm_name == 'alarm3':
-	    if c_m._c['alarm']['alarm3']['sw ']['value'] == 'ON':
-		ts = al_a.calc_next_alarm(c_m._c['alarm']['alarm3'])
-		al_a._queue['alarm3'] = ts
-		logger.debug("alarm3:" +  str(ts))
-	    else:
-		ts = al_a._queue.pop('alarm3', None)
-		if ts != None: logger.debug("remove alarm3:"+ str(ts))
+	if alarm_name == None:
+	    # c_m の alarm 以下の全アラーム
+	    al_a._queue = alarm_queue()
+	    for name in c_m._c['alarm']:
+		al_a.schedule(name)
+	else:
+	    al_a.schedule(alarm_name)
 
-	al_a._ordered_queue = OrderedDict(sorted(al_a._queue.items(), key=lambda x:x[1]))
-	print var_dump(al_a._ordered_queue)
-	iter_q = iter(al_a._ordered_queue)
-	try:
-	    al_a._recent_alarm = next(iter_q)
-	    al_a._recent_val = al_a._ordered_queue[al_a._recent_alarm]
-	except StopIteration:
+	al_a.set_recent()
+
+    #
+    # after an alarm: the alarms whose time has passed get their next time
+    #
+    @staticmethod
+    def reschedule_due():
+	al_a._mode = 'none'
+	now = clock.time()
+	# schedule() は次の時刻 (> now) に入れ直すか、OFF・日付なしなら外す
+	while al_a._queue.peek() is not None and al_a._queue.peek()[0] <= now:
+	    al_a.schedule(al_a._queue.peek()[1])
+
+	al_a.set_recent()
+
+    @staticmethod
+    def schedule(alarm_name):
+	logger = logging.getLogger(__name__)
+	alarm_info = c_m._c['alarm'].get(alarm_name)
+	ts = None
+	if alarm_info is not None and alarm_info['sw ']['value'] == 'ON':
+	    ts = al_a.calc_next_alarm(alarm_info)
+	if ts is not None:
+	    al_a._queue.set(alarm_name, ts)
+	    logger.debug(alarm_name + ":" + str(ts))
+	else:
+	    ts = al_a._queue.remove(alarm_name)
+	    if ts != None: logger.debug("remove " + alarm_name + ":" + str(ts))
+
+    @staticmethod
+    def set_recent():
+	# 直近のアラームでタイマーを張り直す
+	recent = al_a._queue.peek()
+	if recent is not None:
+	    al_a._recent_val, al_a._recent_alarm = recent
+	else:
 	    al_a._recent_alarm = None
 	    al_a._recent_val   = None
 
+	al_a.arm()
+
     @staticmethod
     def calc_next_alarm(alarm_info):
 
@@ -1040,37 +1539,23 @@ class al_a:
 	h  = alarm_info['h ']['value']
 	m  = alarm_info['m ']['value']
 	logger.debug(str(wk)+":"+str(h)+":"+str(m))
-	dt_now = datetime.now()
-	dt_al = dt_now.replace(hour=h,minute=m,second=0,microsecond=0)
+	dt_now = clock.now()
 	########################################################################
 	if wk == 9:	# for alarm TEST 		今から1分後に設定
 	    dt_al = dt_now + timedelta(minutes=1)
 	    dt_al = dt_al.replace(second=0,microsecond=0)
+	    return time.mktime(dt_al.timetuple())
 
 	########################################################################
 
-	if wk < 7:      # set specified day
-	    wk_diff = wk - dt_now.weekday()	# 今日とターゲット曜日の差分から次回を計算
-	    if wk_diff < 0 : wk_diff += 7
-	    dt_al += timedelta(days=wk_diff)
-	    logger.debug("wd:wk_diff="+str(wk_diff))
-	    if dt_al <= dt_now: dt_al += timedelta(days=7)
-
-	elif wk == 7:   # set week day
-	    wk_diffs1 = (0, 0, 0, 0, 0, 2, 1)	# 今日の曜日で次回までの日数を決定　次回が本日中になる可能性がある場合は0
-	    wk_diffs2 = (1, 1, 1, 1, 3, 0, 0)	# 次回が本日でなかった場合は更にこれをこれを足す
-	    wk_diff = wk_diffs1[dt_now.weekday()]
-	    logger.debug("wd:wk_diff="+str(wk_diff))
-	    dt_al += timedelta(days=wk_diff)
-	    if dt_al <= dt_now: dt_al += timedelta(days=wk_diffs2[dt_now.weekday()])
-
-	elif wk == 8:   # set holyday
-	    wk_diffs1 = (5, 4, 3, 2, 1, 0, 0)	# 今日の曜日で次回までの日数を決定　次回が本日中になる可能性がある場合は0
-	    wk_diffs2 = (0, 0, 0, 0, 0, 1, 6)	# 次回が本日でなかった場合は更にこれをこれを足す
-	    wk_diff = wk_diffs1[dt_now.weekday()]
-	    logger.debug("wd:wk_diff="+str(wk_diff))
-	    dt_al += timedelta(days=wk_diff)
-	    if dt_al <= dt_now: dt_al += timedelta(days=wk_diffs2[dt_now.weekday()])
+	# 曜日指定(0..6)、平日（祝日を除く）、休日（土日と祝日） -> holiday_calのビットマップを検索
+	kind = al_a._day_kinds[wk]
+	day = holiday_cal.next_day(kind, dt_now.date())
+	if day is not None and datetime(day.year, day.month, day.day, h, m) <= dt_now:
+	    day = holiday_cal.next_day(kind, dt_now.date() + timedelta(days=1))
+	if day is None: return None
+	dt_al = datetime(day.year, day.month, day.day, h, m)
+	logger.debug("next day:" + str(day))
 
 	return time.mktime(dt_al.timetuple())
 
@@ -1089,41 +1574,47 @@ class al_a:
 ######################################################################
 #  MAIN
 
-logging.basicConfig(format='%(asctime)s %(funcName)s %(message)s', filename='/tmp/p3.log',level=logging.INFO)
-logger = logging.getLogger(__name__)
-logger.addHandler(logging.StreamHandler())
-
-__i2c = smbus.SMBus(1)
+#
+#  refresh display every minute
+#
+def minute_job():
+    if not tr_m.running():				# 遷移中ならば遷移の最後に描画される
+	logger.debug("Do refresh Display")
+	if d_m.refresh_display(): ld.flush()		# 表示内容が変わらなければ転送なし
+    d_m.resume_hsd()
 
-c_m.init()
-al_a.init(__i2c)
-ld.init(__i2c)
-d_m.init(__i2c)
+logger = logging.getLogger(__name__)
 
-time.sleep(5)
-d_m.resume_hsd()
-m_time = (time.time() // 60)
+def init():
+    global __i2c
 
-try:
-    while 1:
-	time.sleep(0.25)
+    sched.init()
+    metrics.start('ui')					# /tmp/monitor_ui.prom
+    bus = smbus.SMBus(1)				# shared with monitorBase through i2c_bus
+    __i2c = i2c_bus(bus, 'button')
 
-	# 描画スレッドの動作をチェック
-	if d_m._transit_state is not None:
-	    continue				# 描画スレッド動作中ならば、以下の処理を一回スキップ
+    c_m.init()
+    al_a.init(i2c_bus(bus, 'speaker'))
+    ld.init(i2c_bus(bus, 'ld'))
+    d_m.init(__i2c)
 
-	ts = time.time()
-	d_m.polling(ts)
-	al_a.polling(ts)
+    ipc_client.connect(d_m.on_message, d_m.on_connect)	# on_connect sends hsd mode and led pattern
+    sched.every_minute(0, minute_job)
+    sched.every(3600, i2c_bus.log_stats)	# I2C bus wait time histograms
 
-	if (m_time != (ts) // 60):
-	    m_time = (ts) // 60
+def main():
+    logging.basicConfig(format='%(asctime)s %(funcName)s %(message)s', filename='/tmp/p3.log',level=logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    trace.open(os.environ.get('MONITOR_TRACE'))		# record events for monitorSim
 
-	    logger.debug("Do refresh Display")
-	    d_m.refresh_display()
-	    d_m.resume_hsd()
+    init()
+    try:
+	sched.run()
 
-except KeyboardInterrupt:
+    except KeyboardInterrupt:
 
-    GPIO.cleanup()
+	metrics.export()
+	GPIO.cleanup()
 
+if __name__ == '__main__':
+    main()
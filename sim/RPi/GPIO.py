@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#
+#  fake RPi.GPIO module for monitorSim
+#
+#	add_event_detect() only stores the callback; the simulation
+#	calls fire(port) to deliver an edge.
+#
+
+BCM   = 11
+BOARD = 10
+IN    = 1
+OUT   = 0
+RISING  = 31
+FALLING = 32
+BOTH    = 33
+PUD_UP   = 22
+PUD_DOWN = 21
+
+_callbacks = {}			# port -> [callback, ...]
+_levels = {}
+
+def setmode(mode):
+    pass
+
+def setwarnings(flag):
+    pass
+
+def setup(port, direction, pull_up_down = None, initial = None):
+    _levels.setdefault(port, 0)
+
+def input(port):
+    return _levels.get(port, 0)
+
+def output(port, value):
+    _levels[port] = value
+
+def add_event_detect(port, edge, callback = None, bouncetime = None):
+    _callbacks[port] = [callback] if callback is not None else []
+
+def add_event_callback(port, callback):
+    _callbacks.setdefault(port, []).append(callback)
+
+def remove_event_detect(port):
+    _callbacks.pop(port, None)
+
+def cleanup(port = None):
+    if port is None: _callbacks.clear()
+    else:	     _callbacks.pop(port, None)
+
+#
+#  simulation: deliver an edge on the port
+#
+def fire(port):
+    for cb in list(_callbacks.get(port, [])):
+	cb(port)
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+#
+#  fake smbus module for monitorSim (put sim/ in front of sys.path)
+#
+#	counts transactions and bytes per device address and emulates
+#	the devices the daemons read from:
+#
+#	  0x3f  button shim expander : input register = ~keys
+#	  0x45  SHT-31               : temperature / humidity with CRC,
+#	                               NACK (IOError) during a single shot
+#
+#	The device state is module global: both daemons share one bus.
+#
+from monitorLib import clock
+
+keys = 0			# pressed buttons (bit mask)
+temp = 20.0			# SHT-31 temperature
+hum  = 50.0			# SHT-31 humidity
+busy = 0.0			# SHT-31 converts a single shot until (clock.monotonic())
+SINGLE_SEC = 0.0155		# conversion time (high repeatability)
+
+NAMES = { 0x3c : 'SO1602', 0x3f : 'expander', 0x45 : 'SHT-31', 0x54 : 'speaker' }
+
+def crc8(data):
+    crc = 0xff
+    for b in data:
+	crc ^= b
+	for i in range(8):
+	    if crc & 0x80: crc = ((crc << 1) ^ 0x31) & 0xff
+	    else:	   crc = (crc << 1) & 0xff
+    return crc
+
+def _word(v):
+    v = max(0, min(0xffff, int(round(v))))
+    w = [v >> 8, v & 0xff]
+    return w + [crc8(w)]
+
+def sht31_frame():
+    return _word((temp + 45) * 65535.0 / 175) + _word(hum * 65535.0 / 100)
+
+class SMBus:
+
+    def __init__(self, bus = None):
+	self.stats = {}			# addr -> [transactions, bytes]
+
+    def _count(self, addr, n):
+	st = self.stats.setdefault(addr, [0, 0])
+	st[0] += 1
+	st[1] += n + 1			# + address byte
+
+    def write_byte(self, addr, val):
+	self._count(addr, 1)
+
+    def read_byte(self, addr):
+	self._count(addr, 1)
+	return 0
+
+    def write_byte_data(self, addr, cmd, val):
+	self._count(addr, 2)
+
+    def read_byte_data(self, addr, cmd):
+	self._count(addr, 2)
+	if addr == 0x3f and cmd == 0x00: return ~keys & 0xff
+	return 0
+
+    def _sht31(self, cmd = None):
+	global busy
+	if clock.monotonic() < busy: raise IOError(121, 'Remote I/O error')
+	if cmd == 0x24: busy = clock.monotonic() + SINGLE_SEC
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+	self._count(addr, 1 + len(vals))
+	if addr == 0x45: self._sht31(cmd)
+
+    def read_i2c_block_data(self, addr, cmd, n = 32):
+	self._count(addr, 1 + n)
+	if addr == 0x45:
+	    self._sht31()
+	    return (sht31_frame() + [0] * n)[:n]
+	return [0] * n
+
+    def close(self):
+	pass